@@ -445,6 +445,21 @@ module.exports.FrameTensor = class FrameTensor {
     return [columns, cutterData, throwerData];
   }
 
+  // Returns un-permuted frames in a format suitable for saving to a CSV. Unlike
+  // getPermutedCsvData, each frame is written once rather than once per
+  // player; the trainers permute them on the fly.
+  getCsvData(columns) {
+    columns = columns || this.allKeys(false);
+    const data = [];
+    for (let frame of this.frames) {
+      if (!INTERESTING_STATES.includes(frame.get('state'))) {
+        continue;
+      }
+      data.push(columns.map(col => this.renderCsvCell(frame, col)));
+    }
+    return [columns, data];
+  }
+
   filter(condition) {
     const newTensor = new FrameTensor();
     newTensor.frames = this.frames.filter(condition);
@@ -0,0 +1,379 @@
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import subprocess
+import tempfile
+import time
+import numpy as np
+import tensorflow as tf
+
+import check_csv
+import export_model
+import inputs
+import profiling
+import train_bootstrap
+from schema import ACTION_VALUES, MODEL_INPUTS, MODEL_OUTPUTS, SELECTED_COLUMNS, \
+    STATE_VALUES
+
+# Benchmarks the training and inference code on synthetic examples, so that it
+# runs offline and the same way on every machine. Writes a JSON file of results
+# which can be diffed between commits, see --baseline. Measures:
+#
+# - decode: reading the example CSV into batches, as the trainers do.
+# - featurize: building inputs and labels from decoded batches, a whole batch
+#   at a time (batch input mode) or one example at a time (example input mode).
+# - train: model.fit steps per second of each model, on featurized batches.
+# - inference: latency of the exported serving function of each model, for a
+#   single player, a team of 7, all 14 players and a large batch.
+# - check_csv: validating the example CSV with check_csv.py.
+#
+# The synthetic CSV has the columns of FrameTensor.getPermutedCsvData, in the
+# same order, with values in the ranges the simulator records and rendered the
+# same way as FrameTensor.renderCsvCell. It is written once per size and seed,
+# and reused.
+
+# Same as FrameTensor.allKeys(true): the last_ columns come after the outputs.
+CSV_COLUMNS = [c for c in MODEL_INPUTS if not c.startswith('last_')] + \
+    MODEL_OUTPUTS + [c for c in MODEL_INPUTS if c.startswith('last_')]
+assert sorted(CSV_COLUMNS) == sorted(SELECTED_COLUMNS)
+PLAYERS = ['team_%d_player_%d' % (t, p) for t in range(2) for p in range(7)]
+# Decimals of the numbers written by csv_utils.writeToFile.
+PRECISION = 3
+
+# Value ranges of the simulator, see game_params.js, player.js and
+# range_finder.js.
+FIELD_LENGTH = 110
+FIELD_WIDTH = 40
+MAX_PLAYER_SPEED = 0.2
+ARM_HEIGHT = 2
+MAX_DISC_HEIGHT = 5
+MAX_STALL_COUNT = 10
+MIN_THROW_SPEED = 0.3
+MAX_THROW_SPEED = 1.2
+MIN_LAUNCH_ANGLE = -0.5
+MAX_LAUNCH_ANGLE = 1.0
+MAX_ANGLE_OF_ATTACK = 0.7
+# Share of each state and action in recorded games, roughly.
+STATE_WEIGHTS = {'pickup': 0.05, 'normal': 0.85, 'receiving': 0.05, 'kickoff': 0.05}
+CUTTER_ACTION_WEIGHTS = {'rest': 0.3, 'move': 0.7, 'throw': 0.0}
+THROWER_ACTION_WEIGHTS = {'rest': 0.3, 'move': 0.2, 'throw': 0.5}
+# In each frame, one of the 14 players is team_0_player_0 of each example.
+THROWER_FRACTION = 1 / len(PLAYERS)
+# Share of cutter examples where another player has the disc.
+HELD_FRACTION = 0.8
+GENERATE_CHUNK_ROWS = 50000
+
+INFERENCE_BATCH_SIZES = [1, 7, 14, 1024]
+MODELS = {
+    'fully_connected': train_bootstrap.FullyConnectedModel,
+    'convolution': train_bootstrap.ConvolutionModel,
+}
+
+def weighted_choice(rng, weights, rows):
+  p = np.array(list(weights.values()))
+  return rng.choice(len(p), rows, p=p / p.sum())
+
+# Returns move or throw parameters for every row, with NaN where 'action' is
+# another action. Moves are destinations on the field, in field coordinates
+# like every other position, made relative to team_0_player_0 along with them
+# by synthetic_columns. Throws are the parameters of RangeFinder.getRandomThrow.
+def action_columns(rng, action, prefix=''):
+  rows = len(action)
+  values = {}
+  is_move = action == ACTION_VALUES.index('move')
+  is_throw = action == ACTION_VALUES.index('throw')
+  values[prefix + 'move_x'] = np.where(is_move, rng.uniform(0, FIELD_LENGTH, rows), np.nan)
+  values[prefix + 'move_y'] = np.where(is_move, rng.uniform(0, FIELD_WIDTH, rows), np.nan)
+  speed = rng.uniform(MIN_THROW_SPEED, MAX_THROW_SPEED, rows)
+  direction = rng.uniform(-math.pi, math.pi, rows)
+  launch = rng.uniform(MIN_LAUNCH_ANGLE, MAX_LAUNCH_ANGLE, rows)
+  throw = {
+      'throw_x': speed * np.cos(launch) * np.cos(direction),
+      'throw_y': speed * np.cos(launch) * np.sin(direction),
+      'throw_z': speed * np.sin(launch),
+      'throw_angleOfAttack': rng.uniform(-MAX_ANGLE_OF_ATTACK, MAX_ANGLE_OF_ATTACK, rows),
+      'throw_tiltAngle': np.zeros(rows),
+  }
+  for k, v in throw.items():
+    values[prefix + k] = np.where(is_throw, v, np.nan)
+  return values
+
+# Returns a dict of float64 columns for 'rows' examples, with NaN for missing
+# values.
+def synthetic_columns(rng, rows):
+  values = {}
+  state = weighted_choice(rng, STATE_WEIGHTS, rows)
+  values['state'] = state
+  values['offensiveTeam'] = rng.integers(0, 2, rows)
+  values['offensiveGoalDirection'] = rng.integers(0, 2, rows)
+  for player in PLAYERS:
+    speed = MAX_PLAYER_SPEED * np.sqrt(rng.uniform(0, 1, rows))
+    direction = rng.uniform(-math.pi, math.pi, rows)
+    values[player + '_x'] = rng.uniform(0, FIELD_LENGTH, rows)
+    values[player + '_y'] = rng.uniform(0, FIELD_WIDTH, rows)
+    values[player + '_vx'] = speed * np.cos(direction)
+    values[player + '_vy'] = speed * np.sin(direction)
+    values[player + '_hasDisc'] = np.zeros(rows)
+
+  # Index of the player holding the disc, or -1 while it is in the air.
+  is_thrower = rng.uniform(0, 1, rows) < THROWER_FRACTION
+  other = rng.integers(1, len(PLAYERS), rows)
+  holder = np.where(is_thrower, 0,
+      np.where(rng.uniform(0, 1, rows) < HELD_FRACTION, other, -1))
+  held = holder >= 0
+  positions = np.stack(
+      [np.stack([values[p + '_x'], values[p + '_y']], -1) for p in PLAYERS], 1)
+  holder_position = positions[np.arange(rows), np.maximum(holder, 0)]
+  for i, player in enumerate(PLAYERS):
+    values[player + '_hasDisc'][holder == i] = 1
+  values['disc_x'] = np.where(held, holder_position[:, 0], rng.uniform(0, FIELD_LENGTH, rows))
+  values['disc_y'] = np.where(held, holder_position[:, 1], rng.uniform(0, FIELD_WIDTH, rows))
+  values['disc_z'] = np.where(held, ARM_HEIGHT, rng.uniform(0, MAX_DISC_HEIGHT, rows))
+  values['stallCount'] = np.where(held & (state == STATE_VALUES.index('normal')),
+      rng.uniform(0, MAX_STALL_COUNT, rows), 0)
+
+  x, y = values['team_0_player_0_x'], values['team_0_player_0_y']
+  action = np.where(is_thrower,
+      weighted_choice(rng, THROWER_ACTION_WEIGHTS, rows),
+      weighted_choice(rng, CUTTER_ACTION_WEIGHTS, rows))
+  values['action'] = action
+  values.update(action_columns(rng, action))
+  last_action = rng.integers(0, len(ACTION_VALUES), rows)
+  values['last_action'] = last_action
+  values.update(action_columns(rng, last_action, 'last_'))
+
+  # Same as FrameTensor.getOffsetFrame.
+  for column in CSV_COLUMNS:
+    for axis, origin in [('x', x), ('y', y)]:
+      if column.split('_')[-1] == axis and column != 'team_0_player_0_' + axis:
+        values[column] = values[column] - origin
+  return values
+
+# Renders a column the same way as csv_utils.writeToFile: whole numbers without a
+# decimal point, other numbers with PRECISION decimals, and missing values
+# empty.
+def render_column(values):
+  values = values.astype(np.float64)
+  text = np.full(len(values), '', dtype=object)
+  present = ~np.isnan(values)
+  whole = present & (values == np.trunc(values))
+  fraction = present & ~whole
+  text[whole] = values[whole].astype(np.int64).astype(str)
+  text[fraction] = ['%.*f' % (PRECISION, v) for v in values[fraction].tolist()]
+  return text.tolist()
+
+# Returns the lines of chunk 'index' of the synthetic CSV. Each chunk has a seed
+# of its own, so that the file is the same however many processes write it.
+def synthetic_lines(args):
+  seed, index, rows = args
+  values = synthetic_columns(np.random.default_rng([seed, index]), rows)
+  columns = [render_column(values[c]) for c in CSV_COLUMNS]
+  return ''.join(','.join(cells) + '\n' for cells in zip(*columns))
+
+def write_synthetic_csv(filename, rows, seed, workers=None):
+  tasks = [
+      (seed, i, min(GENERATE_CHUNK_ROWS, rows - start))
+      for i, start in enumerate(range(0, rows, GENERATE_CHUNK_ROWS))
+  ]
+  with open(filename + '.tmp', 'w') as f, multiprocessing.Pool(workers) as pool:
+    f.write(','.join(CSV_COLUMNS) + '\n')
+    for lines in pool.imap(synthetic_lines, tasks):
+      f.write(lines)
+  os.replace(filename + '.tmp', filename)
+
+def synthetic_csv(data_dir, rows, seed, workers=None):
+  filename = os.path.join(data_dir, 'examples_%d_%d.csv' % (rows, seed))
+  if not os.path.exists(filename):
+    os.makedirs(data_dir, exist_ok=True)
+    start = time.perf_counter()
+    write_synthetic_csv(filename, rows, seed, workers)
+    print('Wrote %d examples to %s in %.1fs' %
+        (rows, filename, time.perf_counter() - start), flush=True)
+  return filename
+
+def decoded(filename):
+  return inputs.example_dataset(
+      filename,
+      flags.batch_size,
+      column_defaults = train_bootstrap.COLUMN_DEFAULTS,
+      shuffle_buffer_size = 1)
+
+def benchmark_decode(filename):
+  elements, examples, seconds = profiling.read(decoded(filename))
+  return {
+      'decode.examples': examples,
+      'decode.examples_per_second': examples / seconds,
+  }
+
+def benchmark_featurize(filename):
+  batches = decoded(filename).take(flags.featurize_batches).cache()
+  examples = profiling.read(batches)[1]
+  batch_seconds = profiling.featurize_seconds(batches,
+      lambda data: (train_bootstrap.batch_raw_inputs(data), train_bootstrap.labels(data)))
+  # In example input mode, each example is featurized on its own.
+  single = batches.unbatch().take(flags.featurize_examples).batch(1).cache()
+  single_examples = profiling.read(single)[1]
+  example_seconds = profiling.featurize_seconds(single,
+      lambda data: (train_bootstrap.raw_inputs(data),
+          tf.reshape(train_bootstrap.labels(data), (-1,))))
+  return {
+      'featurize.batch.examples_per_second':
+          examples / batch_seconds if batch_seconds else None,
+      'featurize.example.examples_per_second':
+          single_examples / example_seconds if example_seconds else None,
+  }
+
+def featurized(filename):
+  data = next(iter(decoded(filename).take(1)))
+  return train_bootstrap.batch_raw_inputs(data), train_bootstrap.labels(data)
+
+def benchmark_train(name, features, labels):
+  model = MODELS[name]()
+  model.compile(
+      loss = train_bootstrap.prediction_loss,
+      optimizer = 'adam',
+      jit_compile = flags.jit_compile)
+  dataset = tf.data.Dataset.from_tensor_slices((features, labels)) \
+      .batch(train_bootstrap.FIT_BATCH_SIZE, drop_remainder=True) \
+      .cache() \
+      .repeat()
+  # The first steps trace and compile the train step.
+  model.fit(dataset, steps_per_epoch=10, verbose=0)
+  start = time.perf_counter()
+  model.fit(dataset, steps_per_epoch=flags.steps, verbose=0)
+  seconds = time.perf_counter() - start
+  return model, {
+      'train.%s.steps_per_second' % name: flags.steps / seconds,
+      'train.%s.step_ms' % name: seconds * 1000 / flags.steps,
+  }
+
+def benchmark_inference(name, model, features):
+  serve = export_model.serving_function(model)
+  results = {}
+  for batch_size in INFERENCE_BATCH_SIZES:
+    batch = tf.constant(np.resize(features.numpy(), (batch_size, features.shape[1])))
+    serve(batch)
+    latencies = []
+    for i in range(flags.repeats):
+      start = time.perf_counter()
+      serve(batch)['outputs'].numpy()
+      latencies.append((time.perf_counter() - start) * 1000)
+    prefix = 'inference.%s.batch_%d.' % (name, batch_size)
+    results[prefix + 'latency_ms_p50'] = float(np.percentile(latencies, 50))
+    results[prefix + 'latency_ms_p99'] = float(np.percentile(latencies, 99))
+    results[prefix + 'examples_per_second'] = batch_size * 1000 / np.mean(latencies)
+  return results
+
+def benchmark_check_csv(filename):
+  start = time.perf_counter()
+  broken = check_csv.check(filename, workers=flags.workers)
+  seconds = time.perf_counter() - start
+  if broken:
+    raise ValueError('%d broken rows in the synthetic CSV %s' % (broken, filename))
+  return {
+      'check_csv.rows_per_second': flags.rows / seconds,
+      'check_csv.megabytes_per_second': os.path.getsize(filename) / (1 << 20) / seconds,
+  }
+
+def commit():
+  try:
+    return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'],
+        cwd=os.path.dirname(os.path.abspath(__file__)), capture_output=True,
+        text=True, check=True).stdout.strip()
+  except (OSError, subprocess.CalledProcessError):
+    return None
+
+# Prints the change of each result from 'baseline', a file written by a
+# previous run.
+def compare(results, baseline):
+  with open(baseline) as f:
+    previous = json.load(f)
+  print('%-52s %14s %14s %9s' % ('result (vs %s)' % previous.get('commit'),
+      'baseline', 'current', 'change'))
+  for key in sorted(set(results) | set(previous['results'])):
+    old, new = previous['results'].get(key), results.get(key)
+    change = '%+8.1f%%' % (100 * (new - old) / old) if old and new is not None else '-'
+    print('%-52s %14s %14s %9s' % (key,
+        '-' if old is None else '%.6g' % old,
+        '-' if new is None else '%.6g' % new, change))
+
+def main():
+  filename = synthetic_csv(flags.data_dir, flags.rows, flags.seed, flags.workers)
+  results = {}
+  if 'decode' in flags.benchmarks:
+    results.update(benchmark_decode(filename))
+  if 'featurize' in flags.benchmarks:
+    results.update(benchmark_featurize(filename))
+  if 'train' in flags.benchmarks or 'inference' in flags.benchmarks:
+    features, labels = featurized(filename)
+    for name in MODELS:
+      tf.keras.utils.set_random_seed(flags.seed)
+      model, train_results = benchmark_train(name, features, labels)
+      if 'train' in flags.benchmarks:
+        results.update(train_results)
+      if 'inference' in flags.benchmarks:
+        results.update(benchmark_inference(name, model, features))
+  if 'check_csv' in flags.benchmarks:
+    results.update(benchmark_check_csv(filename))
+
+  report = {
+      'commit': commit(),
+      'time': time.time(),
+      'config': {
+          'rows': flags.rows,
+          'seed': flags.seed,
+          'batch_size': flags.batch_size,
+          'steps': flags.steps,
+          'repeats': flags.repeats,
+          'jit_compile': flags.jit_compile,
+          'cpus': os.cpu_count(),
+          'tensorflow': tf.__version__,
+      },
+      'results': results,
+  }
+  with open(flags.output, 'w') as f:
+    json.dump(report, f, indent=2, sort_keys=True)
+  print('Wrote %s' % flags.output)
+  if flags.baseline:
+    compare(results, flags.baseline)
+  else:
+    for key, value in sorted(results.items()):
+      print('%-52s %14.6g' % (key, value))
+
+BENCHMARKS = ['decode', 'featurize', 'train', 'inference', 'check_csv']
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Benchmark training and inference on synthetic examples.')
+  parser.add_argument('--output', default='benchmark.json',
+      help='JSON file to write results to.');
+  parser.add_argument('--baseline',
+      help='JSON file written by a previous run, to compare results with.');
+  parser.add_argument('--benchmarks', nargs='+', default=BENCHMARKS, choices=BENCHMARKS,
+      help='Benchmarks to run');
+  parser.add_argument('--rows', default=100000, type=int,
+      help='Number of synthetic examples, from 10k to 10M.');
+  parser.add_argument('--seed', default=0, type=int,
+      help='Seed for the synthetic examples and initial weights');
+  parser.add_argument('--data_dir',
+      default=os.path.join(tempfile.gettempdir(), 'ultimate_benchmark'),
+      help='Directory to write synthetic CSVs to, and reuse them from.');
+  parser.add_argument('--batch_size', default=10000, type=int,
+      help='Examples per decoded batch, same as --train_batch_size of the trainers');
+  parser.add_argument('--featurize_batches', default=5, type=int,
+      help='Number of batches to featurize in batch input mode');
+  parser.add_argument('--featurize_examples', default=2000, type=int,
+      help='Number of examples to featurize in example input mode');
+  parser.add_argument('--steps', default=200, type=int,
+      help='Number of train steps to time for each model');
+  parser.add_argument('--repeats', default=200, type=int,
+      help='Number of calls to time for each inference batch size');
+  parser.add_argument('--jit_compile', default=False, action='store_true',
+      help='Compile train steps with XLA.');
+  parser.add_argument('--workers', type=int, help='Number of processes writing the synthetic CSV and running check_csv.py');
+  flags = parser.parse_args()
+  if not 10000 <= flags.rows <= 10000000:
+    parser.error('--rows must be from 10k to 10M')
+  main()
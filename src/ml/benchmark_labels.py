@@ -0,0 +1,74 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+import train_bootstrap
+import train_double_bootstrap
+from schema import ACTION_VALUES, NUMERIC_MODEL_OUTPUTS
+
+# Micro-benchmark of label construction in the trainers. Compares the previous
+# per-example implementations, which built the throw label with tf.map_fn and
+# concatenated one reshaped column at a time, with the current batch-level ones.
+
+def legacy_labels(data):
+  one_hot_action = tf.one_hot(data['action'], 3)
+  numeric_labels = []
+  for k in NUMERIC_MODEL_OUTPUTS:
+    numeric_labels.append(tf.reshape(data[k], (1, 1), name=k))
+  return tf.concat([one_hot_action] + numeric_labels, axis=-1)
+
+def legacy_cutter_labels(data):
+  numeric_labels = []
+  for k in train_double_bootstrap.CUTTER_MODEL_OUTPUTS:
+    numeric_labels.append(tf.reshape(data[k], (1,), name=k))
+  return tf.concat(numeric_labels, axis=-1)
+
+def legacy_thrower_labels(data):
+  throw_action = tf.map_fn(
+      lambda action: 1.0 if action == ACTION_VALUES.index('throw') else 0.0,
+      data['action'],
+      dtype = tf.float32)
+  numeric_labels = []
+  for k in train_double_bootstrap.THROWER_MODEL_NUMERIC_OUTPUTS:
+    numeric_labels.append(tf.reshape(data[k], (1,), name=k))
+  return tf.concat([throw_action] + numeric_labels, axis=-1)
+
+def synthetic_data(rows, seed=0):
+  rng = np.random.default_rng(seed)
+  data = {'action': rng.integers(0, len(ACTION_VALUES), rows).astype(np.int32)}
+  for k in NUMERIC_MODEL_OUTPUTS:
+    data[k] = rng.normal(size=rows).astype(np.float32)
+  return data
+
+# Returns labels per second, building labels one example at a time (then
+# batching, as in example input mode) or a whole batch at a time.
+def measure(data, labels_fn, batch_size, per_example):
+  dataset = tf.data.Dataset.from_tensor_slices(data)
+  if per_example:
+    dataset = dataset.batch(1).map(labels_fn).batch(batch_size)
+  else:
+    dataset = dataset.batch(batch_size).map(labels_fn)
+  rows = 0
+  start = time.time()
+  for labels in dataset:
+    rows += labels.shape[0]
+  return rows / (time.time() - start)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Benchmark label construction.')
+  parser.add_argument('--rows', default=100000, type=int, help='Number of labels to build');
+  parser.add_argument('--batch_size', default=10000, type=int, help='Batch size');
+  flags = parser.parse_args()
+
+  data = synthetic_data(flags.rows)
+  for name, legacy_fn, labels_fn in [
+      ('labels', legacy_labels, train_bootstrap.labels),
+      ('cutter_labels', legacy_cutter_labels, train_double_bootstrap.cutter_labels),
+      ('thrower_labels', legacy_thrower_labels, train_double_bootstrap.thrower_labels),
+  ]:
+    before = measure(data, legacy_fn, flags.batch_size, per_example=True)
+    example = measure(data, labels_fn, flags.batch_size, per_example=True)
+    batch = measure(data, labels_fn, flags.batch_size, per_example=False)
+    print('%-15s before: %10.0f/s  per-example: %10.0f/s  batch: %12.0f/s (%.0fx)' %
+        (name, before, example, batch, batch / before))
@@ -0,0 +1,229 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+import inputs
+import train_bootstrap
+import train_double_bootstrap
+from schema import ACTION_VALUES, NUMERIC_MODEL_OUTPUTS
+
+# Compares the logit-based losses of the trainers with the previous ones, which
+# applied softmax_cross_entropy_with_logits to the output of a softmax, applied
+# binary cross entropy to the unbounded thrower output, and regressed move and
+# throw outputs on every example. For each model, measures:
+#
+# - The time of the loss and its gradient, and of a whole train step.
+# - The gradient of the loss with respect to the action logits, when the model
+#   is unsure and when it is confidently wrong.
+# - Held out action accuracy and move/throw error while training on a fixed
+#   sample, from the same initial weights.
+
+def legacy_prediction_loss(y, y_pred):
+  y_pred = tf.reshape(y_pred, tf.shape(y))
+  action, others = tf.split(y, [len(ACTION_VALUES), len(NUMERIC_MODEL_OUTPUTS)], axis=-1)
+  action_pred, others_pred = \
+      tf.split(y_pred, [len(ACTION_VALUES), len(NUMERIC_MODEL_OUTPUTS)], axis=-1)
+  action_loss = tf.nn.softmax_cross_entropy_with_logits(action, action_pred)
+  others_loss = tf.compat.v1.losses.mean_squared_error(others, others_pred)
+  return action_loss * train_bootstrap.ACTION_WEIGHT + others_loss
+
+def legacy_cutter_loss(y, y_pred):
+  return tf.keras.losses.mean_squared_error(y[:, 1:], y_pred)
+
+def legacy_thrower_loss(y, y_pred):
+  y_pred = tf.reshape(y_pred, tf.shape(y))
+  action, params = tf.split(y, [1, 5], axis=-1)
+  action_pred, params_pred = tf.split(y_pred, [1, 5], axis=-1)
+  return tf.keras.losses.binary_crossentropy(action, action_pred) * \
+      train_double_bootstrap.ACTION_WEIGHT \
+      + tf.compat.v1.losses.mean_squared_error(params, params_pred)
+
+def softmax_actions(outputs):
+  actions, others = tf.split(outputs, [len(ACTION_VALUES), -1], axis=-1)
+  return tf.concat([tf.nn.softmax(actions), others], axis=-1)
+
+# For each model: which examples it is trained on by team_0_player_0_hasDisc,
+# how to build it and its labels, the number of action outputs, and the losses
+# to compare, with the activation the previous model applied to its outputs.
+MODELS = {
+    'model': (
+        None,
+        lambda: train_bootstrap.ConvolutionModel(),
+        train_bootstrap.labels,
+        len(ACTION_VALUES),
+        {
+            'legacy': (legacy_prediction_loss, softmax_actions),
+            'current': (train_bootstrap.prediction_loss, None),
+        }),
+    'cutter': (
+        0,
+        lambda: train_double_bootstrap.ConvolutionModel(
+            len(train_double_bootstrap.CUTTER_MODEL_OUTPUTS)),
+        train_double_bootstrap.cutter_labels,
+        0,
+        {
+            'legacy': (legacy_cutter_loss, None),
+            'current': (train_double_bootstrap.cutter_loss, None),
+        }),
+    'thrower': (
+        1,
+        lambda: train_double_bootstrap.ConvolutionModel(
+            len(train_double_bootstrap.THROWER_MODEL_OUTPUTS)),
+        train_double_bootstrap.thrower_labels,
+        1,
+        {
+            'legacy': (legacy_thrower_loss, None),
+            'current': (train_double_bootstrap.thrower_loss, None),
+        }),
+}
+
+# Applies 'activation' to the outputs of 'model', as the previous models did in
+# their output layer.
+class Activated(tf.keras.Model):
+  def __init__(self, model, activation):
+    super(Activated, self).__init__()
+    self.model = model
+    self.activation = activation
+
+  def call(self, inputs, training=False):
+    outputs = self.model(inputs, training=training)
+    return self.activation(outputs) if self.activation else outputs
+
+def sample(filename, has_disc, labels_fn, size):
+  features, labels = [], []
+  examples = 0
+  for data in inputs.example_dataset(filename, 10000, has_disc=has_disc):
+    features.append(train_bootstrap.batch_raw_inputs(data).numpy())
+    labels.append(labels_fn(data).numpy())
+    examples += len(features[-1])
+    if examples >= size:
+      break
+  if not examples:
+    raise ValueError('No examples found in %s' % filename)
+  return np.concatenate(features)[:size], np.concatenate(labels)[:size]
+
+def cpu_ms(function, repeats):
+  function()
+  start = time.process_time()
+  for i in range(repeats):
+    function()
+  return (time.process_time() - start) * 1000 / repeats
+
+def loss_ms(loss_fn, labels, outputs, repeats):
+  labels = tf.constant(labels)
+  outputs = tf.constant(outputs)
+  @tf.function
+  def step():
+    with tf.GradientTape() as tape:
+      tape.watch(outputs)
+      loss = tf.reduce_mean(loss_fn(labels, outputs))
+    return tape.gradient(loss, outputs)
+  return cpu_ms(step, repeats)
+
+# Returns the mean absolute gradient of the loss with respect to the action
+# logits, for logits which are 'margin' away from the labels, in the wrong
+# direction.
+def action_gradient(loss_fn, activation, labels, num_actions, num_outputs, margin):
+  actions = labels[:, :num_actions]
+  logits = np.zeros((len(labels), num_outputs), dtype=np.float32)
+  logits[:, :num_actions] = margin * (1 - 2 * actions)
+  logits = tf.constant(logits)
+  with tf.GradientTape() as tape:
+    tape.watch(logits)
+    outputs = activation(logits) if activation else logits
+    loss = tf.reduce_mean(loss_fn(tf.constant(labels), outputs))
+  return float(tf.reduce_mean(tf.abs(tape.gradient(loss, logits)[:, :num_actions])))
+
+# Action accuracy, and mean squared error of the move and throw outputs on move
+# and throw examples, computed the same way whatever the loss.
+def metrics(name, outputs, labels, variant):
+  result = {}
+  if name == 'model':
+    actions = labels[:, :len(ACTION_VALUES)]
+    result['accuracy'] = np.mean(
+        np.argmax(outputs[:, :len(ACTION_VALUES)], axis=-1) == np.argmax(actions, axis=-1))
+    numeric_outputs = outputs[:, len(ACTION_VALUES):]
+    numeric_labels = labels[:, len(ACTION_VALUES):]
+    move = len(train_bootstrap.MOVE_OUTPUTS)
+    errors = [
+        ('move_mse', actions[:, ACTION_VALUES.index('move')],
+            numeric_outputs[:, :move], numeric_labels[:, :move]),
+        ('throw_mse', actions[:, ACTION_VALUES.index('throw')],
+            numeric_outputs[:, move:], numeric_labels[:, move:]),
+    ]
+  elif name == 'cutter':
+    errors = [('move_mse', labels[:, 0], outputs, labels[:, 1:])]
+  else:
+    # The previous thrower output was a probability, not a logit.
+    threshold = 0.5 if variant == 'legacy' else 0.0
+    result['accuracy'] = np.mean((outputs[:, 0] > threshold) == (labels[:, 0] > 0.5))
+    errors = [('throw_mse', labels[:, 0], outputs[:, 1:], labels[:, 1:])]
+  for key, mask, predicted, actual in errors:
+    squared = np.mean(np.square(predicted - actual), axis=-1)
+    result[key] = squared[mask > 0].mean() if np.any(mask > 0) else float('nan')
+  return result
+
+def compare(name, filename):
+  has_disc, build, labels_fn, num_actions, losses = MODELS[name]
+  features, labels = sample(filename, has_disc, labels_fn, flags.sample_size)
+  held_out = len(features) // 5
+  train_features, train_labels = features[held_out:], labels[held_out:]
+  test_features, test_labels = features[:held_out], labels[:held_out]
+  print('[%s] %d training and %d held out examples' %
+      (name, len(train_features), len(test_features)))
+
+  for variant, (loss_fn, activation) in losses.items():
+    tf.keras.utils.set_random_seed(flags.seed)
+    model = Activated(build(), activation)
+    model.compile(loss=loss_fn, optimizer='adam', jit_compile=flags.jit_compile)
+    num_outputs = model(features[:1]).shape[-1]
+
+    batch = train_labels[:train_bootstrap.FIT_BATCH_SIZE]
+    outputs = model(train_features[:len(batch)]).numpy()
+    loss_time = loss_ms(loss_fn, batch, outputs, flags.repeats)
+    step = lambda: model.train_on_batch(
+        train_features[:len(batch)], batch)
+    step_time = cpu_ms(step, flags.repeats)
+    gradients = ''
+    if num_actions:
+      gradients = ', action gradient %.3g unsure, %.3g confidently wrong' % (
+          action_gradient(loss_fn, activation, batch, num_actions, num_outputs, 0.1),
+          action_gradient(loss_fn, activation, batch, num_actions, num_outputs, 10.0))
+    print('[%s] %s: loss and gradient %.3f ms, train step %.3f ms (CPU)%s' %
+        (name, variant, loss_time, step_time, gradients))
+
+    tf.keras.utils.set_random_seed(flags.seed)
+    model = Activated(build(), activation)
+    model.compile(loss=loss_fn, optimizer='adam', jit_compile=flags.jit_compile)
+    for epoch in range(1, flags.epochs + 1):
+      model.fit(train_features, train_labels, batch_size=train_bootstrap.FIT_BATCH_SIZE,
+          epochs=1, shuffle=True, verbose=0)
+      result = metrics(name, model.predict(test_features, batch_size=1000, verbose=0),
+          test_labels, variant)
+      print('[%s] %s epoch %d: %s' % (name, variant, epoch, ', '.join(
+          '%s %.4f' % item for item in result.items())))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Compare the logit-based losses with the previous ones.')
+  parser.add_argument('--input', required=True,
+      help='CSV file, frame CSV file or shard directory to sample examples from.');
+  parser.add_argument('--thrower_input',
+      help='Input for the thrower model, if different from --input.');
+  parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS),
+      help='Models to compare the losses of');
+  parser.add_argument('--sample_size', default=20000, type=int,
+      help='Number of examples to sample, a fifth of which are held out');
+  parser.add_argument('--epochs', default=5, type=int, help='Number of epochs to train');
+  parser.add_argument('--repeats', default=200, type=int,
+      help='Number of steps to average times over');
+  parser.add_argument('--seed', default=0, type=int, help='Seed for the initial weights');
+  parser.add_argument('--jit_compile', default=False, action='store_true',
+      help='Compile train steps with XLA.');
+  flags = parser.parse_args()
+
+  for name in flags.models:
+    filename = flags.thrower_input if name == 'thrower' and flags.thrower_input \
+        else flags.input
+    compare(name, filename)
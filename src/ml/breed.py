@@ -0,0 +1,326 @@
+import argparse
+import json
+import multiprocessing
+import os
+import shutil
+import time
+import numpy as np
+
+# Breeds many new models at once from a population of cutter and thrower models
+# in the tfjs graph model format, the same way as DoubleModelPopulation.breed
+# breeds one at a time:
+#
+# - Parents are chosen by their expected reward in the reward file, with weight
+#   exp(reward / REWARD_FACTOR), as Population.chooseGoodModel.
+# - With SEX_PROBABILITY, an offspring has two compatible parents, and each of
+#   its trainable weight tensors is crossed over between them along a random
+#   axis with CROSSOVER_PROBABILITY, or else inherited whole from either one, as
+#   sexAndNoise. Otherwise it is a copy of one parent, as applyNoise.
+# - Truncated normal noise is added to every trainable weight tensor.
+#
+# The weights of all compatible parents are stacked into one array per tensor,
+# so that each step is a few NumPy operations over a whole chunk of offspring.
+# Chunks are bred and written by a pool of processes, in the layout that
+# DoubleModelPopulation.loadModel reads, and added to the reward file with no
+# reward yet, as registerNewModel does.
+
+# Same as tensor_utils.js: the last part of the names of the dense and conv1d
+# weights, in models exported from Python.
+TRAINABLE = ['ReadVariableOp', 'ExpandDims_1']
+# Same as tensor_utils.js and population.js.
+CROSSOVER_PROBABILITY = 0.1
+SEX_PROBABILITY = 0.8
+REWARD_FACTOR = 50
+NOISE_STD_DEV = 0.1
+# Same as double_model_population.js and local_double_model_population.js.
+MODEL_FILES = {'cutter': 'cutter/model.json', 'thrower': 'thrower/model.json'}
+GENERATED_MODELS_PREFIX = 'generated/model-'
+# Same as the file tfjs-node writes weights to.
+WEIGHTS_FILE = 'weights.bin'
+DTYPES = {'float32': np.float32, 'int32': np.int32, 'bool': np.bool_}
+
+# Returns the model.json of a tfjs graph model without its weights manifest,
+# the manifest entry of each weight, and the weights, in manifest order.
+def read_model(filename):
+  with open(filename) as f:
+    spec = json.load(f)
+  entries, weights = [], []
+  for group in spec.pop('weightsManifest'):
+    buffer = b''.join(
+        open(os.path.join(os.path.dirname(filename), path), 'rb').read()
+        for path in group['paths'])
+    offset = 0
+    for entry in group['weights']:
+      if 'quantization' in entry or entry['dtype'] not in DTYPES:
+        raise ValueError('%s: %s weights are not supported (%s)' %
+            (filename, 'quantized' if 'quantization' in entry else entry['dtype'],
+            entry['name']))
+      dtype = np.dtype(DTYPES[entry['dtype']]).newbyteorder('<')
+      size = int(np.prod(entry['shape'], dtype=np.int64))
+      weights.append(
+          np.frombuffer(buffer, dtype, size, offset).reshape(entry['shape']))
+      entries.append({k: entry[k] for k in ['name', 'shape', 'dtype']})
+      offset += size * dtype.itemsize
+  return spec, entries, weights
+
+# Writes a tfjs graph model to 'filename', with all weights in one file.
+def write_model(filename, spec, entries, weights):
+  directory = os.path.dirname(filename)
+  os.makedirs(directory, exist_ok=True)
+  with open(os.path.join(directory, WEIGHTS_FILE), 'wb') as f:
+    for entry, weight in zip(entries, weights):
+      f.write(np.ascontiguousarray(
+          weight, np.dtype(DTYPES[entry['dtype']]).newbyteorder('<')).tobytes())
+  model = dict(spec)
+  model['weightsManifest'] = [{'paths': [WEIGHTS_FILE], 'weights': entries}]
+  with open(filename, 'w') as f:
+    json.dump(model, f)
+
+def is_trainable(name):
+  return name.split('/')[-1] in TRAINABLE
+
+# Models can only be crossed over with models with the same weights, see
+# areCompatible in tensor_utils.js.
+def signature(entries):
+  return tuple((e['name'], tuple(e['shape']), e['dtype']) for e in entries)
+
+# Cutter and thrower models of compatible parents, with the weights of each
+# tensor stacked over parents.
+class Parents:
+  def __init__(self, keys, models):
+    self.keys = keys
+    self.specs = {}
+    self.entries = {}
+    self.stacked = {}
+    for role in MODEL_FILES:
+      spec, entries, weights = models[0][role]
+      self.specs[role] = spec
+      self.entries[role] = entries
+      self.stacked[role] = [
+          np.stack([model[role][2][i] for model in models])
+          for i in range(len(entries))
+      ]
+
+def truncated_normal(rng, shape, std_dev):
+  values = rng.standard_normal(shape)
+  # Same as tf.truncatedNormal: values more than 2 standard deviations from the
+  # mean are drawn again.
+  redraw = np.abs(values) > 2
+  while redraw.any():
+    values[redraw] = rng.standard_normal(np.count_nonzero(redraw))
+    redraw = np.abs(values) > 2
+  return values * std_dev
+
+# Returns the offspring of the pairs of parents 'first' and 'second' for one
+# stacked weight tensor, with shape [offspring, ...]. For a copy of one parent,
+# both are the same.
+def offspring_weights(rng, stacked, first, second, std_dev, crossover_probability):
+  a, b = stacked[first], stacked[second]
+  count, shape = len(first), stacked.shape[1:]
+  broadcast = (-1,) + (1,) * len(shape)
+  # Without crossover, inherit from either parent. With crossover, take one of
+  # the two recombinations, which is the same as swapping the parents first.
+  swap = (rng.uniform(size=count) < 0.5).reshape(broadcast)
+  x, y = np.where(swap, b, a), np.where(swap, a, b)
+  crossover = rng.uniform(size=count) < crossover_probability
+  # Longer axes are more likely to be split along, axes of length 1 never.
+  axis_weights = np.array(shape, dtype=np.float64) - 1
+  if crossover.any() and axis_weights.sum() > 0:
+    axes = rng.choice(len(shape), size=count, p=axis_weights / axis_weights.sum())
+    lengths = np.array(shape)[axes]
+    # Split sizes are from 1 to the length of the axis, exclusive.
+    splits = 1 + np.floor(rng.uniform(size=count) * (lengths - 1)).astype(np.int64)
+    from_y = np.zeros(a.shape, dtype=bool)
+    for axis in range(len(shape)):
+      rows = crossover & (axes == axis)
+      if rows.any():
+        positions = np.arange(shape[axis]).reshape(
+            (1,) + (1,) * axis + (-1,) + (1,) * (len(shape) - axis - 1))
+        from_y[rows] = positions >= splits[rows].reshape(broadcast)
+    x = np.where(from_y, y, x)
+  return x + truncated_normal(rng, x.shape, std_dev).astype(x.dtype)
+
+# Set in each worker process by init_worker.
+parent_groups = None
+
+def init_worker(groups):
+  global parent_groups
+  parent_groups = groups
+
+# Breeds and writes one chunk of offspring of the same group of parents.
+def breed_chunk(args):
+  group, seed, chunk, first, second, keys, population_dir, std_dev, \
+      crossover_probability = args
+  parents = parent_groups[group]
+  rng = np.random.default_rng([seed, chunk])
+  offspring = [{} for key in keys]
+  for role in MODEL_FILES:
+    weights = []
+    for entry, stacked in zip(parents.entries[role], parents.stacked[role]):
+      if is_trainable(entry['name']):
+        weights.append(offspring_weights(
+            rng, stacked, first, second, std_dev, crossover_probability))
+      else:
+        # Other weights are kept from the first parent, as the offspring starts
+        # out as a copy of it.
+        weights.append(stacked[first])
+    for i in range(len(keys)):
+      offspring[i][role] = [w[i] for w in weights]
+  for key, model in zip(keys, offspring):
+    # Written under a temporary name, then moved into place, so that a model
+    # directory is never left partially written.
+    directory = os.path.join(population_dir, key)
+    temporary = directory + '.tmp'
+    shutil.rmtree(temporary, ignore_errors=True)
+    for role, filename in MODEL_FILES.items():
+      write_model(os.path.join(temporary, filename), parents.specs[role],
+          parents.entries[role], model[role])
+    os.replace(temporary, directory)
+  return len(keys)
+
+# Returns the expected reward and reward weight of each model in the reward
+# file, which evolve.js saves as [[[key, reward], ...], [[key, weight], ...]].
+def load_rewards(filename):
+  if not filename or not os.path.exists(filename):
+    return {}, {}
+  with open(filename) as f:
+    rewards, weights = json.load(f)
+  return dict(rewards), dict(weights)
+
+def save_rewards(filename, rewards, weights):
+  with open(filename + '.tmp', 'w') as f:
+    json.dump([list(rewards.items()), list(weights.items())], f)
+  os.replace(filename + '.tmp', filename)
+
+def find_models(population_dir):
+  keys = []
+  for root, dirs, files in os.walk(population_dir):
+    if all(os.path.exists(os.path.join(root, f)) for f in MODEL_FILES.values()):
+      keys.append(os.path.relpath(root, population_dir))
+      dirs.clear()
+  return sorted(keys)
+
+# Same as LocalDoubleModelPopulation.generateModelKey, for 'count' models.
+def new_model_keys(population_dir, count):
+  keys = []
+  i = 0
+  while len(keys) < count:
+    key = GENERATED_MODELS_PREFIX + str(i)
+    if not os.path.exists(os.path.join(population_dir, key)):
+      keys.append(key)
+    i += 1
+  return keys
+
+# Groups parents which can be crossed over with each other.
+def load_parents(population_dir, keys):
+  groups = {}
+  for key in keys:
+    model = {
+        role: read_model(os.path.join(population_dir, key, filename))
+        for role, filename in MODEL_FILES.items()
+    }
+    group = tuple(signature(model[role][1]) for role in MODEL_FILES)
+    groups.setdefault(group, ([], []))
+    groups[group][0].append(key)
+    groups[group][1].append(model)
+  return [Parents(keys, models) for keys, models in groups.values()]
+
+# Returns the group, first parent and second parent of each offspring, with
+# parents as indices within their group. The second parent is chosen from the
+# same group as the first, and is the same for a copy of one parent.
+def choose_parents(rng, groups, rewards, count, sex_probability):
+  keys = [key for parents in groups for key in parents.keys]
+  group_of = np.concatenate([np.full(len(p.keys), g) for g, p in enumerate(groups)])
+  index_in_group = np.concatenate([np.arange(len(p.keys)) for p in groups])
+  scores = np.array([rewards.get(key) or 0.0 for key in keys]) / REWARD_FACTOR
+  # Same as exp(reward / REWARD_FACTOR), normalized without overflowing.
+  weights = np.exp(scores - scores.max())
+  first = rng.choice(len(keys), size=count, p=weights / weights.sum())
+  second = first.copy()
+  sexual = rng.uniform(size=count) < sex_probability
+  for g in range(len(groups)):
+    rows = sexual & (group_of[first] == g)
+    members = np.flatnonzero(group_of == g)
+    # Normalized again within the group, where all weights may be tiny.
+    member_weights = np.exp(scores[members] - scores[members].max())
+    second[rows] = rng.choice(members, size=np.count_nonzero(rows),
+        p=member_weights / member_weights.sum())
+  return group_of[first], index_in_group[first], index_in_group[second]
+
+def breed(population_dir, parent_keys, count, reward_file, seed, workers, chunk_size,
+    sex_probability, std_dev, crossover_probability):
+  rewards, reward_weights = load_rewards(reward_file)
+  parent_keys = parent_keys or list(rewards) or find_models(population_dir)
+  if not parent_keys:
+    raise ValueError('No models found in %s' % population_dir)
+  start = time.perf_counter()
+  groups = load_parents(population_dir, parent_keys)
+  print('Loaded %d parents in %d compatible groups in %.1fs' %
+      (len(parent_keys), len(groups), time.perf_counter() - start))
+
+  rng = np.random.default_rng(seed)
+  group, first, second = choose_parents(rng, groups, rewards, count, sex_probability)
+  keys = np.array(new_model_keys(population_dir, count), dtype=object)
+  tasks = []
+  for g in range(len(groups)):
+    rows = np.flatnonzero(group == g)
+    for i in range(0, len(rows), chunk_size):
+      chunk = rows[i:i + chunk_size]
+      tasks.append((g, seed, len(tasks), first[chunk], second[chunk],
+          list(keys[chunk]), population_dir, std_dev, crossover_probability))
+
+  start = time.perf_counter()
+  written = 0
+  with multiprocessing.Pool(workers, initializer=init_worker, initargs=(groups,)) as pool:
+    for chunk_count in pool.imap_unordered(breed_chunk, tasks):
+      written += chunk_count
+  elapsed = time.perf_counter() - start
+  print('Wrote %d offspring (%d from two parents) in %.1fs (%.0f offspring/sec)' %
+      (written, np.count_nonzero(first != second), elapsed, written / elapsed))
+
+  if reward_file:
+    for key in keys:
+      rewards[key] = 0
+      reward_weights[key] = 0
+    save_rewards(reward_file, rewards, reward_weights)
+    print('Added offspring to %s' % reward_file)
+  return list(keys)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Breed many new cutter and thrower models from a population at once.')
+  parser.add_argument('--population_dir', required=True,
+      help='Directory of the population, the same as for evolve.js.');
+  parser.add_argument('--parents', nargs='*', default=[],
+      help='Models to breed from, relative to --population_dir. Defaults to all ' +
+      'models in the reward file, or all models in the population if there is none.');
+  parser.add_argument('--offspring', default=100, type=int,
+      help='Number of new models to breed');
+  parser.add_argument('--reward_file', default='rewards.json',
+      help='Reward file in --population_dir to choose parents by, and to add ' +
+      'offspring to. Empty to choose parents uniformly and leave it as it is.');
+  parser.add_argument('--sex_probability', default=SEX_PROBABILITY, type=float,
+      help='Probability that an offspring has two parents');
+  parser.add_argument('--crossover_probability', default=CROSSOVER_PROBABILITY, type=float,
+      help='Probability that a weight tensor of an offspring of two parents is ' +
+      'crossed over, rather than inherited whole from either one');
+  parser.add_argument('--std_dev', default=NOISE_STD_DEV, type=float,
+      help='Standard deviation of the noise added to trainable weights');
+  parser.add_argument('--seed', type=int, help='Random seed, for reproducible offspring');
+  parser.add_argument('--workers', type=int, help='Number of worker processes');
+  parser.add_argument('--chunk_size', default=16, type=int,
+      help='Number of offspring bred and written per task');
+  flags = parser.parse_args()
+  if flags.seed is None:
+    flags.seed = np.random.SeedSequence().entropy
+  breed(
+      flags.population_dir,
+      flags.parents,
+      flags.offspring,
+      os.path.join(flags.population_dir, flags.reward_file) if flags.reward_file else None,
+      flags.seed,
+      flags.workers,
+      flags.chunk_size,
+      flags.sex_probability,
+      flags.std_dev,
+      flags.crossover_probability)
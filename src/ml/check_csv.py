@@ -1,32 +1,148 @@
 import argparse
+import collections
+import math
+import multiprocessing
+import os
+import shutil
 
-def check(file):
-  columns = None
-  if flags.remove:
-    with open(file, 'r') as f:
-      lines = f.readlines()
-    with open(file, 'w') as f:
-      for lineNumber, line in enumerate(lines):
-        currentColumns = line.count(',') + 1
-        columns = columns or currentColumns
-        mismatch = columns != currentColumns
-        if mismatch:
-          print('[%d] Expected %d but found %d columns' % (lineNumber, columns, currentColumns))
-        else:
-          f.write(line)
-  else:
-    with open(file, 'r') as f:
-      lines = f.readlines()
-      for lineNumber, line in enumerate(lines):
-        currentColumns = line.count(',') + 1
-        columns = columns or currentColumns
-        mismatch = columns != currentColumns
-        if mismatch:
-          print('[%d] Expected %d but found %d columns' % (lineNumber, columns, currentColumns))
+from schema import ACTION_VALUES, STATE_VALUES, DEFAULTS_MAP, is_required
+
+# Validates an example or frame CSV in parallel chunks, without loading it into
+# memory, and optionally writes a copy with the broken rows removed.
+
+# Enum columns are identified by the last part of their name, the same way as
+# getLastPart in frame_tensor.js.
+ENUM_VALUES = {
+    'state': STATE_VALUES,
+    'action': ACTION_VALUES,
+}
+MAX_EXAMPLES = 5
+
+def enum_values(column):
+  return ENUM_VALUES.get(column.split('_')[-1])
+
+# Returns the type of error in a row, and details, or None if the row is valid.
+def check_row(fields, header, required, enums):
+  if len(fields) != len(header):
+    return 'Wrong number of columns', \
+        'Expected %d but found %d columns' % (len(header), len(fields))
+  for i, field in enumerate(fields):
+    if not field:
+      if i in required:
+        return 'Missing required value', 'Missing %s' % header[i]
+      continue
+    try:
+      value = float(field)
+    except ValueError:
+      return 'Non-numeric value', 'Found %r in %s' % (field, header[i])
+    if not math.isfinite(value):
+      return 'Non-finite value', 'Found %r in %s' % (field, header[i])
+    if i in enums and (value != int(value) or not 0 <= value < enums[i]):
+      return 'Enum value out of range', 'Found %r in %s' % (field, header[i])
+  return None
+
+# Checks all lines which start within [start, end) of the file. Returns the
+# count and a few byte offsets for each type of error, the number of rows
+# checked, and the number of bytes of the lines checked. If 'part' is given,
+# writes all valid lines to it.
+def check_chunk(args):
+  filename, start, end, header, part = args
+  required = set(i for i, c in enumerate(header) if c in DEFAULTS_MAP and is_required(c))
+  enums = {i: len(enum_values(c)) for i, c in enumerate(header) if enum_values(c)}
+  errors = collections.OrderedDict()
+  rows = 0
+  out = open(part, 'wb') if part else None
+  with open(filename, 'rb') as f:
+    if start > 0:
+      # Skip the rest of a line which started in the previous chunk, and only
+      # that: a line starting exactly at 'start' belongs to this chunk.
+      f.seek(start - 1)
+      f.readline()
+    offset = f.tell()
+    first = offset
+    while offset < end:
+      line = f.readline()
+      if not line:
+        break
+      if offset == 0:
+        # Always keep the header.
+        error = None
+      else:
+        rows += 1
+        error = check_row(
+            line.rstrip(b'\r\n').decode('utf-8', 'replace').split(','),
+            header, required, enums)
+      if error:
+        kind, detail = error
+        count, examples = errors.get(kind, (0, []))
+        if len(examples) < MAX_EXAMPLES:
+          examples.append((offset, detail))
+        errors[kind] = (count + 1, examples)
+      elif out:
+        out.write(line)
+      offset += len(line)
+  if out:
+    out.close()
+  return rows, errors, max(0, offset - first)
+
+def check(file, output=None, workers=None, chunk_size=64 << 20):
+  with open(file, 'r', newline='') as f:
+    header = f.readline().rstrip('\r\n').split(',')
+  size = os.path.getsize(file)
+  starts = list(range(0, size, chunk_size)) or [0]
+  parts = ['%s.part%05d' % (output, i) for i in range(len(starts))] if output \
+      else [None] * len(starts)
+  tasks = [
+      (file, start, min(start + chunk_size, size), header, part)
+      for start, part in zip(starts, parts)
+  ]
+
+  rows = 0
+  checked = 0
+  errors = collections.OrderedDict()
+  with multiprocessing.Pool(workers) as pool:
+    for chunk_rows, chunk_errors, chunk_bytes in pool.imap(check_chunk, tasks):
+      rows += chunk_rows
+      checked += chunk_bytes
+      for error, (count, examples) in chunk_errors.items():
+        total, all_examples = errors.get(error, (0, []))
+        errors[error] = (total + count, (all_examples + examples)[:MAX_EXAMPLES])
+
+  # Every line must be checked by exactly one chunk, whatever the chunk size,
+  # or rows would be dropped from the cleaned copy.
+  if checked != size:
+    for part in parts:
+      if part and os.path.exists(part):
+        os.remove(part)
+    raise RuntimeError('Checked %d of %d bytes of %s' % (checked, size, file))
+
+  if output:
+    # Write the cleaned copy under a temporary name, then move it into place,
+    # so that 'output' is never left partially written.
+    with open(output + '.tmp', 'wb') as out:
+      for part in parts:
+        with open(part, 'rb') as f:
+          shutil.copyfileobj(f, out)
+        os.remove(part)
+    os.replace(output + '.tmp', output)
+
+  broken = sum(count for count, examples in errors.values())
+  print('Checked %d rows of %s: %d broken' % (rows, file, broken))
+  for error, (count, examples) in errors.items():
+    print('  %s: %d rows' % (error, count))
+    for offset, detail in examples:
+      print('    [byte %d] %s' % (offset, detail))
+  return broken
 
 if __name__ == '__main__':
-  parser = argparse.ArgumentParser(description='Train a bootstrap model.')
+  parser = argparse.ArgumentParser(description='Check an example CSV for broken rows.')
   parser.add_argument('--file', required=True, help='File to check');
-  parser.add_argument('--remove', default=False, help='Delete broken rows');
+  parser.add_argument('--remove', nargs='?', const=True, default=False,
+      help='Delete broken rows from the file');
+  parser.add_argument('--output', help='Write a copy of the file without broken rows');
+  parser.add_argument('--workers', type=int, help='Number of worker processes');
+  parser.add_argument('--chunk_size', default=64 << 20, type=int,
+      help='Bytes of the file to check per task');
   flags = parser.parse_args()
-  check(flags.file)
+  check(flags.file, flags.file if flags.remove else flags.output, flags.workers,
+      flags.chunk_size)
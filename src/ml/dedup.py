@@ -0,0 +1,154 @@
+import argparse
+import time
+import numpy as np
+import tensorflow as tf
+
+import inputs
+
+# Drops near-duplicate examples from a stream of batches. Games are recorded
+# every tick, but DoubleModelStrategy only decides every INFERENCE_STEP ticks and
+# replays the same action in between, so consecutive rows for the same player
+# often differ by a few centimetres of position. Each example is quantized to a
+# grid of 'precision' in every float column, hashed, and dropped if an example
+# with the same hash was seen within the last 'window' examples.
+#
+# Example CSVs hold all the ticks of one player's perspective in a row, and
+# expanded frame files all the perspectives of one tick, so near-duplicates are
+# close together, but only before shuffling: the input must be read in file
+# order, and the kept examples are shuffled afterwards.
+
+DEFAULT_PRECISION = 0.1
+DEFAULT_WINDOW = 1000
+# Fixed, so that the same examples are dropped on every run.
+HASH_SEED = 0
+# Quantized value of empty optional columns, which frame files decode as NaN.
+# Far outside any quantized value, and the same on every platform, unlike a
+# cast of NaN to an integer.
+NAN_SENTINEL = -float(1 << 62)
+
+class Deduplicator:
+  def __init__(self, precision=DEFAULT_PRECISION, window=DEFAULT_WINDOW):
+    self.precision = precision
+    self.window = window
+    self.coefficients = {}
+    # Totals over all passes over the input.
+    self.rows = 0
+    self.kept = 0
+    self.reset()
+
+  # Starts a new pass over the input.
+  def reset(self):
+    self.position = 0
+    self.hashes = np.zeros(0, dtype=np.uint64)
+    self.positions = np.zeros(0, dtype=np.int64)
+
+  # Returns a 64-bit hash of each example in a batch, as a dict of numpy arrays,
+  # with float columns quantized to 'precision', and NaN values replaced with
+  # NAN_SENTINEL.
+  def hash(self, data):
+    if len(self.coefficients) != len(data):
+      # Random odd multipliers, one per column.
+      rng = np.random.default_rng(HASH_SEED)
+      self.coefficients = {
+          c: rng.integers(0, 1 << 63, dtype=np.uint64) * np.uint64(2) + np.uint64(1)
+          for c in sorted(data)
+      }
+    hashes = np.zeros(len(next(iter(data.values()))), dtype=np.uint64)
+    with np.errstate(over='ignore'):
+      for c, values in data.items():
+        if np.issubdtype(values.dtype, np.floating):
+          values = np.round(values / self.precision)
+          values = np.where(np.isnan(values), NAN_SENTINEL, values)
+        hashes += values.astype(np.int64).astype(np.uint64) * self.coefficients[c]
+    return hashes
+
+  # Returns which examples of a batch to keep: those whose hash was not seen in
+  # the last 'window' examples, including the earlier ones in the same batch.
+  def keep(self, data):
+    hashes = self.hash(data)
+    positions = self.position + np.arange(len(hashes), dtype=np.int64)
+    all_hashes = np.concatenate([self.hashes, hashes])
+    all_positions = np.concatenate([self.positions, positions])
+    # A stable sort keeps equal hashes in order, so the previous occurrence of
+    # each one is just before it.
+    order = np.argsort(all_hashes, kind='stable')
+    sorted_hashes = all_hashes[order]
+    previous = np.full(len(all_hashes), np.iinfo(np.int64).min // 2)
+    repeated = sorted_hashes[1:] == sorted_hashes[:-1]
+    previous[order[1:][repeated]] = all_positions[order[:-1][repeated]]
+    keep = positions - previous[len(self.hashes):] > self.window
+
+    self.position += len(hashes)
+    start = np.searchsorted(all_positions, self.position - self.window)
+    self.hashes = all_hashes[start:]
+    self.positions = all_positions[start:]
+    self.rows += len(keep)
+    self.kept += int(np.count_nonzero(keep))
+    return keep
+
+  def summary(self):
+    return 'kept %d of %d examples (%.1f%%)' % (
+        self.kept, self.rows, 100 * self.kept / self.rows if self.rows else 0)
+
+  # Returns a dataset of batches of 'batch_size' deduplicated examples from
+  # 'dataset', a dataset of dicts in the same format as make_csv_dataset, read in
+  # file order. With 'shuffle_buffer_size', the kept examples are shuffled
+  # through a buffer of that many examples.
+  def dataset(self, dataset, batch_size, shuffle_buffer_size=1, seed=None):
+    spec = dataset.element_spec
+
+    def generate():
+      self.reset()
+      rng = np.random.default_rng(seed)
+      buffer = {c: np.zeros(0, dtype=s.dtype.as_numpy_dtype) for c, s in spec.items()}
+      buffered = 0
+      for data in dataset.as_numpy_iterator():
+        keep = self.keep(data)
+        buffer = {c: np.concatenate([buffer[c], data[c][keep]]) for c in buffer}
+        buffered += np.count_nonzero(keep)
+        while buffered >= batch_size + max(0, shuffle_buffer_size - 1):
+          if shuffle_buffer_size > 1:
+            rows = rng.choice(buffered, batch_size, replace=False)
+            rest = np.ones(buffered, dtype=bool)
+            rest[rows] = False
+            yield {c: values[rows] for c, values in buffer.items()}
+            buffer = {c: values[rest] for c, values in buffer.items()}
+          else:
+            yield {c: values[:batch_size] for c, values in buffer.items()}
+            buffer = {c: values[batch_size:] for c, values in buffer.items()}
+          buffered -= batch_size
+      order = rng.permutation(buffered) if shuffle_buffer_size > 1 else np.arange(buffered)
+      for start in range(0, buffered, batch_size):
+        rows = order[start:start + batch_size]
+        yield {c: values[rows] for c, values in buffer.items()}
+
+    return tf.data.Dataset.from_generator(
+        generate,
+        output_signature={
+            c: tf.TensorSpec((None,), s.dtype) for c, s in spec.items()
+        })
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Report how many examples of an input are kept by deduplication.')
+  parser.add_argument('--input', required=True,
+      help='CSV file, frame CSV file or shard directory to read examples from.');
+  parser.add_argument('--dedup_precision', default=DEFAULT_PRECISION, type=float,
+      help='Grid size float columns are quantized to');
+  parser.add_argument('--dedup_windows', default=[DEFAULT_WINDOW], nargs='+', type=int,
+      help='Numbers of preceding examples to look for duplicates in');
+  parser.add_argument('--tick_stride', default=1, type=int,
+      help='Only read every Nth row of CSV files');
+  parser.add_argument('--has_disc', type=int, choices=[0, 1],
+      help='Only keep examples of frame files where team_0_player_0_hasDisc matches.');
+  flags = parser.parse_args()
+
+  deduplicators = [Deduplicator(flags.dedup_precision, w) for w in flags.dedup_windows]
+  start = time.perf_counter()
+  for data in inputs.example_dataset(flags.input, 10000, shuffle_buffer_size=1,
+      has_disc=flags.has_disc, row_stride=flags.tick_stride).as_numpy_iterator():
+    for deduplicator in deduplicators:
+      deduplicator.keep(data)
+  for deduplicator in deduplicators:
+    print('window %d: %s' % (deduplicator.window, deduplicator.summary()))
+  print('Read in %.1fs' % (time.perf_counter() - start))
@@ -0,0 +1,175 @@
+import argparse
+import csv
+import json
+import os
+import numpy as np
+import tensorflow as tf
+
+from schema import DEFAULTS_MAP, SELECTED_COLUMNS, column_type, is_required
+
+# Converts example CSVs into a directory of fixed-width binary shards, and reads
+# them back as batches in the same format as make_csv_dataset.
+#
+# Layout of a shard directory:
+#   schema.json                 Columns, defaults and list of shards
+#   shard-00000.ints.npy        int32 [rows, len(int_columns)]
+#   shard-00000.floats.npy      float32 [rows, len(float_columns)]
+#
+# Shards are plain .npy files, so they can be memory-mapped and sliced without
+# copying.
+
+SCHEMA_FILE = 'schema.json'
+SHARD_FORMAT = 'shard-%05d'
+TF_TYPES = {int: tf.int32, float: tf.float32}
+
+def is_shard_directory(path):
+  return os.path.isfile(os.path.join(path, SCHEMA_FILE))
+
+def load_schema(directory):
+  with open(os.path.join(directory, SCHEMA_FILE), 'r') as f:
+    return json.load(f)
+
+def write_schema(directory, schema):
+  # Write to a temporary file first, so readers never see a partial schema.
+  path = os.path.join(directory, SCHEMA_FILE)
+  with open(path + '.tmp', 'w') as f:
+    json.dump(schema, f, indent=2)
+  os.replace(path + '.tmp', path)
+
+def new_schema(columns):
+  return {
+      'int_columns': [c for c in columns if column_type(c) is int],
+      'float_columns': [c for c in columns if column_type(c) is float],
+      'defaults': {
+          c: column_type(c).__name__ if is_required(c) else DEFAULTS_MAP[c]
+          for c in columns
+      },
+      'shards': [],
+  }
+
+def write_shard(directory, schema, ints, floats):
+  name = SHARD_FORMAT % len(schema['shards'])
+  np.save(os.path.join(directory, name + '.ints.npy'),
+      np.concatenate(ints).astype(np.int32))
+  np.save(os.path.join(directory, name + '.floats.npy'),
+      np.concatenate(floats).astype(np.float32))
+  schema['shards'].append({'name': name, 'rows': sum(len(i) for i in ints)})
+  # Update the schema after every shard, so an interrupted conversion still
+  # leaves a readable directory.
+  write_schema(directory, schema)
+
+# Appends the examples in 'filename' to the shard directory 'directory'.
+def convert(filename, directory, columns=SELECTED_COLUMNS, shard_size=1000000,
+    read_batch_size=10000):
+  with open(filename, 'r', newline='') as f:
+    header = next(csv.reader(f))
+  missing = [c for c in columns if c not in header]
+  if missing:
+    raise ValueError('%s is missing columns: %s' % (filename, missing))
+
+  os.makedirs(directory, exist_ok=True)
+  schema = new_schema(columns)
+  if is_shard_directory(directory):
+    existing = load_schema(directory)
+    if existing['int_columns'] != schema['int_columns'] \
+        or existing['float_columns'] != schema['float_columns']:
+      raise ValueError('Schema of %s does not match %s' % (directory, filename))
+    schema = existing
+
+  # CsvDataset requires selected columns in file order.
+  file_columns = sorted(columns, key=header.index)
+  record_defaults = [
+      TF_TYPES[column_type(c)] if is_required(c) else DEFAULTS_MAP[c]
+      for c in file_columns
+  ]
+  dataset = tf.data.experimental.CsvDataset(
+      filename,
+      record_defaults,
+      header=True,
+      select_cols=sorted(header.index(c) for c in columns)) \
+      .batch(min(read_batch_size, shard_size)) \
+      .prefetch(tf.data.experimental.AUTOTUNE)
+  int_indices = [file_columns.index(c) for c in schema['int_columns']]
+  float_indices = [file_columns.index(c) for c in schema['float_columns']]
+
+  ints, floats, rows = [], [], 0
+  total_rows = 0
+  for batch in dataset:
+    batch = [t.numpy() for t in batch]
+    ints.append(np.stack([batch[i] for i in int_indices], axis=1))
+    floats.append(np.stack([batch[i] for i in float_indices], axis=1))
+    rows += len(ints[-1])
+    if rows >= shard_size:
+      write_shard(directory, schema, ints, floats)
+      total_rows += rows
+      ints, floats, rows = [], [], 0
+  if rows:
+    write_shard(directory, schema, ints, floats)
+    total_rows += rows
+  return total_rows
+
+def open_shards(directory):
+  schema = load_schema(directory)
+  shards = []
+  for shard in schema['shards']:
+    path = os.path.join(directory, shard['name'])
+    shards.append((
+        np.load(path + '.ints.npy', mmap_mode='r'),
+        np.load(path + '.floats.npy', mmap_mode='r')))
+  return schema, shards
+
+# Returns a dataset of batches read from a shard directory, in the same format
+# as make_csv_dataset: a dict mapping each column to a tensor of shape [batch].
+# Without shuffling, batches are zero-copy slices of the memory-mapped shards.
+# With 'num_shards', only reads every num_shards-th shard file starting from
+# 'shard_index', so that each training worker reads different files.
+def shard_dataset(directory, batch_size, columns=SELECTED_COLUMNS, shuffle=True,
+    num_epochs=1, seed=None, num_shards=1, shard_index=0):
+  schema, shards = open_shards(directory)
+  shards = shards[shard_index::num_shards]
+  if not shards:
+    raise ValueError('%s has fewer than %d shards' % (directory, num_shards))
+  int_columns, float_columns = schema['int_columns'], schema['float_columns']
+  missing = [c for c in columns if c not in int_columns + float_columns]
+  if missing:
+    raise ValueError('%s is missing columns: %s' % (directory, missing))
+
+  def generate():
+    rng = np.random.default_rng(seed)
+    epoch = 0
+    while num_epochs is None or epoch < num_epochs:
+      epoch += 1
+      order = rng.permutation(len(shards)) if shuffle else range(len(shards))
+      for s in order:
+        ints, floats = shards[s]
+        if shuffle:
+          indices = rng.permutation(len(ints))
+        for start in range(0, len(ints), batch_size):
+          if shuffle:
+            # Sorted indices keep reads from the memory map sequential.
+            rows = np.sort(indices[start:start + batch_size])
+            yield ints[rows], floats[rows]
+          else:
+            yield ints[start:start + batch_size], floats[start:start + batch_size]
+
+  def to_columns(ints, floats):
+    data = dict(zip(int_columns, tf.unstack(ints, len(int_columns), axis=1)))
+    data.update(zip(float_columns, tf.unstack(floats, len(float_columns), axis=1)))
+    return {c: data[c] for c in columns}
+
+  return tf.data.Dataset.from_generator(
+      generate,
+      output_signature=(
+          tf.TensorSpec((None, len(int_columns)), tf.int32),
+          tf.TensorSpec((None, len(float_columns)), tf.float32))) \
+      .map(to_columns, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Convert example CSVs to binary shards.')
+  parser.add_argument('--input', required=True, nargs='+', help='CSV files to convert.')
+  parser.add_argument('--output', required=True, help='Directory to write shards to.')
+  parser.add_argument('--shard_size', default=1000000, type=int, help='Rows per shard');
+  flags = parser.parse_args()
+  for filename in flags.input:
+    rows = convert(filename, flags.output, shard_size=flags.shard_size)
+    print('Converted %d rows from %s' % (rows, filename))
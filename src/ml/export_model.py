@@ -0,0 +1,219 @@
+import argparse
+import os
+import time
+import numpy as np
+import tensorflow as tf
+from tensorflow.core.protobuf import config_pb2, meta_graph_pb2
+from tensorflow.python.framework.convert_to_constants import \
+    convert_variables_to_constants_v2
+from tensorflow.python.grappler import tf_optimizer
+
+import frames
+from schema import MODEL_INPUTS, ONE_HOT_MODEL_INPUTS
+
+# Exports models saved by the trainers for inference in the simulator, which
+# predicts for all 7 players of a team, or all 14 players, at once. Writes:
+#
+# - A SavedModel with a serving signature taking inputs of shape [batch,
+#   RAW_INPUTS] for any batch size, for `npm run convert_model`.
+# - A frozen graph, with variables folded into constants and pruned down to
+#   the ops needed for the output, for tensorflowjs_converter
+#   --input_format=tf_frozen_model.
+#
+# Both are checked against the original model at batch sizes 1, 7 and 14.
+#
+# Cutter and thrower models trained with --model=player_encoder take whole
+# frames instead, and are exported together, with a single serving signature
+# taking frames of shape [batch, len(FRAME_COLUMNS)], in the order of
+# FrameTensor.allKeys(false), with NaN for empty values. It returns the outputs
+# of both models for every player on both teams, of shape [batch, 2, 7,
+# num_outputs], by team and player number.
+
+RAW_INPUTS = sum(len(values) for c, values in ONE_HOT_MODEL_INPUTS.items()) + \
+        len(MODEL_INPUTS) - len(ONE_HOT_MODEL_INPUTS)
+# Same as the output node name in the convert_model npm script.
+OUTPUT_NAME = 'final_result'
+# Output node names of the frame serving signature, by model.
+FRAME_OUTPUT_NAMES = {'cutter': 'cutter_result', 'thrower': 'thrower_result'}
+FROZEN_SUFFIX = '.frozen.pb'
+CHECK_BATCH_SIZES = [1, 7, 14]
+# Grappler passes, as run by tensorflowjs_converter.
+OPTIMIZERS = [
+    'pruning', 'constfold', 'arithmetic', 'dependency', 'pruning', 'remap',
+    'constfold', 'arithmetic', 'dependency',
+]
+
+def serving_function(model):
+  @tf.function(input_signature=[
+      tf.TensorSpec((None, RAW_INPUTS), tf.float32, name='inputs')])
+  def serve(inputs):
+    return {'outputs': tf.identity(model(inputs, training=False), name=OUTPUT_NAME)}
+  return serve
+
+# Returns whether a model takes whole frames, see PlayerEncoderModel in
+# train_double_bootstrap.py.
+def takes_frames(model):
+  return model.save_spec()[0][0].shape[-1] == len(frames.FRAME_COLUMNS)
+
+# Reshapes outputs for each of frames.PERSPECTIVES to [batch, 2, 7,
+# num_outputs].
+def by_player(outputs):
+  return tf.reshape(
+      outputs, (-1, 2, len(frames.PERSPECTIVES) // 2, outputs.shape[-1]))
+
+# Serves the cutter and thrower models of a population member at once, given
+# as a dict by name, for models which take whole frames.
+def frame_serving_function(models):
+  @tf.function(input_signature=[
+      tf.TensorSpec((None, len(frames.FRAME_COLUMNS)), tf.float32, name='frames')])
+  def serve(inputs):
+    return {
+        name: tf.identity(
+            by_player(model(inputs, training=False)), name=FRAME_OUTPUT_NAMES[name])
+        for name, model in models.items()
+    }
+  return serve
+
+# Returns a GraphDef of 'function' with its variables folded into constants,
+# optimized the same way as tensorflowjs_converter does, with the name of its
+# input and the names of 'output_names'.
+def freeze(function, output_names=[OUTPUT_NAME]):
+  frozen = convert_variables_to_constants_v2(function)
+  meta_graph = meta_graph_pb2.MetaGraphDef(graph_def=frozen.graph.as_graph_def())
+  # Grappler keeps the nodes in the 'train_op' collection, and prunes
+  # everything they do not depend on.
+  fetches = meta_graph_pb2.CollectionDef()
+  fetches.node_list.value.extend(output_names)
+  meta_graph.collection_def['train_op'].CopyFrom(fetches)
+  config = config_pb2.ConfigProto()
+  config.graph_options.rewrite_options.optimizers.extend(OPTIMIZERS)
+  return tf_optimizer.OptimizeGraph(config, meta_graph), \
+      frozen.inputs[0].name, [name + ':0' for name in output_names]
+
+def load_frozen(graph_def, input_name, output_name):
+  imported = tf.compat.v1.wrap_function(
+      lambda: tf.compat.v1.import_graph_def(graph_def, name=''), [])
+  return imported.prune(
+      imported.graph.get_tensor_by_name(input_name),
+      imported.graph.get_tensor_by_name(output_name))
+
+# Raises if the outputs of 'exported' for a batch differ from the outputs of
+# 'model' for each example on its own, which is how the simulator used to
+# predict. Examples have 'input_size' random inputs.
+def check(name, variant, model, exported, tolerance, input_size=RAW_INPUTS):
+  rng = np.random.default_rng(0)
+  for batch_size in CHECK_BATCH_SIZES:
+    inputs = rng.normal(size=(batch_size, input_size)).astype(np.float32)
+    expected = np.concatenate(
+        [model(inputs[i:i + 1], training=False).numpy() for i in range(batch_size)])
+    outputs = exported(tf.constant(inputs)).numpy()
+    if outputs.shape != expected.shape:
+      raise ValueError('[%s] %s returned shape %s for a batch of %d, expected %s' %
+          (name, variant, outputs.shape, batch_size, expected.shape))
+    error = np.max(np.abs(outputs - expected) / np.maximum(1.0, np.abs(expected)))
+    print('[%s] %s, batch of %d: max error %.2g' % (name, variant, batch_size, error))
+    if error > tolerance:
+      raise ValueError('[%s] %s differs from the original model by %g' %
+          (name, variant, error))
+
+# Compares one batched call for a team of 7 players with 7 calls of one player.
+def measure(name, variant, exported, repeats=200):
+  inputs = tf.random.normal((7, RAW_INPUTS))
+  players = [inputs[i:i + 1] for i in range(7)]
+  exported(inputs)
+  start = time.time()
+  for i in range(repeats):
+    for player in players:
+      exported(player)
+  single = (time.time() - start) / repeats
+  start = time.time()
+  for i in range(repeats):
+    exported(inputs)
+  batched = (time.time() - start) / repeats
+  print('[%s] %s, 7 players: %.3f ms one at a time, %.3f ms batched' %
+      (name, variant, single * 1000, batched * 1000))
+
+def export(name, model_dir, output_dir, tolerance):
+  model = tf.keras.models.load_model(model_dir, compile=False)
+  serve = serving_function(model)
+
+  tf.saved_model.save(model, output_dir, signatures={'serving_default': serve})
+  signature = tf.saved_model.load(output_dir).signatures['serving_default']
+  saved = lambda inputs: signature(inputs=inputs)['outputs']
+  check(name, 'SavedModel', model, saved, tolerance)
+
+  graph_def, input_name, [output_name] = freeze(serve.get_concrete_function())
+  frozen_path = os.path.normpath(output_dir) + FROZEN_SUFFIX
+  with open(frozen_path, 'wb') as f:
+    f.write(graph_def.SerializeToString())
+  frozen = load_frozen(graph_def, input_name, output_name)
+  check(name, 'frozen graph', model, frozen, tolerance)
+  print('[%s] Wrote %s and %s (%d nodes, output %s)' %
+      (name, output_dir, frozen_path, len(graph_def.node), output_name))
+
+  measure(name, 'SavedModel', saved)
+
+# Times the frame serving signature on one frame, which predicts for all 14
+# players.
+def measure_frames(exported, repeats=200):
+  inputs = tf.random.normal((1, len(frames.FRAME_COLUMNS)))
+  exported(inputs)
+  start = time.time()
+  for i in range(repeats):
+    exported(inputs)
+  print('[frames] SavedModel, 14 players: %.3f ms per frame' %
+      ((time.time() - start) * 1000 / repeats))
+
+# Exports models which take whole frames, given as a dict by name, with a
+# single frame serving signature. Each of their outputs is checked on its own.
+def export_frames(models, output_dir, tolerance):
+  serve = frame_serving_function(models)
+  module = tf.Module()
+  module.models = models
+  tf.saved_model.save(module, output_dir, signatures={'serving_default': serve})
+  signature = tf.saved_model.load(output_dir).signatures['serving_default']
+
+  graph_def, input_name, output_names = freeze(
+      serve.get_concrete_function(), [FRAME_OUTPUT_NAMES[name] for name in models])
+  frozen_path = os.path.normpath(output_dir) + FROZEN_SUFFIX
+  with open(frozen_path, 'wb') as f:
+    f.write(graph_def.SerializeToString())
+  for (name, model), output_name in zip(models.items(), output_names):
+    reshaped = lambda inputs, training=False, model=model: \
+        by_player(model(inputs, training=training))
+    saved = lambda inputs, name=name: signature(frames=inputs)[name]
+    check(name, 'SavedModel', reshaped, saved, tolerance, len(frames.FRAME_COLUMNS))
+    frozen = load_frozen(graph_def, input_name, output_name)
+    check(name, 'frozen graph', reshaped, frozen, tolerance, len(frames.FRAME_COLUMNS))
+  print('[frames] Wrote %s and %s (%d nodes, outputs %s)' %
+      (output_dir, frozen_path, len(graph_def.node), ', '.join(output_names)))
+
+  measure_frames(lambda inputs: signature(frames=inputs))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Export a trained model for batched inference.')
+  parser.add_argument('--model', required=True,
+      help='Model saved by train_bootstrap.py, or directory of cutter and ' +
+      'thrower models saved by train_double_bootstrap.py.');
+  parser.add_argument('--output', required=True, help='Directory to export to.');
+  parser.add_argument('--tolerance', default=1e-5, type=float,
+      help='Maximum relative difference from the original model');
+  flags = parser.parse_args()
+
+  names = [
+      name for name in ['cutter', 'thrower']
+      if os.path.isdir(os.path.join(flags.model, name))
+  ]
+  models = {
+      name: tf.keras.models.load_model(os.path.join(flags.model, name), compile=False)
+      for name in names
+  }
+  if models and all(takes_frames(model) for model in models.values()):
+    export_frames(models, flags.output, flags.tolerance)
+  elif models:
+    for name in names:
+      export(name, os.path.join(flags.model, name),
+          os.path.join(flags.output, name), flags.tolerance)
+  else:
+    export('model', flags.model, flags.output, flags.tolerance)
@@ -0,0 +1,164 @@
+import csv
+import tensorflow as tf
+
+from schema import DEFAULTS_MAP, SELECTED_COLUMNS, column_type
+
+# Reads un-permuted frames, as written by FrameTensor.getCsvData, and expands
+# each frame into the 14 examples that FrameTensor.getPermutedCsvData would have
+# written for it: one from the perspective of each player on the field.
+
+PLAYER_KEYS = ['x', 'y', 'vx', 'vy', 'hasDisc']
+ACTION_KEYS = [
+    'action', 'move_x', 'move_y', 'throw_x', 'throw_y', 'throw_z',
+    'throw_angleOfAttack', 'throw_tiltAngle',
+]
+
+# Same as FrameTensor.allKeys(false)
+FRAME_COLUMNS = [
+    'state', 'offensiveTeam', 'offensiveGoalDirection', 'stallCount',
+    'disc_x', 'disc_y', 'disc_z', 'defensiveTeam',
+] + [
+    column
+    for t in range(2)
+    for p in range(7)
+    for column in
+        ['team_%d_player_%d_%s' % (t, p, k) for k in PLAYER_KEYS + ACTION_KEYS] +
+        ['last_team_%d_player_%d_%s' % (t, p, k) for k in ACTION_KEYS]
+]
+
+PERSPECTIVES = [(t, p) for t in range(2) for p in range(7)]
+
+# Same as FrameTensor.generatePermutations, as a Map<outputKey, rawKey> for the
+# perspective of player p on team t.
+def permutation(t, p):
+  result = {
+      'state': 'state',
+      'stallCount': 'stallCount',
+      'offensiveTeam': 'offensiveTeam' if t == 0 else 'defensiveTeam',
+      'offensiveGoalDirection': 'offensiveGoalDirection',
+      'disc_x': 'disc_x',
+      'disc_y': 'disc_y',
+      'disc_z': 'disc_z',
+  }
+  for k in ACTION_KEYS:
+    result[k] = 'team_%d_player_%d_%s' % (t, p, k)
+    result['last_' + k] = 'last_team_%d_player_%d_%s' % (t, p, k)
+  for k in PLAYER_KEYS:
+    result['team_0_player_0_' + k] = 'team_%d_player_%d_%s' % (t, p, k)
+    for teammate in range(7):
+      if teammate != p:
+        new_index = teammate + 1 if teammate < p else teammate
+        result['team_0_player_%d_%s' % (new_index, k)] = \
+            'team_%d_player_%d_%s' % (t, teammate, k)
+    for opponent in range(7):
+      result['team_1_player_%d_%s' % (opponent, k)] = \
+          'team_%d_player_%d_%s' % (1 - t, opponent, k)
+  return result
+
+# Same as FrameTensor.getOffsetFrame: all x and y columns, except the position
+# of the perspective player, are made relative to that player.
+def is_offset(column, axis):
+  return column.split('_')[-1] == axis and column != 'team_0_player_0_' + axis
+
+FRAME_INDEX = {c: i for i, c in enumerate(FRAME_COLUMNS)}
+PERMUTATION_INDICES = [
+    [FRAME_INDEX[permutation(t, p)[c]] for c in SELECTED_COLUMNS]
+    for t, p in PERSPECTIVES
+]
+ORIGIN_INDICES = [
+    SELECTED_COLUMNS.index('team_0_player_0_x'),
+    SELECTED_COLUMNS.index('team_0_player_0_y'),
+]
+OFFSET_MASK = [
+    [1.0 if is_offset(c, axis) else 0.0 for c in SELECTED_COLUMNS]
+    for axis in ['x', 'y']
+]
+EXAMPLE_DEFAULTS = [
+    0.0 if isinstance(DEFAULTS_MAP[c], type) else float(DEFAULTS_MAP[c])
+    for c in SELECTED_COLUMNS
+]
+HAS_DISC_INDEX = SELECTED_COLUMNS.index('team_0_player_0_hasDisc')
+# Indices of the PLAYER_KEYS of every player in stacked frames, of shape
+# [2, 7, len(PLAYER_KEYS)], by team and player number.
+PLAYER_INDICES = [
+    [[FRAME_INDEX['team_%d_player_%d_%s' % (t, p, k)] for k in PLAYER_KEYS]
+        for p in range(7)]
+    for t in range(2)
+]
+
+# The selected column which each frame column is permuted into.
+SOURCE_COLUMNS = {}
+for t, p in PERSPECTIVES:
+  for column, frame_column in permutation(t, p).items():
+    SOURCE_COLUMNS.setdefault(frame_column, column)
+
+# Optional float columns are decoded as NaN, so that empty values are not offset,
+# and only then replaced with their defaults.
+def frame_default(column):
+  default = DEFAULTS_MAP[SOURCE_COLUMNS[column]]
+  if isinstance(default, type):
+    return tf.int32 if default is int else tf.float32
+  return default if isinstance(default, int) else float('nan')
+
+def read_header(filename):
+  with open(filename, 'r', newline='') as f:
+    return next(csv.reader(f), [])
+
+def is_frame_file(filename):
+  return 'defensiveTeam' in read_header(filename)
+
+# Stacks a batch of frames, as a dict mapping each of FRAME_COLUMNS to a tensor
+# of shape [frames], into a float32 tensor of shape [frames, len(FRAME_COLUMNS)].
+# Empty optional columns are NaN, see frame_default.
+def stack_frames(data):
+  return tf.stack(
+      [tf.cast(data[c], tf.float32) for c in FRAME_COLUMNS], axis = -1)
+
+# Permutes stacked frames, of shape [frames, len(FRAME_COLUMNS)], into a float32
+# tensor of shape [frames, 14, len(SELECTED_COLUMNS)], with the example from the
+# perspective of each of PERSPECTIVES.
+def permute(frames):
+  examples = tf.gather(frames, PERMUTATION_INDICES, axis = 1)
+  origin = tf.gather(examples, ORIGIN_INDICES, axis = 2)
+  examples = examples - tf.matmul(origin, tf.constant(OFFSET_MASK))
+  return tf.where(tf.math.is_nan(examples), tf.constant(EXAMPLE_DEFAULTS), examples)
+
+# Expands a batch of frames, as a dict mapping each of FRAME_COLUMNS to a
+# tensor of shape [frames], into a float32 tensor of shape [frames * 14,
+# len(SELECTED_COLUMNS)].
+def permute_frames(data):
+  return tf.reshape(permute(stack_frames(data)), (-1, len(SELECTED_COLUMNS)))
+
+# Converts a tensor of shape [examples, len(SELECTED_COLUMNS)] into the same
+# format as make_csv_dataset.
+def to_columns(examples):
+  columns = tf.unstack(examples, len(SELECTED_COLUMNS), axis = 1)
+  return {
+      c: tf.cast(v, tf.int32) if column_type(c) is int else v
+      for c, v in zip(SELECTED_COLUMNS, columns)
+  }
+
+# Returns defaults for FRAME_COLUMNS in the order they appear in a frame file,
+# which is how make_csv_dataset matches defaults to selected columns.
+def frame_defaults(filename):
+  header = read_header(filename)
+  missing = [c for c in FRAME_COLUMNS if c not in header]
+  if missing:
+    raise ValueError('%s is missing columns: %s' % (filename, missing))
+  return [frame_default(c) for c in sorted(FRAME_COLUMNS, key = header.index)]
+
+# Expands a dataset of frame batches, as read by make_csv_dataset with
+# FRAME_COLUMNS, into batches of permuted examples in the same format as
+# make_csv_dataset. If 'has_disc' is given, only keeps examples where
+# team_0_player_0_hasDisc matches, as getPermutedCsvData does to split cutter
+# and thrower examples.
+def expand_frames(dataset, batch_size, has_disc=None):
+  dataset = dataset.map(
+      permute_frames, num_parallel_calls = tf.data.experimental.AUTOTUNE)
+  if has_disc is not None:
+    dataset = dataset.map(
+        lambda examples: tf.boolean_mask(
+            examples, tf.equal(examples[:, HAS_DISC_INDEX], has_disc)),
+        num_parallel_calls = tf.data.experimental.AUTOTUNE)
+  return dataset.unbatch().batch(batch_size) \
+      .map(to_columns, num_parallel_calls = tf.data.experimental.AUTOTUNE)
@@ -0,0 +1,373 @@
+import argparse
+import collections
+import json
+import os
+import queue
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import numpy as np
+import tensorflow as tf
+
+import export_model
+
+# Serves predictions for many concurrent games from one process on localhost.
+# Each game posts the raw inputs of the players it needs predictions for, and
+# requests for the same model are gathered into a single batch, waiting at most
+# --latency_budget_ms after the first request of the batch.
+#
+# Models are loaded by directory: either a single model saved by
+# train_bootstrap.py, or a population member saved by train_double_bootstrap.py,
+# with cutter and thrower models. The --max_models most recently used ones are
+# kept loaded.
+#
+# POST /predict {"model": dir, "head": "cutter", "inputs": [[...], ...]}
+#   returns {"outputs": [[...], ...]}. "head" is "cutter" or "thrower" for a
+#   population member, and left out for a single model.
+# GET /stats returns throughput and latency percentiles since the last reset.
+# POST /stats/reset resets them.
+
+SINGLE_HEAD = 'model'
+DOUBLE_HEADS = ['cutter', 'thrower']
+LATENCY_PERCENTILES = [50, 90, 99]
+# Number of most recent requests latency percentiles are computed over.
+LATENCY_WINDOW = 100000
+
+class RequestError(Exception):
+  def __init__(self, status, message):
+    super(RequestError, self).__init__(message)
+    self.status = status
+
+class Closed(Exception):
+  pass
+
+class Stats:
+  def __init__(self):
+    self.lock = threading.Lock()
+    self.reset()
+
+  def reset(self):
+    with self.lock:
+      self.start = time.time()
+      self.requests = 0
+      self.examples = 0
+      self.batches = 0
+      self.batch_time = 0.0
+      self.latencies = collections.deque(maxlen=LATENCY_WINDOW)
+      self.loads = 0
+      self.evictions = 0
+
+  def add_batch(self, num_requests, num_examples, seconds):
+    with self.lock:
+      self.batches += 1
+      self.requests += num_requests
+      self.examples += num_examples
+      self.batch_time += seconds
+
+  def add_latency(self, seconds):
+    with self.lock:
+      self.latencies.append(seconds * 1000)
+
+  def add_load(self, evicted):
+    with self.lock:
+      self.loads += 1
+      self.evictions += evicted
+
+  def snapshot(self):
+    with self.lock:
+      elapsed = time.time() - self.start
+      latencies = np.array(self.latencies)
+      result = {
+          'seconds': elapsed,
+          'requests': self.requests,
+          'examples': self.examples,
+          'batches': self.batches,
+          'requests_per_second': self.requests / elapsed,
+          'examples_per_second': self.examples / elapsed,
+          'mean_batch_size': self.examples / max(1, self.batches),
+          'mean_batch_ms': self.batch_time * 1000 / max(1, self.batches),
+          'model_loads': self.loads,
+          'model_evictions': self.evictions,
+      }
+    for p in LATENCY_PERCENTILES:
+      result['latency_ms_p%d' % p] = \
+          float(np.percentile(latencies, p)) if len(latencies) else None
+    return result
+
+class Request:
+  def __init__(self, inputs):
+    self.inputs = inputs
+    self.outputs = None
+    self.error = None
+    self.done = threading.Event()
+
+# Runs 'predict' on batches of requests from a queue, in a thread of its own.
+class Batcher:
+  def __init__(self, predict, stats, max_batch_size, latency_budget):
+    self.predict_fn = predict
+    self.stats = stats
+    self.max_batch_size = max_batch_size
+    self.latency_budget = latency_budget
+    self.queue = queue.Queue()
+    self.lock = threading.Lock()
+    self.closed = False
+    threading.Thread(target=self.run, daemon=True).start()
+
+  # Blocks until the outputs for 'inputs' are ready. Raises Closed if the model
+  # has been evicted.
+  def predict(self, inputs):
+    request = Request(inputs)
+    with self.lock:
+      if self.closed:
+        raise Closed()
+      self.queue.put(request)
+    request.done.wait()
+    if request.error:
+      raise request.error
+    return request.outputs
+
+  # Requests queued before close are still answered.
+  def close(self):
+    with self.lock:
+      self.closed = True
+      self.queue.put(None)
+
+  def next_batch(self):
+    first = self.queue.get()
+    if first is None:
+      return None
+    batch = [first]
+    size = len(first.inputs)
+    deadline = time.monotonic() + self.latency_budget
+    while size < self.max_batch_size:
+      try:
+        request = self.queue.get(timeout=max(0, deadline - time.monotonic()))
+      except queue.Empty:
+        break
+      if request is None:
+        self.queue.put(None)
+        break
+      batch.append(request)
+      size += len(request.inputs)
+    return batch
+
+  def run(self):
+    while True:
+      batch = self.next_batch()
+      if batch is None:
+        return
+      start = time.time()
+      try:
+        outputs = self.predict_fn(np.concatenate([r.inputs for r in batch]))
+        offsets = np.cumsum([len(r.inputs) for r in batch])[:-1]
+        for request, request_outputs in zip(batch, np.split(outputs, offsets)):
+          request.outputs = request_outputs
+      except Exception as e:
+        for request in batch:
+          request.error = e
+      self.stats.add_batch(len(batch), sum(len(r.inputs) for r in batch),
+          time.time() - start)
+      for request in batch:
+        request.done.set()
+
+def load_heads(directory):
+  heads = [
+      head for head in DOUBLE_HEADS
+      if os.path.isdir(os.path.join(directory, head))
+  ]
+  if heads:
+    return {head: os.path.join(directory, head) for head in heads}
+  return {SINGLE_HEAD: directory}
+
+# A model which is being loaded. Requests for it wait for the load to finish,
+# without holding the lock of Models.
+class Loading:
+  def __init__(self):
+    self.batchers = None
+    self.error = None
+    self.done = threading.Event()
+
+# Keeps the most recently used models loaded, with a Batcher for each of their
+# heads.
+class Models:
+  def __init__(self, stats, max_models, max_batch_size, latency_budget):
+    self.stats = stats
+    self.max_models = max_models
+    self.max_batch_size = max_batch_size
+    self.latency_budget = latency_budget
+    self.lock = threading.Lock()
+    self.members = collections.OrderedDict()
+    # Loading by directory, for models not in 'members' yet.
+    self.loading = {}
+
+  def load(self, directory):
+    batchers = {}
+    try:
+      for head, model_dir in load_heads(directory).items():
+        model = tf.keras.models.load_model(model_dir, compile=False)
+        serve = export_model.serving_function(model)
+        predict = lambda inputs, serve=serve: serve(inputs)['outputs'].numpy()
+        batchers[head] = Batcher(
+            predict, self.stats, self.max_batch_size, self.latency_budget)
+    except Exception:
+      # Stops the batchers of the heads loaded before the one which failed.
+      for batcher in batchers.values():
+        batcher.close()
+      raise
+    return batchers
+
+  # Loads a model outside the lock, so that requests for other models are not
+  # held up, then adds it to 'members', evicting the least recently used ones.
+  def load_member(self, key, directory, loading):
+    try:
+      if not os.path.isdir(key):
+        raise RequestError(404, 'No model in %s' % directory)
+      try:
+        loading.batchers = self.load(key)
+      except OSError as e:
+        raise RequestError(400, 'Cannot load model in %s: %s' % (directory, e))
+    except Exception as e:
+      loading.error = e
+    with self.lock:
+      del self.loading[key]
+      if loading.batchers:
+        self.members[key] = loading.batchers
+        evicted = 0
+        while len(self.members) > self.max_models:
+          for batcher in self.members.popitem(last=False)[1].values():
+            batcher.close()
+          evicted += 1
+        self.stats.add_load(evicted)
+    loading.done.set()
+
+  def batcher(self, directory, head):
+    key = os.path.abspath(directory)
+    with self.lock:
+      batchers = self.members.get(key)
+      loading = None if batchers else self.loading.get(key)
+      # The first request for a model loads it, later ones wait for it.
+      load = not batchers and not loading
+      if load:
+        loading = self.loading[key] = Loading()
+      elif batchers:
+        self.members.move_to_end(key)
+    if load:
+      self.load_member(key, directory, loading)
+    if loading:
+      loading.done.wait()
+      if loading.error:
+        raise loading.error
+      batchers = loading.batchers
+    if head not in batchers:
+      raise RequestError(400, 'Model %s has heads %s, not %s' %
+          (directory, ', '.join(batchers), head))
+    return batchers[head]
+
+  def predict(self, directory, head, inputs):
+    start = time.time()
+    while True:
+      try:
+        outputs = self.batcher(directory, head).predict(inputs)
+        break
+      except Closed:
+        # Evicted between the lookup and the request, load it again.
+        continue
+    self.stats.add_latency(time.time() - start)
+    return outputs
+
+class Handler(BaseHTTPRequestHandler):
+  # Keeps connections open between requests of the same game.
+  protocol_version = 'HTTP/1.1'
+
+  def reply(self, status, body):
+    content = json.dumps(body).encode()
+    self.send_response(status)
+    self.send_header('Content-Type', 'application/json')
+    self.send_header('Content-Length', str(len(content)))
+    self.end_headers()
+    self.wfile.write(content)
+
+  def do_GET(self):
+    if self.path == '/stats':
+      self.reply(200, self.server.stats.snapshot())
+    else:
+      self.reply(404, {'error': 'Not found: %s' % self.path})
+
+  def do_POST(self):
+    length = int(self.headers.get('Content-Length', 0))
+    body = self.rfile.read(length)
+    if self.path == '/stats/reset':
+      self.server.stats.reset()
+      self.reply(200, {})
+      return
+    if self.path != '/predict':
+      self.reply(404, {'error': 'Not found: %s' % self.path})
+      return
+    try:
+      request = json.loads(body)
+      inputs = np.array(request['inputs'], dtype=np.float32)
+      if inputs.ndim != 2 or inputs.shape[1] != export_model.RAW_INPUTS:
+        raise RequestError(400, 'Expected inputs of shape [batch, %d], got %s' %
+            (export_model.RAW_INPUTS, list(inputs.shape)))
+      outputs = self.server.models.predict(
+          request['model'], request.get('head', SINGLE_HEAD), inputs)
+      self.reply(200, {'outputs': outputs.tolist()})
+    except RequestError as e:
+      self.reply(e.status, {'error': str(e)})
+    except (ValueError, KeyError, TypeError) as e:
+      self.reply(400, {'error': 'Bad request: %r' % e})
+    except (tf.errors.OpError, OSError) as e:
+      self.reply(500, {'error': 'Prediction failed: %s' % e})
+    except Exception as e:
+      self.reply(500, {'error': 'Internal error: %r' % e})
+
+  def log_message(self, format, *args):
+    if flags.verbose:
+      super(Handler, self).log_message(format, *args)
+
+class Server(ThreadingHTTPServer):
+  daemon_threads = True
+  # Every game opens a connection of its own, often all at once.
+  request_queue_size = 1024
+
+def log_stats(stats, interval):
+  while True:
+    time.sleep(interval)
+    print(json.dumps(stats.snapshot()), flush=True)
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Serve batched predictions to simulated games on localhost.')
+  parser.add_argument('--port', default=8500, type=int, help='Port to listen on.');
+  parser.add_argument('--latency_budget_ms', default=2.0, type=float,
+      help='Longest time to wait for more requests after the first one of a batch.');
+  parser.add_argument('--max_batch_size', default=1024, type=int,
+      help='Largest batch to predict at once, in examples.');
+  parser.add_argument('--max_models', default=16, type=int,
+      help='Number of models to keep loaded, least recently used first out.');
+  parser.add_argument('--preload', nargs='*', default=[],
+      help='Model directories to load on startup.');
+  parser.add_argument('--stats_interval', default=0, type=float,
+      help='Print stats every this many seconds, if set.');
+  parser.add_argument('--verbose', default=False, action='store_true',
+      help='Log every request.');
+  flags = parser.parse_args()
+
+  stats = Stats()
+  models = Models(stats, flags.max_models, flags.max_batch_size,
+      flags.latency_budget_ms / 1000)
+  for directory in flags.preload:
+    for head in load_heads(directory):
+      models.batcher(directory, head)
+  if flags.stats_interval:
+    threading.Thread(
+        target=log_stats, args=(stats, flags.stats_interval), daemon=True).start()
+
+  server = Server(('localhost', flags.port), Handler)
+  server.stats = stats
+  server.models = models
+  print('Serving on http://localhost:%d' % flags.port, flush=True)
+  try:
+    server.serve_forever()
+  except KeyboardInterrupt:
+    pass
@@ -0,0 +1,113 @@
+import argparse
+import json
+import numpy as np
+
+import inputs
+from schema import BINARY_MODEL_INPUTS, MODEL_INPUTS, ONE_HOT_MODEL_INPUTS
+
+# Computes the mean and variance of each numeric model input in a single
+# streaming pass. Uses the parallel form of Welford's algorithm, so statistics
+# computed separately for several files or shards can be merged exactly.
+#
+# The trainers bake these statistics into the model as a normalization layer,
+# see --input_stats.
+
+NUMERIC_MODEL_INPUTS = [
+    c for c in MODEL_INPUTS
+    if c not in ONE_HOT_MODEL_INPUTS and c not in BINARY_MODEL_INPUTS
+]
+
+class InputStats:
+  def __init__(self, count=0, mean=None, m2=None):
+    self.count = count
+    self.mean = np.zeros(len(NUMERIC_MODEL_INPUTS)) if mean is None else mean
+    self.m2 = np.zeros(len(NUMERIC_MODEL_INPUTS)) if m2 is None else m2
+
+  # Adds a batch of values, of shape [batch, len(NUMERIC_MODEL_INPUTS)].
+  def update(self, values):
+    values = np.asarray(values, dtype=np.float64)
+    if not len(values):
+      return
+    mean = values.mean(axis=0)
+    self.merge(InputStats(len(values), mean, ((values - mean) ** 2).sum(axis=0)))
+
+  def merge(self, other):
+    if not other.count:
+      return
+    count = self.count + other.count
+    delta = other.mean - self.mean
+    self.mean = self.mean + delta * other.count / count
+    self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other.count / count
+    self.count = count
+
+  def variance(self):
+    return self.m2 / max(self.count, 1)
+
+  # Returns (mean, variance) laid out the same way as raw_inputs in the
+  # trainers. One-hot and binary inputs are left as they are.
+  def normalization(self):
+    stats = dict(zip(NUMERIC_MODEL_INPUTS, zip(self.mean, self.variance())))
+    mean, variance = [], []
+    for column in MODEL_INPUTS:
+      if column in ONE_HOT_MODEL_INPUTS:
+        mean += [0.0] * len(ONE_HOT_MODEL_INPUTS[column])
+        variance += [1.0] * len(ONE_HOT_MODEL_INPUTS[column])
+      elif column in BINARY_MODEL_INPUTS:
+        mean.append(0.0)
+        variance.append(1.0)
+      else:
+        mean.append(float(stats[column][0]))
+        variance.append(float(stats[column][1]))
+    return mean, variance
+
+  def save(self, filename):
+    with open(filename, 'w') as f:
+      json.dump({
+          'count': self.count,
+          'columns': {
+              c: {'mean': float(mean), 'm2': float(m2)}
+              for c, mean, m2 in zip(NUMERIC_MODEL_INPUTS, self.mean, self.m2)
+          },
+      }, f, indent=2)
+
+  @staticmethod
+  def load(filename):
+    with open(filename, 'r') as f:
+      data = json.load(f)
+    columns = data['columns']
+    return InputStats(
+        data['count'],
+        np.array([columns[c]['mean'] for c in NUMERIC_MODEL_INPUTS]),
+        np.array([columns[c]['m2'] for c in NUMERIC_MODEL_INPUTS]))
+
+# Returns (mean, variance) for the trainers, or None if 'filename' is not set.
+def load_normalization(filename):
+  return InputStats.load(filename).normalization() if filename else None
+
+def compute(filename, batch_size=10000, has_disc=None):
+  stats = InputStats()
+  dataset = inputs.example_dataset(filename, batch_size, has_disc=has_disc)
+  for data in dataset:
+    stats.update(np.stack([data[c].numpy() for c in NUMERIC_MODEL_INPUTS], axis=1))
+  return stats
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(description='Compute normalization statistics of model inputs.')
+  parser.add_argument('--input', nargs='*', default=[],
+      help='CSV files, frame CSV files or shard directories to read examples from.')
+  parser.add_argument('--merge', nargs='*', default=[], help='Statistics files to merge.')
+  parser.add_argument('--output', required=True, help='File to write statistics to.')
+  parser.add_argument('--has_disc', type=int, choices=[0, 1],
+      help='Only use examples where team_0_player_0_hasDisc matches, for frame files.')
+  parser.add_argument('--batch_size', default=10000, type=int, help='Examples per batch');
+  flags = parser.parse_args()
+
+  stats = InputStats()
+  for filename in flags.merge:
+    stats.merge(InputStats.load(filename))
+  for filename in flags.input:
+    file_stats = compute(filename, flags.batch_size, flags.has_disc)
+    print('Read %d examples from %s' % (file_stats.count, filename))
+    stats.merge(file_stats)
+  stats.save(flags.output)
+  print('Wrote statistics of %d examples to %s' % (stats.count, flags.output))
@@ -0,0 +1,264 @@
+import glob
+import os
+import numpy as np
+import tensorflow as tf
+
+import example_shards
+import frames
+from schema import DEFAULTS_MAP, SELECTED_COLUMNS, column_type, is_required
+
+# Reads batches of examples from any of the supported input formats: an example
+# CSV, a frame CSV (see frames.py) or a shard directory (see example_shards.py).
+# Several CSV files with the same columns, as a glob pattern or a directory, are
+# read in parallel, interleaving their rows. Batches are in the same format as
+# make_csv_dataset: a dict mapping each of SELECTED_COLUMNS to a tensor of shape
+# [batch].
+
+TF_TYPES = {int: tf.int32, float: tf.float32}
+def column_default(column):
+  default = DEFAULTS_MAP[column]
+  return TF_TYPES[column_type(column)] if is_required(column) else default
+COLUMN_DEFAULTS = list(map(column_default, SELECTED_COLUMNS))
+
+# Returns the files of an input: a CSV file or shard directory, a directory of
+# CSV files, or a glob pattern. Files are sorted, so that they are always split
+# between shards the same way. The header of every CSV file is checked up front:
+# it must have all the columns the trainers read, and the same columns in the
+# same order as the first file.
+def input_files(path):
+  if example_shards.is_shard_directory(path) or os.path.isfile(path):
+    return [path]
+  filenames = sorted(glob.glob(
+      os.path.join(path, '*.csv') if os.path.isdir(path) else path))
+  if not filenames:
+    raise ValueError('No CSV files found in %s' % path)
+  header = frames.read_header(filenames[0])
+  columns = frames.FRAME_COLUMNS if frames.is_frame_file(filenames[0]) \
+      else SELECTED_COLUMNS
+  for filename in filenames:
+    if example_shards.is_shard_directory(filename):
+      raise ValueError('%s: shard directories can only be read on their own' % filename)
+    file_header = frames.read_header(filename)
+    missing = [c for c in columns if c not in file_header]
+    if missing:
+      raise ValueError('%s is missing columns: %s' % (filename, missing))
+    if file_header != header:
+      raise ValueError('%s has different columns from %s' % (filename, filenames[0]))
+  return filenames
+
+# Returns 'column_defaults', given for each of 'columns', in the order the
+# columns appear in 'header', which is how make_csv_dataset and line_decoder
+# match defaults to columns.
+def file_defaults(header, columns, column_defaults):
+  defaults = dict(zip(columns, column_defaults))
+  return [defaults[c] for c in sorted(columns, key=header.index)]
+
+# Returns a function which decodes a batch of CSV lines into a dict mapping each
+# of 'columns' to a tensor of shape [batch], with 'column_defaults' in file
+# order, the same way as make_csv_dataset.
+def line_decoder(header, columns, column_defaults):
+  indices = sorted(header.index(c) for c in columns)
+  record_defaults = [
+      tf.constant([], dtype=d) if isinstance(d, tf.DType) else d
+      for d in column_defaults
+  ]
+  def decode(lines):
+    values = tf.io.decode_csv(lines, record_defaults, select_cols=indices)
+    return dict(zip([header[i] for i in indices], values))
+  return decode
+
+# Reads batches of 'columns' from a CSV file, the same way as make_csv_dataset,
+# with 'column_defaults' in file order. With 'row_stride', only reads every
+# row_stride-th row. With 'num_shards', only reads every num_shards-th of those
+# rows starting from 'shard_index'. Rows are split before they are decoded, so
+# each training worker only parses its own share of the file.
+def csv_dataset(filename, batch_size, columns, column_defaults, num_epochs=1,
+    shuffle_buffer_size=10000, num_shards=1, shard_index=0, row_stride=1):
+  if num_shards == 1 and row_stride == 1:
+    return tf.data.experimental.make_csv_dataset(
+        filename,
+        batch_size=batch_size,
+        select_columns=columns,
+        column_defaults=column_defaults,
+        num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size,
+        num_parallel_reads=tf.data.experimental.AUTOTUNE)
+  decode = line_decoder(frames.read_header(filename), columns, column_defaults)
+  return tf.data.TextLineDataset(filename) \
+      .skip(1) \
+      .shard(row_stride, 0) \
+      .shard(num_shards, shard_index) \
+      .shuffle(shuffle_buffer_size) \
+      .repeat(num_epochs) \
+      .batch(batch_size) \
+      .map(decode, num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+# Reads batches of 'columns' from several CSV files with the same 'header', with
+# 'column_defaults' in file order, interleaving lines read from several files at
+# once, then decoding them in parallel. With 'num_shards', each shard reads
+# whole files, split by their index, if there are at least as many files as
+# shards, and otherwise every num_shards-th row of every file. Unless
+# 'shuffle_buffer_size' is 1, files are read in a different order in each epoch.
+def multi_csv_dataset(filenames, header, batch_size, columns, column_defaults,
+    num_epochs=1, shuffle_buffer_size=10000, num_shards=1, shard_index=0,
+    row_stride=1, block_size=1024):
+  by_file = len(filenames) >= num_shards
+  files = tf.data.Dataset.from_tensor_slices(filenames)
+  if by_file:
+    files = files.shard(num_shards, shard_index)
+  if shuffle_buffer_size > 1:
+    files = files.shuffle(len(filenames))
+  def read(filename):
+    lines = tf.data.TextLineDataset(filename).skip(1).shard(row_stride, 0)
+    if not by_file:
+      lines = lines.shard(num_shards, shard_index)
+    # Interleaved in blocks, which is much cheaper than line by line.
+    return lines.batch(block_size)
+  return files.repeat(num_epochs) \
+      .interleave(read, num_parallel_calls=tf.data.experimental.AUTOTUNE) \
+      .unbatch() \
+      .shuffle(shuffle_buffer_size) \
+      .batch(batch_size) \
+      .map(line_decoder(header, columns, column_defaults),
+          num_parallel_calls=tf.data.experimental.AUTOTUNE)
+
+# Reads batches of 'columns' from the CSV files of an input, with
+# 'column_defaults' in file order, see csv_dataset and multi_csv_dataset.
+def read_csv_files(filenames, batch_size, columns, column_defaults, **kwargs):
+  if len(filenames) > 1:
+    return multi_csv_dataset(filenames, frames.read_header(filenames[0]), batch_size,
+        columns, column_defaults, **kwargs)
+  return csv_dataset(filenames[0], batch_size, columns, column_defaults, **kwargs)
+
+# Reads batches of whole frames from frame files, see input_files, as dicts
+# mapping each of FRAME_COLUMNS to a tensor of shape [batch], with empty
+# optional float columns decoded as NaN. Takes the same arguments as
+# example_dataset.
+def frame_dataset(filename, batch_size, num_epochs=1, shuffle_buffer_size=10000,
+    num_shards=1, shard_index=0, row_stride=1):
+  filenames = input_files(filename)
+  if not frames.is_frame_file(filenames[0]):
+    raise ValueError('%s is not a frame file' % filenames[0])
+  return read_csv_files(filenames, batch_size, frames.FRAME_COLUMNS,
+      frames.frame_defaults(filenames[0]),
+      num_epochs=num_epochs,
+      shuffle_buffer_size=shuffle_buffer_size,
+      num_shards=num_shards,
+      shard_index=shard_index,
+      row_stride=row_stride)
+
+# Reads any input, see input_files, with 'column_defaults' for each of
+# SELECTED_COLUMNS. Frame files are permuted on the fly, keeping only examples
+# where team_0_player_0_hasDisc is 'has_disc', if given. With 'num_shards', each
+# shard reads a different part of the input, see csv_dataset,
+# multi_csv_dataset and example_shards.shard_dataset. With 'row_stride', only reads every
+# row_stride-th row of CSV files: every row_stride-th tick of a frame file, or of
+# each player in an example CSV, where getPermutedCsvData writes all the ticks
+# of a player in a row.
+def example_dataset(filename, batch_size, column_defaults=COLUMN_DEFAULTS,
+    num_epochs=1, shuffle_buffer_size=10000, has_disc=None, num_shards=1,
+    shard_index=0, row_stride=1):
+  if example_shards.is_shard_directory(filename):
+    if row_stride != 1:
+      raise ValueError('%s: shard directories are not in tick order' % filename)
+    return example_shards.shard_dataset(filename, batch_size, num_epochs=num_epochs,
+        num_shards=num_shards, shard_index=shard_index)
+  filenames = input_files(filename)
+  if frames.is_frame_file(filenames[0]):
+    dataset = frame_dataset(filename, max(1, batch_size // len(frames.PERSPECTIVES)),
+        num_epochs=num_epochs,
+        shuffle_buffer_size=shuffle_buffer_size,
+        num_shards=num_shards,
+        shard_index=shard_index,
+        row_stride=row_stride)
+    return frames.expand_frames(dataset, batch_size, has_disc=has_disc)
+  header = frames.read_header(filenames[0])
+  return read_csv_files(filenames, batch_size, SELECTED_COLUMNS,
+      file_defaults(header, SELECTED_COLUMNS, column_defaults),
+      num_epochs=num_epochs,
+      shuffle_buffer_size=shuffle_buffer_size,
+      num_shards=num_shards,
+      shard_index=shard_index,
+      row_stride=row_stride)
+
+# Returns a dataset of the lines of a file between byte offsets 'start' and
+# 'end', which must both be at the start of a line.
+def read_lines(filename, start, end, block_size=1 << 20):
+  def generate():
+    with open(filename, 'rb') as f:
+      f.seek(start)
+      remaining = end - start
+      while remaining > 0:
+        lines = f.readlines(min(block_size, remaining))
+        if not lines:
+          break
+        remaining -= sum(map(len, lines))
+        yield np.array([line.rstrip(b'\r\n') for line in lines], dtype=object)
+  return tf.data.Dataset.from_generator(
+      generate, output_signature=tf.TensorSpec((None,), tf.string)).unbatch()
+
+# Returns the number of lines between byte offsets 'start' and 'end'.
+def count_lines(filename, start, end, block_size=1 << 20):
+  lines = 0
+  with open(filename, 'rb') as f:
+    f.seek(start)
+    remaining = end - start
+    while remaining > 0:
+      block = f.read(min(block_size, remaining))
+      if not block:
+        break
+      lines += block.count(b'\n')
+      remaining -= len(block)
+  return lines
+
+# Returns 'count' lines sampled at random from between byte offsets 'start' and
+# 'end'. Each sample is the line following a random offset, so lines are picked
+# roughly, not exactly, uniformly, and only 'count' lines are read.
+def sample_lines(filename, start, end, count, seed=None):
+  rng = np.random.default_rng(seed)
+  lines = []
+  with open(filename, 'rb') as f:
+    for offset in np.sort(rng.integers(start, end, count)) if end > start else []:
+      # Skip to the start of the next line, unless already there.
+      f.seek(offset - 1)
+      f.readline()
+      if f.tell() >= end:
+        f.seek(start)
+      lines.append(f.readline().rstrip(b'\r\n'))
+  return lines
+
+# Reads the rows of a CSV or frame CSV file between byte offsets 'start' and
+# 'end', shuffled together with replay_fraction times as many rows sampled at
+# random from between the header and 'start'. Used to train only on rows
+# appended since the last run, see resume.py. With 'row_stride', only reads
+# every row_stride-th of the new rows.
+def appended_dataset(filename, batch_size, start, end, replay_fraction=0.0,
+    column_defaults=COLUMN_DEFAULTS, shuffle_buffer_size=10000, has_disc=None,
+    row_stride=1):
+  if example_shards.is_shard_directory(filename):
+    raise ValueError('%s: only CSV files can be read from an offset' % filename)
+  header = frames.read_header(filename)
+  with open(filename, 'rb') as f:
+    header_end = len(f.readline())
+  new_rows = -(-count_lines(filename, start, end) // row_stride)
+  replay = sample_lines(
+      filename, header_end, start, int(new_rows * replay_fraction))
+  lines = read_lines(filename, start, end).shard(row_stride, 0)
+  if replay:
+    # Draw from both in proportion to their size, so replayed rows are spread
+    # over the whole run.
+    lines = tf.data.Dataset.sample_from_datasets(
+        [lines, tf.data.Dataset.from_tensor_slices(replay)],
+        weights=[float(new_rows), float(len(replay))],
+        stop_on_empty_dataset=False)
+  lines = lines.shuffle(shuffle_buffer_size)
+  if frames.is_frame_file(filename):
+    dataset = lines \
+        .batch(max(1, batch_size // len(frames.PERSPECTIVES))) \
+        .map(line_decoder(header, frames.FRAME_COLUMNS, frames.frame_defaults(filename)),
+            num_parallel_calls=tf.data.experimental.AUTOTUNE)
+    return frames.expand_frames(dataset, batch_size, has_disc=has_disc)
+  return lines.batch(batch_size).map(
+      line_decoder(header, SELECTED_COLUMNS,
+          file_defaults(header, SELECTED_COLUMNS, column_defaults)),
+      num_parallel_calls=tf.data.experimental.AUTOTUNE)
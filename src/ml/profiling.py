@@ -0,0 +1,206 @@
+import contextlib
+import json
+import math
+import resource
+import sys
+import time
+import numpy as np
+import tensorflow as tf
+
+# Profiling of training runs, see --profile. Appends one JSON object per line
+# to a log file:
+#
+# - 'input': time of each stage of the input pipeline, measured on its own
+#   before training. Decoding reads a few batches without shuffling, and
+#   caches them. Featurizing maps the cached batches, on a single thread,
+#   where the pipeline runs it in parallel. Shuffling reads the same number of
+#   batches with the shuffle buffer, so its time is the difference, and its
+#   first batch includes filling the buffer.
+# - 'chunk': for each training batch, how long the training loop waited for
+#   it, how long each model took to fit and validate on it, and the share of
+#   time spent waiting on input (the stall percentage).
+# - 'summary': totals over the whole run.
+#
+# Every line has the peak resident set size of the process so far. Optionally,
+# a TensorFlow profiler trace is recorded for a window of training steps, which
+# can be viewed in TensorBoard.
+
+FEATURIZE_PASSES = 10
+FEATURIZE_TRIES = 3
+
+def peak_rss_mb():
+  usage = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+  # In bytes on macOS, in kilobytes elsewhere.
+  return usage / (1 << 20) if sys.platform == 'darwin' else usage / (1 << 10)
+
+# Returns the number of elements and examples in 'dataset', and the time it
+# took to read them. Reads within TensorFlow, so that the time per element of
+# iterating in Python does not hide the time of cheap stages.
+def read(dataset):
+  def count(state, element):
+    # Elements are batches, or tuples of them. Their first dimension is the
+    # number of examples.
+    first = tf.nest.flatten(element)[0]
+    return state[0] + 1, state[1] + tf.cast(tf.shape(first)[0], tf.int64)
+  start = time.perf_counter()
+  elements, examples = dataset.reduce((np.int64(0), np.int64(0)), count)
+  return int(elements), int(examples), time.perf_counter() - start
+
+# Returns the time to map 'featurize' over the elements of 'cached', a cached
+# dataset. Featurizing is cheap next to the fixed cost of a read, so it is timed
+# over several passes, taking the fastest of a few tries.
+def featurize_seconds(cached, featurize):
+  cache_read = featurized = math.inf
+  for i in range(FEATURIZE_TRIES):
+    cache_read = min(cache_read, read(cached.repeat(FEATURIZE_PASSES))[2])
+    featurized = min(featurized,
+        read(cached.repeat(FEATURIZE_PASSES).map(featurize))[2])
+  return max(0.0, featurized - cache_read) / FEATURIZE_PASSES
+
+def first_element_seconds(dataset):
+  start = time.perf_counter()
+  next(iter(dataset))
+  return time.perf_counter() - start
+
+# Yields the elements of 'iterable', keeping the time spent waiting for the last
+# one in 'wait'.
+class TimedIterator:
+  def __init__(self, iterable):
+    self.iterator = iter(iterable)
+    self.wait = 0.0
+
+  def __iter__(self):
+    return self
+
+  def __next__(self):
+    start = time.perf_counter()
+    try:
+      return next(self.iterator)
+    finally:
+      self.wait = time.perf_counter() - start
+
+# Does nothing if 'filename' is None, so that the training loops can call it
+# unconditionally.
+class Profiler:
+  def __init__(self, filename, trace_dir=None, trace_start=1, trace_steps=100):
+    self.file = open(filename, 'a') if filename else None
+    self.trace_dir = trace_dir
+    self.trace_start = trace_start
+    self.trace_steps = trace_steps
+    self.traced_steps = None
+    self.chunks = 0
+    self.examples = 0
+    self.seconds = 0.0
+    self.input_wait = 0.0
+
+  @property
+  def enabled(self):
+    return self.file is not None
+
+  def log(self, event, **fields):
+    record = {'event': event, 'time': time.time()}
+    record.update(fields)
+    record['peak_rss_mb'] = peak_rss_mb()
+    self.file.write(json.dumps(record) + '\n')
+    self.file.flush()
+
+  # Times decoding, shuffling and featurizing 'num_elements' elements of the
+  # input of 'name'. 'decoded' takes a shuffle buffer size and returns a
+  # dataset of decoded elements, and 'featurize' maps them to what the
+  # training loop reads.
+  def input_stages(self, name, decoded, featurize, shuffle_size, num_elements):
+    cached = decoded(1).take(num_elements).cache()
+    elements, examples, decode = read(cached)
+    if not elements:
+      raise ValueError('No %s examples found' % name)
+    shuffled = read(decoded(shuffle_size).take(num_elements))[2]
+    stages = {
+        'decode': decode,
+        'featurize': featurize_seconds(cached, featurize),
+        'shuffle': max(0.0, shuffled - decode),
+    }
+    for stage, seconds in stages.items():
+      self.log('input', model=name, stage=stage, elements=elements,
+          examples=examples, seconds=seconds,
+          examples_per_second=examples / seconds if seconds else None)
+    self.log('input', model=name, stage='shuffle_fill',
+        seconds=first_element_seconds(decoded(shuffle_size)),
+        decode_first_seconds=first_element_seconds(decoded(1)),
+        shuffle_size=shuffle_size)
+
+  # Called once the training loop has read a chunk, before training on it.
+  def start_chunk(self, input_wait):
+    if not self.enabled:
+      return
+    self.chunk_wait = input_wait
+    self.chunk_start = time.perf_counter()
+    self.chunk_models = {}
+    if self.trace_dir and self.chunks == self.trace_start:
+      tf.profiler.experimental.start(self.trace_dir)
+      self.traced_steps = 0
+
+  # Times fitting model 'name' on 'examples' examples, in 'steps' train steps.
+  @contextlib.contextmanager
+  def fit(self, name, examples, steps):
+    start = time.perf_counter()
+    yield
+    if self.enabled:
+      seconds = time.perf_counter() - start
+      self.chunk_models[name] = {
+          'examples': examples,
+          'steps': steps,
+          'fit_seconds': seconds,
+          'step_ms': seconds * 1000 / steps if steps else None,
+          'validate_seconds': 0.0,
+      }
+
+  @contextlib.contextmanager
+  def validate(self, name):
+    start = time.perf_counter()
+    yield
+    if self.enabled and name in self.chunk_models:
+      self.chunk_models[name]['validate_seconds'] = time.perf_counter() - start
+
+  def end_chunk(self):
+    if not self.enabled:
+      return
+    train = time.perf_counter() - self.chunk_start
+    examples = sum(m['examples'] for m in self.chunk_models.values())
+    seconds = self.chunk_wait + train
+    self.examples += examples
+    self.seconds += seconds
+    self.input_wait += self.chunk_wait
+    self.log('chunk',
+        chunk=self.chunks,
+        examples=examples,
+        seconds=seconds,
+        input_wait_seconds=self.chunk_wait,
+        train_seconds=train,
+        examples_per_second=examples / seconds if seconds else None,
+        stall_percent=100 * self.chunk_wait / seconds if seconds else None,
+        models=self.chunk_models)
+    self.chunks += 1
+    if self.traced_steps is not None:
+      self.traced_steps += max(
+          [m['steps'] for m in self.chunk_models.values()], default=0)
+      if self.traced_steps >= self.trace_steps:
+        self.stop_trace()
+
+  def stop_trace(self):
+    if self.traced_steps is not None:
+      tf.profiler.experimental.stop()
+      self.log('trace', directory=self.trace_dir, steps=self.traced_steps)
+      self.traced_steps = None
+
+  def close(self):
+    if not self.enabled:
+      return
+    self.stop_trace()
+    self.log('summary',
+        chunks=self.chunks,
+        examples=self.examples,
+        seconds=self.seconds,
+        input_wait_seconds=self.input_wait,
+        examples_per_second=self.examples / self.seconds if self.seconds else None,
+        stall_percent=100 * self.input_wait / self.seconds if self.seconds else None)
+    self.file.close()
@@ -0,0 +1,242 @@
+import argparse
+import gzip
+import json
+import os
+import time
+import numpy as np
+import tensorflow as tf
+
+import export_model
+import inputs
+import train_bootstrap
+import train_double_bootstrap
+import validation
+
+# Builds smaller variants of a trained model and reports how much they drift
+# from it, on held out examples:
+#
+# - float32: the model converted to TensorFlow Lite as it is, as a baseline.
+# - float16: TensorFlow Lite, with weights stored as float16.
+# - int8: TensorFlow Lite, with weights and activations quantized to int8,
+#   calibrated on held out examples. Inputs and outputs stay float32.
+# - pruned: a SavedModel with the smallest weights of each kernel set to zero,
+#   which makes it compress better.
+#
+# For each variant, reports its size, gzipped size, latency for one example
+# and for a team of 7, how often the predicted action agrees with the float32
+# model, and the mean squared difference of the numeric outputs.
+
+# Number of leading outputs which are action logits, by model. The thrower
+# model predicts whether to throw as a single logit.
+ACTION_OUTPUTS = {'model': 3, 'cutter': 0, 'thrower': 1}
+# Which examples each model is trained on, by team_0_player_0_hasDisc.
+HAS_DISC = {'model': None, 'cutter': 0, 'thrower': 1}
+
+def sample_inputs(filename, has_disc, size):
+  def featurize(data):
+    if has_disc is not None:
+      mask = tf.equal(data['team_0_player_0_hasDisc'], has_disc)
+      data = {c: tf.boolean_mask(v, mask) for c, v in data.items()}
+    return train_bootstrap.batch_raw_inputs(data)
+  features = []
+  examples = 0
+  dataset = inputs.example_dataset(filename, 10000) \
+      .map(lambda data: validation.split(data, flags.validation_fraction, True)) \
+      .map(featurize)
+  for batch in dataset:
+    features.append(batch.numpy())
+    examples += len(batch)
+    if examples >= size:
+      break
+  if not examples:
+    raise ValueError('No validation examples found in %s' % filename)
+  return np.concatenate(features)[:size]
+
+# TensorFlow Lite has no bfloat16 kernels, so models trained with --bfloat16
+# are rebuilt in float32 with the same weights.
+def float32_model(name, model, sample):
+  if all(layer.compute_dtype == 'float32' for layer in model.layers):
+    return model
+  normalization = None
+  for layer in model.layers:
+    if type(layer).__name__ == 'Normalization':
+      normalization = layer.get_weights()[:2]
+  if name == 'model':
+    copy = getattr(train_bootstrap, type(model).__name__)(normalization)
+  else:
+    num_outputs = model(sample[:1], training=False).shape[-1]
+    copy = getattr(train_double_bootstrap, type(model).__name__)(
+        num_outputs, normalization)
+  copy(sample[:1])
+  copy.set_weights(model.get_weights())
+  return copy
+
+def tflite_model(model, sample, variant):
+  serve = export_model.serving_function(model)
+  converter = tf.lite.TFLiteConverter.from_concrete_functions(
+      [serve.get_concrete_function()], model)
+  if variant == 'float16':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.target_spec.supported_types = [tf.float16]
+  elif variant == 'int8':
+    converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    converter.representative_dataset = \
+        lambda: ([sample[i:i + 1]] for i in range(min(len(sample), 500)))
+  return converter.convert()
+
+# Returns a function running a TensorFlow Lite model on a batch of inputs.
+def tflite_function(content):
+  interpreter = tf.lite.Interpreter(model_content=content)
+  input_index = interpreter.get_input_details()[0]['index']
+  output_index = interpreter.get_output_details()[0]['index']
+  shape = [None]
+  def predict(batch):
+    if shape[0] != batch.shape:
+      interpreter.resize_tensor_input(input_index, batch.shape)
+      interpreter.allocate_tensors()
+      shape[0] = batch.shape
+    interpreter.set_tensor(input_index, batch)
+    interpreter.invoke()
+    return interpreter.get_tensor(output_index).copy()
+  return predict
+
+# Sets the 'sparsity' fraction of weights with the smallest magnitude in each
+# kernel to zero. Biases and normalization statistics are left as they are.
+def prune(model, sparsity):
+  for layer in model.layers:
+    if getattr(layer, 'kernel', None) is None:
+      continue
+    kernel = layer.kernel.numpy()
+    threshold = np.quantile(np.abs(kernel), sparsity)
+    layer.kernel.assign(np.where(np.abs(kernel) < threshold, 0.0, kernel))
+
+def directory_size(path):
+  return sum(
+      os.path.getsize(os.path.join(root, f))
+      for root, dirs, files in os.walk(path) for f in files)
+
+def gzip_size(path):
+  if os.path.isdir(path):
+    return sum(
+        gzip_size(os.path.join(root, f))
+        for root, dirs, files in os.walk(path) for f in files)
+  with open(path, 'rb') as f:
+    return len(gzip.compress(f.read()))
+
+def latency(predict, sample, batch_size, repeats):
+  batch = sample[:batch_size]
+  predict(batch)
+  start = time.time()
+  for i in range(repeats):
+    predict(batch)
+  return (time.time() - start) * 1000 / repeats
+
+def drift(name, outputs, reference):
+  num_actions = ACTION_OUTPUTS[name]
+  if num_actions == 1:
+    agreement = np.mean((outputs[:, 0] > 0) == (reference[:, 0] > 0))
+  elif num_actions:
+    agreement = np.mean(
+        np.argmax(outputs[:, :num_actions], axis=-1) ==
+        np.argmax(reference[:, :num_actions], axis=-1))
+  else:
+    agreement = None
+  mse = float(np.mean((outputs[:, num_actions:] - reference[:, num_actions:]) ** 2))
+  return agreement, mse
+
+def report(name, model_dir, filename, output_dir):
+  model = tf.keras.models.load_model(model_dir, compile=False)
+  sample = sample_inputs(filename, HAS_DISC[name], flags.validation_size)
+  reference = model.predict(sample, batch_size=1000, verbose=0)
+  os.makedirs(output_dir, exist_ok=True)
+
+  variants = {}
+  converted = float32_model(name, model, sample)
+  for variant in ['float32', 'float16', 'int8']:
+    path = os.path.join(output_dir, variant + '.tflite')
+    with open(path, 'wb') as f:
+      f.write(tflite_model(converted, sample, variant))
+    with open(path, 'rb') as f:
+      variants[variant] = (path, tflite_function(f.read()))
+
+  pruned = tf.keras.models.load_model(model_dir, compile=False)
+  prune(pruned, flags.sparsity)
+  path = os.path.join(output_dir, 'pruned')
+  pruned.save(path, include_optimizer=False)
+  variants['pruned'] = (path, lambda batch: pruned(batch, training=False).numpy())
+
+  variants['saved model'] = (model_dir, lambda batch: model(batch, training=False).numpy())
+
+  results = []
+  for variant, (path, predict) in variants.items():
+    outputs = np.concatenate([
+        predict(sample[i:i + 1000]) for i in range(0, len(sample), 1000)])
+    agreement, mse = drift(name, outputs, reference)
+    size = directory_size(path) if os.path.isdir(path) else os.path.getsize(path)
+    results.append({
+        'model': name,
+        'variant': variant,
+        'path': path,
+        'bytes': size,
+        'gzip_bytes': gzip_size(path),
+        'latency_ms_batch_1': latency(predict, sample, 1, flags.repeats),
+        'latency_ms_batch_7': latency(predict, sample, 7, flags.repeats),
+        'action_agreement': agreement,
+        'mse_drift': mse,
+    })
+
+  print('[%s] %d held out examples' % (name, len(sample)))
+  print('%-12s %10s %10s %10s %10s %10s %12s' % (
+      'variant', 'bytes', 'gzip', 'ms (1)', 'ms (7)', 'action', 'mse drift'))
+  for r in results:
+    print('%-12s %10d %10d %10.3f %10.3f %10s %12.3g' % (
+        r['variant'], r['bytes'], r['gzip_bytes'], r['latency_ms_batch_1'],
+        r['latency_ms_batch_7'],
+        '-' if r['action_agreement'] is None else '%.4f' % r['action_agreement'],
+        r['mse_drift']))
+  return results
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Build quantized and pruned variants of a model and report their drift.')
+  parser.add_argument('--model', required=True,
+      help='Model saved by train_bootstrap.py, or directory of cutter and ' +
+      'thrower models saved by train_double_bootstrap.py.');
+  parser.add_argument('--input',
+      help='CSV file, frame CSV file or shard directory to take held out examples from.');
+  parser.add_argument('--cutter_input',
+      help='Input for the cutter model, if different from --input.');
+  parser.add_argument('--thrower_input',
+      help='Input for the thrower model, if different from --input.');
+  parser.add_argument('--output', required=True, help='Directory to write variants to.');
+  parser.add_argument('--validation_fraction', default=0.1, type=float,
+      help='Same as the --validation_fraction the model was trained with');
+  parser.add_argument('--validation_size', default=10000, type=int,
+      help='Number of held out examples to compare on');
+  parser.add_argument('--sparsity', default=0.5, type=float,
+      help='Fraction of each kernel to set to zero in the pruned variant');
+  parser.add_argument('--repeats', default=200, type=int,
+      help='Number of calls to average latency over');
+  flags = parser.parse_args()
+
+  names = [
+      name for name in ['cutter', 'thrower']
+      if os.path.isdir(os.path.join(flags.model, name))
+  ]
+  filenames = {
+      'model': flags.input,
+      'cutter': flags.cutter_input or flags.input,
+      'thrower': flags.thrower_input or flags.input,
+  }
+  for name in names or ['model']:
+    if not filenames[name]:
+      parser.error('No input for the %s model, see --input' % name)
+  results = []
+  if names:
+    for name in names:
+      results += report(name, os.path.join(flags.model, name), filenames[name],
+          os.path.join(flags.output, name))
+  else:
+    results += report('model', flags.model, flags.input, flags.output)
+  with open(os.path.join(flags.output, 'report.json'), 'w') as f:
+    json.dump(results, f, indent=2)
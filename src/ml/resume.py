@@ -0,0 +1,81 @@
+import json
+import os
+import tensorflow as tf
+
+import inputs
+
+# State for incremental training over append-only example files, kept in a
+# directory next to the trained model: a checkpoint of the model weights and
+# optimizer state, and a cursor per input file recording the byte offset and
+# number of rows trained on so far. A run with --resume trains only on rows
+# appended after the cursor, then moves the cursor to the end of the file.
+
+CURSOR_FILE = 'cursors.json'
+CHECKPOINT_PREFIX = 'checkpoint'
+
+def state_directory(output):
+  return os.path.normpath(output) + '.resume'
+
+def load_cursors(output):
+  path = os.path.join(state_directory(output), CURSOR_FILE)
+  if not os.path.exists(path):
+    return {}
+  with open(path, 'r') as f:
+    return json.load(f)
+
+# Returns the byte offset just past the header of a CSV file, and just past its
+# last complete line. A row which is still being appended is left for the next
+# run.
+def data_range(filename):
+  with open(filename, 'rb') as f:
+    start = len(f.readline())
+    end = f.seek(0, os.SEEK_END)
+    while end > start:
+      block = max(start, end - (1 << 16))
+      f.seek(block)
+      newline = f.read(end - block).rfind(b'\n')
+      if newline >= 0:
+        return start, block + newline + 1
+      end = block
+  return start, start
+
+# Returns the byte offsets of the rows of 'filename' appended since the last
+# run, and moves its cursor in 'cursors' past them.
+def advance(cursors, filename):
+  key = os.path.abspath(filename)
+  header_end, end = data_range(filename)
+  cursor = cursors.get(key, {'offset': header_end, 'rows': 0})
+  if cursor['offset'] > end:
+    raise ValueError('%s is shorter than when it was last trained on' % filename)
+  rows = inputs.count_lines(filename, cursor['offset'], end)
+  print('Resuming %s at row %d: %d new rows' % (filename, cursor['rows'], rows))
+  cursors[key] = {'offset': end, 'rows': cursor['rows'] + rows}
+  return cursor['offset'], end
+
+def checkpoint(models):
+  return tf.train.Checkpoint(**{
+      name: tf.train.Checkpoint(model=model, optimizer=model.optimizer)
+      for name, model in models.items()
+  })
+
+# Restores the weights and optimizer state of 'models', a dict of compiled
+# models by name, if there is a saved state. Returns whether there was one.
+def restore(output, models):
+  prefix = os.path.join(state_directory(output), CHECKPOINT_PREFIX)
+  if not tf.io.gfile.exists(prefix + '.index'):
+    return False
+  # Slot variables of the optimizer are restored when they are created, on
+  # the first training step.
+  checkpoint(models).read(prefix).expect_partial()
+  return True
+
+def save(output, models, cursors):
+  directory = state_directory(output)
+  os.makedirs(directory, exist_ok=True)
+  checkpoint(models).write(os.path.join(directory, CHECKPOINT_PREFIX))
+  # The cursors are written last, so that rows are never skipped if saving
+  # the checkpoint fails.
+  path = os.path.join(directory, CURSOR_FILE)
+  with open(path + '.tmp', 'w') as f:
+    json.dump(cursors, f, indent=2)
+  os.replace(path + '.tmp', path)
@@ -0,0 +1,82 @@
+import os
+import re
+import subprocess
+import sys
+import tempfile
+import unittest
+
+import benchmark
+import resume
+
+# Run with: python -m unittest resume_test
+
+DIRECTORY = os.path.dirname(os.path.abspath(__file__))
+FIRST_ROWS = 300
+APPENDED_ROWS = 400
+BATCH_SIZE = 100
+
+FLAGS = [
+    '--resume', '--train_batches', '1', '--train_batch_size', str(BATCH_SIZE),
+    '--epochs', '1', '--shuffle_size', '100', '--replay_fraction', '0',
+]
+
+def append_rows(filename, seed, rows):
+  with open(filename, 'a') as f:
+    if not f.tell():
+      f.write(','.join(benchmark.CSV_COLUMNS) + '\n')
+    f.write(benchmark.synthetic_lines((seed, 0, rows)))
+
+def run(script, *args):
+  result = subprocess.run(
+      [sys.executable, os.path.join(DIRECTORY, script)] + FLAGS + list(args),
+      cwd=DIRECTORY, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, text=True)
+  if result.returncode:
+    raise AssertionError('%s failed:\n%s' % (script, result.stdout))
+  return result.stdout
+
+class ResumeTest(unittest.TestCase):
+  def setUp(self):
+    self.directory = tempfile.TemporaryDirectory()
+    self.input = os.path.join(self.directory.name, 'examples.csv')
+    self.output = os.path.join(self.directory.name, 'model')
+    append_rows(self.input, 0, FIRST_ROWS)
+
+  def tearDown(self):
+    self.directory.cleanup()
+
+  def assertNothingPending(self):
+    cursor = resume.load_cursors(self.output)[os.path.abspath(self.input)]
+    self.assertEqual(cursor['rows'], FIRST_ROWS + APPENDED_ROWS)
+    self.assertEqual(cursor['offset'], os.path.getsize(self.input))
+
+  # The appended rows take several batches, more than --train_batches, and are
+  # all trained on before the cursor moves past them.
+  def test_trains_on_all_appended_rows(self):
+    args = ['--input', self.input, '--output', self.output, '--validation_fraction', '0']
+    run('train_bootstrap.py', *args)
+    append_rows(self.input, 1, APPENDED_ROWS)
+    output = run('train_bootstrap.py', *args)
+    self.assertIn('%d new rows' % APPENDED_ROWS, output)
+    self.assertIn('Trained on %d examples' % APPENDED_ROWS, output)
+    self.assertNothingPending()
+    self.assertIn('nothing to train on', run('train_bootstrap.py', *args))
+
+  def test_double_trains_on_all_appended_rows(self):
+    args = ['--input', self.input, '--output', self.output, '--validation_size', '50']
+    run('train_double_bootstrap.py', *args)
+    append_rows(self.input, 1, APPENDED_ROWS)
+    output = run('train_double_bootstrap.py', *args)
+    self.assertIn('%d new rows' % APPENDED_ROWS, output)
+    # The cutter is validated after every shared batch.
+    self.assertEqual(len(re.findall(r'\[cutter\] Validation loss', output)),
+        APPENDED_ROWS // BATCH_SIZE)
+    self.assertNothingPending()
+    self.assertIn('nothing to train on', run('train_double_bootstrap.py', *args))
+
+  def test_rejects_patience(self):
+    with self.assertRaises(AssertionError):
+      run('train_bootstrap.py', '--input', self.input, '--output', self.output,
+          '--patience', '2')
+
+if __name__ == '__main__':
+  unittest.main()
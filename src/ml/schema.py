@@ -0,0 +1,170 @@
+# Schema of the example CSVs written by record_games.js, shared by the trainers
+# and by the tools which read or convert their input.
+
+MODEL_INPUTS = [
+    'state',
+    'offensiveTeam',
+    'offensiveGoalDirection',
+    'stallCount',
+    'disc_x',
+    'disc_y',
+    'disc_z',
+    'team_0_player_0_x', 'team_0_player_0_y', 'team_0_player_0_vx', 'team_0_player_0_vy', 'team_0_player_0_hasDisc',
+    'team_0_player_1_x', 'team_0_player_1_y', 'team_0_player_1_vx', 'team_0_player_1_vy', 'team_0_player_1_hasDisc',
+    'team_0_player_2_x', 'team_0_player_2_y', 'team_0_player_2_vx', 'team_0_player_2_vy', 'team_0_player_2_hasDisc',
+    'team_0_player_3_x', 'team_0_player_3_y', 'team_0_player_3_vx', 'team_0_player_3_vy', 'team_0_player_3_hasDisc',
+    'team_0_player_4_x', 'team_0_player_4_y', 'team_0_player_4_vx', 'team_0_player_4_vy', 'team_0_player_4_hasDisc',
+    'team_0_player_5_x', 'team_0_player_5_y', 'team_0_player_5_vx', 'team_0_player_5_vy', 'team_0_player_5_hasDisc',
+    'team_0_player_6_x', 'team_0_player_6_y', 'team_0_player_6_vx', 'team_0_player_6_vy', 'team_0_player_6_hasDisc',
+    'team_1_player_0_x', 'team_1_player_0_y', 'team_1_player_0_vx', 'team_1_player_0_vy', 'team_1_player_0_hasDisc',
+    'team_1_player_1_x', 'team_1_player_1_y', 'team_1_player_1_vx', 'team_1_player_1_vy', 'team_1_player_1_hasDisc',
+    'team_1_player_2_x', 'team_1_player_2_y', 'team_1_player_2_vx', 'team_1_player_2_vy', 'team_1_player_2_hasDisc',
+    'team_1_player_3_x', 'team_1_player_3_y', 'team_1_player_3_vx', 'team_1_player_3_vy', 'team_1_player_3_hasDisc',
+    'team_1_player_4_x', 'team_1_player_4_y', 'team_1_player_4_vx', 'team_1_player_4_vy', 'team_1_player_4_hasDisc',
+    'team_1_player_5_x', 'team_1_player_5_y', 'team_1_player_5_vx', 'team_1_player_5_vy', 'team_1_player_5_hasDisc',
+    'team_1_player_6_x', 'team_1_player_6_y', 'team_1_player_6_vx', 'team_1_player_6_vy', 'team_1_player_6_hasDisc',
+    'last_action',
+    'last_move_x',
+    'last_move_y',
+    'last_throw_x',
+    'last_throw_y',
+    'last_throw_z',
+    'last_throw_angleOfAttack',
+    'last_throw_tiltAngle',
+]
+ACTION_VALUES = ['rest', 'move', 'throw']
+STATE_VALUES = ['pickup', 'normal', 'receiving', 'kickoff']
+ONE_HOT_MODEL_INPUTS = {
+    'state': STATE_VALUES,
+    'last_action': ACTION_VALUES,
+}
+BINARY_MODEL_INPUTS = [
+    'offensiveTeam', 'offensiveGoalDirection',
+    'team_0_player_0_hasDisc',
+    'team_0_player_1_hasDisc',
+    'team_0_player_2_hasDisc',
+    'team_0_player_3_hasDisc',
+    'team_0_player_4_hasDisc',
+    'team_0_player_5_hasDisc',
+    'team_0_player_6_hasDisc',
+    'team_1_player_0_hasDisc',
+    'team_1_player_1_hasDisc',
+    'team_1_player_2_hasDisc',
+    'team_1_player_3_hasDisc',
+    'team_1_player_4_hasDisc',
+    'team_1_player_5_hasDisc',
+    'team_1_player_6_hasDisc',
+]
+
+NUMERIC_MODEL_OUTPUTS = [
+    'move_x', 'move_y',
+    'throw_x', 'throw_y', 'throw_z', 'throw_angleOfAttack', 'throw_tiltAngle',
+]
+MODEL_OUTPUTS = ['action'] + NUMERIC_MODEL_OUTPUTS
+
+SELECTED_COLUMNS = MODEL_INPUTS + MODEL_OUTPUTS
+
+# For columns which must be present in every row, the type of the column.
+# Otherwise, the value to use when the column is left empty.
+DEFAULTS_MAP = {
+    'state': int,
+    'offensiveTeam': int,
+    'offensiveGoalDirection': int,
+    'stallCount': float,
+    'disc_x': float,
+    'disc_y': float,
+    'disc_z': float,
+    'team_0_player_0_x': float,
+    'team_0_player_0_y': float,
+    'team_0_player_0_vx': float,
+    'team_0_player_0_vy': float,
+    'team_0_player_0_hasDisc': int,
+    'team_0_player_1_x': float,
+    'team_0_player_1_y': float,
+    'team_0_player_1_vx': float,
+    'team_0_player_1_vy': float,
+    'team_0_player_1_hasDisc': int,
+    'team_0_player_2_x': float,
+    'team_0_player_2_y': float,
+    'team_0_player_2_vx': float,
+    'team_0_player_2_vy': float,
+    'team_0_player_2_hasDisc': int,
+    'team_0_player_3_x': float,
+    'team_0_player_3_y': float,
+    'team_0_player_3_vx': float,
+    'team_0_player_3_vy': float,
+    'team_0_player_3_hasDisc': int,
+    'team_0_player_4_x': float,
+    'team_0_player_4_y': float,
+    'team_0_player_4_vx': float,
+    'team_0_player_4_vy': float,
+    'team_0_player_4_hasDisc': int,
+    'team_0_player_5_x': float,
+    'team_0_player_5_y': float,
+    'team_0_player_5_vx': float,
+    'team_0_player_5_vy': float,
+    'team_0_player_5_hasDisc': int,
+    'team_0_player_6_x': float,
+    'team_0_player_6_y': float,
+    'team_0_player_6_vx': float,
+    'team_0_player_6_vy': float,
+    'team_0_player_6_hasDisc': int,
+    'team_1_player_0_x': float,
+    'team_1_player_0_y': float,
+    'team_1_player_0_vx': float,
+    'team_1_player_0_vy': float,
+    'team_1_player_0_hasDisc': int,
+    'team_1_player_1_x': float,
+    'team_1_player_1_y': float,
+    'team_1_player_1_vx': float,
+    'team_1_player_1_vy': float,
+    'team_1_player_1_hasDisc': int,
+    'team_1_player_2_x': float,
+    'team_1_player_2_y': float,
+    'team_1_player_2_vx': float,
+    'team_1_player_2_vy': float,
+    'team_1_player_2_hasDisc': int,
+    'team_1_player_3_x': float,
+    'team_1_player_3_y': float,
+    'team_1_player_3_vx': float,
+    'team_1_player_3_vy': float,
+    'team_1_player_3_hasDisc': int,
+    'team_1_player_4_x': float,
+    'team_1_player_4_y': float,
+    'team_1_player_4_vx': float,
+    'team_1_player_4_vy': float,
+    'team_1_player_4_hasDisc': int,
+    'team_1_player_5_x': float,
+    'team_1_player_5_y': float,
+    'team_1_player_5_vx': float,
+    'team_1_player_5_vy': float,
+    'team_1_player_5_hasDisc': int,
+    'team_1_player_6_x': float,
+    'team_1_player_6_y': float,
+    'team_1_player_6_vx': float,
+    'team_1_player_6_vy': float,
+    'team_1_player_6_hasDisc': int,
+    'action': int,
+    'move_x': 0.0,
+    'move_y': 0.0,
+    'throw_x': 0.0,
+    'throw_y': 0.0,
+    'throw_z': 0.0,
+    'throw_angleOfAttack': 0.0,
+    'throw_tiltAngle': 0.0,
+    'last_action': 0,
+    'last_move_x': 0.0,
+    'last_move_y': 0.0,
+    'last_throw_x': 0.0,
+    'last_throw_y': 0.0,
+    'last_throw_z': 0.0,
+    'last_throw_angleOfAttack': 0.0,
+    'last_throw_tiltAngle': 0.0,
+}
+
+def column_type(column):
+  default = DEFAULTS_MAP[column]
+  return default if isinstance(default, type) else type(default)
+
+def is_required(column):
+  return isinstance(DEFAULTS_MAP[column], type)
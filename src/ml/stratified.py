@@ -0,0 +1,84 @@
+import numpy as np
+import tensorflow as tf
+
+from schema import ACTION_VALUES, STATE_VALUES
+
+# Rebalances a stream of examples by action and game state. Keeps a fixed-size
+# uniform sample (a reservoir) of the examples seen so far for each pair of
+# action and state, and emits batches drawn from the reservoirs at a
+# configured ratio between actions, split evenly between states. Memory is
+# bounded by the reservoir sizes, however skewed the input is.
+
+NUM_STRATA = len(ACTION_VALUES) * len(STATE_VALUES)
+
+def stratum(data):
+  return np.asarray(data['action']) * len(STATE_VALUES) + np.asarray(data['state'])
+
+class Reservoirs:
+  def __init__(self, columns, capacity, seed=None):
+    self.capacity = capacity
+    self.rng = np.random.default_rng(seed)
+    self.seen = np.zeros(NUM_STRATA, dtype=np.int64)
+    self.values = [
+        {c: np.zeros(capacity, dtype=dtype) for c, dtype in columns.items()}
+        for s in range(NUM_STRATA)
+    ]
+
+  def size(self, s):
+    return min(self.seen[s], self.capacity)
+
+  # Adds a batch of examples, as a dict of numpy arrays. Each example replaces
+  # a random slot of a full reservoir with probability capacity / seen, as in
+  # Algorithm R, so every reservoir stays a uniform sample of its stratum.
+  def add(self, data):
+    strata = stratum(data)
+    for s in np.unique(strata):
+      rows = np.nonzero(strata == s)[0]
+      seen = self.seen[s] + np.arange(1, len(rows) + 1)
+      slots = np.where(
+          seen <= self.capacity,
+          seen - 1,
+          (self.rng.random(len(rows)) * seen).astype(np.int64))
+      keep = slots < self.capacity
+      for c, values in self.values[s].items():
+        values[slots[keep]] = data[c][rows[keep]]
+      self.seen[s] += len(rows)
+
+  # Returns a batch drawn from the reservoirs, with 'action_ratio' giving the
+  # relative share of each action. Actions which have not been seen yet are
+  # left out, and the share of each action is split evenly between its states.
+  def sample(self, batch_size, action_ratio):
+    weights = np.zeros(NUM_STRATA)
+    for a, ratio in enumerate(action_ratio):
+      strata = [
+          a * len(STATE_VALUES) + s for s in range(len(STATE_VALUES))
+          if self.seen[a * len(STATE_VALUES) + s]
+      ]
+      for s in strata:
+        weights[s] = ratio / len(strata)
+    counts = self.rng.multinomial(batch_size, weights / weights.sum())
+    batch = {c: [] for c in self.values[0]}
+    for s in np.nonzero(counts)[0]:
+      rows = self.rng.integers(0, self.size(s), counts[s])
+      for c, values in self.values[s].items():
+        batch[c].append(values[rows])
+    return {c: np.concatenate(values) for c, values in batch.items()}
+
+# Returns a dataset of balanced batches of 'batch_size' examples, emitting one
+# for each batch read from 'dataset', a dataset of dicts in the same format as
+# make_csv_dataset.
+def balance(dataset, batch_size, capacity, action_ratio, seed=None):
+  spec = dataset.element_spec
+  columns = {c: s.dtype.as_numpy_dtype for c, s in spec.items()}
+
+  def generate():
+    reservoirs = Reservoirs(columns, capacity, seed)
+    for data in dataset.as_numpy_iterator():
+      reservoirs.add(data)
+      yield reservoirs.sample(batch_size, action_ratio)
+
+  return tf.data.Dataset.from_generator(
+      generate,
+      output_signature={
+          c: tf.TensorSpec((None,), s.dtype) for c, s in spec.items()
+      })
@@ -0,0 +1,365 @@
+import argparse
+import csv
+import functools
+import itertools
+import math
+import multiprocessing
+import os
+import time
+from multiprocessing import shared_memory
+import numpy as np
+import tensorflow as tf
+
+import input_stats
+import inputs
+import train_double_bootstrap as trainer
+import validation
+
+# Sweeps hyperparameters of the cutter and thrower models of
+# train_double_bootstrap.py. The input is decoded, featurized and split into
+# training and validation examples once, into shared memory. Each trial then
+# trains a new model on it in one of a pool of worker processes, which read the
+# examples without copying them, and import TensorFlow once for many trials.
+#
+# Trials train the same way as the trainer: on --train_batches batches of
+# train_batch_size examples, each fit for 'epochs' epochs, validating after
+# each batch and keeping the lowest validation loss. Validation losses are those
+# of the trainer, with its ACTION_WEIGHT, so that trials which train with
+# different action weights can be compared. A trial stops early after
+# --patience batches without a lower loss, or, from --median_stop_batches on,
+# once its lowest loss is worse than the median of the other trials of the same
+# model and batch size after as many batches (the median stopping rule).
+#
+# Writes a table of the results of all trials to --output, as CSV.
+
+MODELS = {
+    trainer.CUTTER_MODEL_DIR: (0, trainer.cutter_labels, len(trainer.CUTTER_MODEL_OUTPUTS)),
+    trainer.THROWER_MODEL_DIR: (1, trainer.thrower_labels, len(trainer.THROWER_MODEL_OUTPUTS)),
+}
+# Hyperparameters of a trial, and the models they apply to.
+PARAMETERS = {
+    'action_weight': [trainer.THROWER_MODEL_DIR],
+    'convolution_channels': list(MODELS),
+    'hidden_units': list(MODELS),
+    'train_batch_size': list(MODELS),
+    'epochs': list(MODELS),
+}
+RESULT_COLUMNS = ['trial', 'model'] + list(PARAMETERS) + [
+    'validation_loss', 'best_batch', 'batches', 'stopped', 'steps_per_second',
+    'wall_seconds',
+]
+# Trials are only stopped by the median stopping rule once this many other
+# trials can be compared with.
+MIN_PEERS = 2
+DECODE_BATCH_SIZE = 10000
+
+# Numpy arrays in one block of shared memory. Workers attach to the block by
+# the name in 'spec', and read views of it without copying.
+class SharedArrays:
+  def __init__(self, arrays=None, spec=None):
+    if arrays is not None:
+      layout = {}
+      size = 0
+      for key, array in arrays.items():
+        layout[key] = (size, array.shape, array.dtype.str)
+        # Aligned to cache lines.
+        size += -(-array.nbytes // 64) * 64
+      self.memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+      self.spec = (self.memory.name, layout)
+    else:
+      self.memory = shared_memory.SharedMemory(name=spec[0])
+      self.spec = spec
+    self.arrays = {
+        key: np.ndarray(shape, dtype, buffer=self.memory.buf, offset=offset)
+        for key, (offset, shape, dtype) in self.spec[1].items()
+    }
+    if arrays is not None:
+      for key, array in arrays.items():
+        self.arrays[key][...] = array
+
+  def close(self, unlink=False):
+    self.arrays = None
+    self.memory.close()
+    if unlink:
+      self.memory.unlink()
+
+# Returns the training and validation examples of each of 'models', as numpy
+# arrays. Each input is decoded and featurized once, even when both models read
+# it, and examples are routed by team_0_player_0_hasDisc as in the trainer.
+def load_examples(flags, models):
+  sources = {}
+  for name in models:
+    filename = flags.input or getattr(flags, name + '_input')
+    sources.setdefault(filename, []).append(name)
+  sizes = {False: flags.train_examples, True: flags.validation_size}
+  examples = {}
+  for filename, names in sources.items():
+    parts = {(name, v): ([], []) for name in names for v in sizes}
+    counts = {key: 0 for key in parts}
+    for data in inputs.example_dataset(
+        filename, DECODE_BATCH_SIZE, shuffle_buffer_size=flags.shuffle_size):
+      features = trainer.batch_raw_inputs(data)
+      in_validation = validation.is_validation(data, flags.validation_fraction)
+      for name in names:
+        has_disc, labels_fn, num_outputs = MODELS[name]
+        labels = labels_fn(data)
+        is_model = tf.equal(data['team_0_player_0_hasDisc'], has_disc)
+        for is_validation in sizes:
+          key = (name, is_validation)
+          if counts[key] >= sizes[is_validation]:
+            continue
+          mask = tf.logical_and(is_model, tf.equal(in_validation, is_validation))
+          parts[key][0].append(tf.boolean_mask(features, mask).numpy())
+          parts[key][1].append(tf.boolean_mask(labels, mask).numpy())
+          counts[key] += len(parts[key][0][-1])
+      if all(counts[key] >= sizes[key[1]] for key in parts):
+        break
+    for (name, is_validation), (features, labels) in parts.items():
+      if not counts[name, is_validation]:
+        raise ValueError('No %s %s examples found in %s' % (
+            name, 'validation' if is_validation else 'training', filename))
+      prefix = name + ('_validation' if is_validation else '')
+      examples[prefix + '_features'] = np.concatenate(features)[:sizes[is_validation]]
+      examples[prefix + '_labels'] = np.concatenate(labels)[:sizes[is_validation]]
+  return examples
+
+# Returns the configs of all trials: the product of the values of each
+# parameter, for each model, leaving out parameters which do not apply to it.
+# With 'random', a random sample of that many of them.
+def trial_configs(flags, seed):
+  configs = []
+  for name in flags.models:
+    values = [
+        getattr(flags, p) if name in models else [None]
+        for p, models in PARAMETERS.items()
+    ]
+    for combination in itertools.product(*values):
+      configs.append(dict(zip(PARAMETERS, combination), model=name))
+  if flags.random and flags.random < len(configs):
+    rng = np.random.default_rng(seed)
+    configs = [configs[i] for i in sorted(rng.choice(len(configs), flags.random, replace=False))]
+  return configs
+
+def parse_hidden_units(value):
+  units = tuple(int(u) for u in value.split(','))
+  if len(units) != len(trainer.HIDDEN_UNITS):
+    raise argparse.ArgumentTypeError('Expected %d comma-separated sizes, found %r' %
+        (len(trainer.HIDDEN_UNITS), value))
+  return units
+
+# Set in each worker process by init_worker.
+shared = None
+configs = None
+settings = None
+
+def init_worker(spec, all_configs, trial_settings, threads):
+  global shared, configs, settings
+  tf.config.threading.set_intra_op_parallelism_threads(threads)
+  shared = SharedArrays(spec=spec)
+  configs = all_configs
+  settings = trial_settings
+
+# Returns whether the lowest validation loss of trial 'index' after 'batch'
+# batches is worse than the median of the other trials of the same model and
+# batch size which got that far.
+def worse_than_median(index, batch):
+  losses = shared.arrays['losses']
+  config = configs[index]
+  peers = [
+      losses[i, batch] for i, c in enumerate(configs)
+      if i != index and c['model'] == config['model']
+      and c['train_batch_size'] == config['train_batch_size']
+      and not np.isnan(losses[i, batch])
+  ]
+  return len(peers) >= MIN_PEERS and losses[index, batch] > np.median(peers)
+
+def run_trial(index):
+  start = time.perf_counter()
+  config = configs[index]
+  name = config['model']
+  tf.keras.utils.set_random_seed(settings['seed'] + index)
+  features = shared.arrays[name + '_features']
+  labels = shared.arrays[name + '_labels']
+  validation_set = (
+      shared.arrays[name + '_validation_features'],
+      shared.arrays[name + '_validation_labels'])
+  losses = shared.arrays['losses']
+
+  model = trainer.ConvolutionModel(
+      MODELS[name][2],
+      input_stats.load_normalization(settings[name + '_input_stats']),
+      channels=config['convolution_channels'],
+      hidden_units=config['hidden_units'])
+  validation_loss_fn = trainer.LOSSES[name]
+  loss_fn = validation_loss_fn if name == trainer.CUTTER_MODEL_DIR else \
+      functools.partial(trainer.thrower_loss, action_weight=config['action_weight'])
+  model.compile(loss=loss_fn, optimizer='adam', jit_compile=settings['jit_compile'])
+
+  batch_size = min(config['train_batch_size'], len(features))
+  best_loss = math.inf
+  best_batch = 0
+  steps = 0
+  fit_seconds = 0.0
+  stopped = ''
+  for batch in range(settings['train_batches']):
+    # Batches are consecutive slices of the shuffled examples, wrapping around.
+    first = batch * batch_size % len(features)
+    rows = slice(first, first + batch_size) if first + batch_size <= len(features) \
+        else np.arange(first, first + batch_size) % len(features)
+    fit_start = time.perf_counter()
+    model.fit(features[rows], labels[rows], epochs=config['epochs'],
+        batch_size=trainer.FIT_BATCH_SIZE, verbose=0)
+    fit_seconds += time.perf_counter() - fit_start
+    steps += config['epochs'] * math.ceil(batch_size / trainer.FIT_BATCH_SIZE)
+    loss = float(tf.reduce_mean(validation_loss_fn(validation_set[1], model.predict(
+        validation_set[0], batch_size=trainer.EVALUATE_BATCH_SIZE, verbose=0))))
+    if loss < best_loss:
+      best_loss = loss
+      best_batch = batch
+    losses[index, batch] = best_loss
+    if settings['patience'] and batch - best_batch >= settings['patience']:
+      stopped = 'patience'
+      break
+    if settings['median_stop_batches'] and batch + 1 >= settings['median_stop_batches'] \
+        and worse_than_median(index, batch):
+      stopped = 'median'
+      break
+  result = dict(config,
+      trial=index,
+      validation_loss=best_loss,
+      best_batch=best_batch + 1,
+      batches=batch + 1,
+      stopped=stopped,
+      steps_per_second=steps / fit_seconds if fit_seconds else None,
+      wall_seconds=time.perf_counter() - start)
+  result['hidden_units'] = ','.join(map(str, config['hidden_units']))
+  return result
+
+def format_value(value):
+  if isinstance(value, float):
+    return '%.5g' % value
+  return '' if value is None else str(value)
+
+def print_table(results):
+  rows = [RESULT_COLUMNS] + [
+      [format_value(r[c]) for c in RESULT_COLUMNS] for r in results
+  ]
+  widths = [max(len(row[i]) for row in rows) for i in range(len(RESULT_COLUMNS))]
+  for row in rows:
+    print('  '.join(v.rjust(w) for v, w in zip(row, widths)))
+
+def main(flags):
+  trials = trial_configs(flags, flags.seed)
+  start = time.perf_counter()
+  examples = load_examples(flags, sorted(set(c['model'] for c in trials)))
+  for key, array in examples.items():
+    if key.endswith('_features'):
+      print('%s: %d examples' % (key[:-len('_features')], len(array)))
+  print('Decoded and featurized the input in %.1fs' % (time.perf_counter() - start))
+  examples['losses'] = np.full((len(trials), flags.train_batches), np.nan)
+
+  workers = min(flags.workers or os.cpu_count() or 1, len(trials))
+  settings = {
+      'seed': flags.seed,
+      'train_batches': flags.train_batches,
+      'patience': flags.patience,
+      'median_stop_batches': flags.median_stop_batches,
+      'jit_compile': flags.jit_compile,
+      'cutter_input_stats': flags.cutter_input_stats,
+      'thrower_input_stats': flags.thrower_input_stats,
+  }
+  threads = flags.intra_op_threads or max(1, (os.cpu_count() or 1) // workers)
+  print('Running %d trials in %d workers' % (len(trials), workers))
+  shared_examples = SharedArrays(examples)
+  del examples
+  results = []
+  try:
+    # Workers are started fresh rather than forked, as TensorFlow is already
+    # running in this process.
+    context = multiprocessing.get_context('spawn')
+    with context.Pool(workers, initializer=init_worker,
+        initargs=(shared_examples.spec, trials, settings, threads)) as pool:
+      for result in pool.imap_unordered(run_trial, range(len(trials))):
+        results.append(result)
+        print('[%d/%d] trial %d (%s): validation loss %.5f after %d batches%s' % (
+            len(results), len(trials), result['trial'], result['model'],
+            result['validation_loss'], result['batches'],
+            ', stopped early (%s)' % result['stopped'] if result['stopped'] else ''))
+  finally:
+    shared_examples.close(unlink=True)
+
+  results.sort(key=lambda r: (r['model'], r['validation_loss']))
+  with open(flags.output, 'w', newline='') as f:
+    writer = csv.DictWriter(f, RESULT_COLUMNS)
+    writer.writeheader()
+    writer.writerows(results)
+  print_table(results)
+  print('Wrote results of %d trials to %s in %.1fs' %
+      (len(results), flags.output, time.perf_counter() - start))
+
+if __name__ == '__main__':
+  parser = argparse.ArgumentParser(
+      description='Sweep hyperparameters of the cutter and thrower models.')
+  parser.add_argument('--cutter_input',
+      help='Input to read cutter examples from, in any of the formats of the trainer.')
+  parser.add_argument('--thrower_input',
+      help='Input to read thrower examples from, in any of the formats of the trainer.')
+  parser.add_argument('--input',
+      help='Input to read both cutter and thrower examples from, instead of ' +
+      '--cutter_input and --thrower_input.')
+  parser.add_argument('--output', required=True, help='CSV file to write results to.')
+  parser.add_argument('--models', nargs='+', default=list(MODELS), choices=list(MODELS),
+      help='Models to sweep');
+  parser.add_argument('--action_weight', nargs='+', type=float,
+      default=[trainer.ACTION_WEIGHT], help='Thrower action loss weights to try');
+  parser.add_argument('--convolution_channels', nargs='+', type=int,
+      default=[trainer.CONVOLUTION_CHANNELS], help='Convolution channels to try');
+  parser.add_argument('--hidden_units', nargs='+', type=parse_hidden_units,
+      default=[tuple(trainer.HIDDEN_UNITS)],
+      help='Hidden layer sizes to try, each as comma-separated sizes of the 3 layers');
+  parser.add_argument('--train_batch_size', nargs='+', type=int, default=[10000],
+      help='Training batch sizes to try');
+  parser.add_argument('--epochs', nargs='+', type=int, default=[10],
+      help='Numbers of epochs to fit each batch for to try');
+  parser.add_argument('--random', default=0, type=int,
+      help='Run this many trials drawn at random from all combinations of the ' +
+      'values above, instead of all of them.');
+  parser.add_argument('--train_batches', default=20, type=int,
+      help='Number of training batches of each trial');
+  parser.add_argument('--train_examples', default=200000, type=int,
+      help='Maximum number of training examples of each model to hold in memory');
+  parser.add_argument('--validation_fraction', default=0.1, type=float,
+      help='Fraction of examples held out for validation, chosen the same way as ' +
+      'in the trainer.');
+  parser.add_argument('--validation_size', default=20000, type=int,
+      help='Maximum number of held out examples to validate each trial on');
+  parser.add_argument('--shuffle_size', default=50000, type=int, help='Shuffle batch size');
+  parser.add_argument('--patience', default=0, type=int,
+      help='Stop a trial after this many training batches without a lower ' +
+      'validation loss. 0 trains on all of --train_batches.');
+  parser.add_argument('--median_stop_batches', default=3, type=int,
+      help='Stop a trial after this many training batches or more, once its ' +
+      'lowest validation loss is worse than the median of the other trials of ' +
+      'the same model and batch size after as many batches. 0 never does.');
+  parser.add_argument('--cutter_input_stats',
+      help='Input statistics from input_stats.py, used to normalize cutter inputs.');
+  parser.add_argument('--thrower_input_stats',
+      help='Input statistics from input_stats.py, used to normalize thrower inputs.');
+  parser.add_argument('--workers', type=int,
+      help='Number of worker processes. Defaults to the number of cores.');
+  parser.add_argument('--intra_op_threads', type=int,
+      help='Threads used within an op by each worker. Defaults to the cores ' +
+      'divided by --workers.');
+  parser.add_argument('--jit_compile', default=False, action='store_true',
+      help='Compile train steps with XLA.');
+  parser.add_argument('--seed', default=0, type=int,
+      help='Seed for sampling trials and for the initial weights of each trial');
+  flags = parser.parse_args()
+  needed = [flags.input] if flags.input else \
+      [getattr(flags, name + '_input') for name in flags.models]
+  if not all(needed):
+    parser.error('Either --input or an input for each of --models is required')
+  if not 0 < flags.validation_fraction < 1:
+    parser.error('Trials are compared by validation loss, which requires a ' +
+        '--validation_fraction between 0 and 1')
+  main(flags)
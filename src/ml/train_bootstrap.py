@@ -1,260 +1,231 @@
 import argparse
+import math
+import time
 import tensorflow as tf
 from tensorflow import keras
 
+import dedup
+import input_stats
+import inputs
+import profiling
+import resume
+import stratified
+import validation
+import workers
+from schema import ACTION_VALUES, BINARY_MODEL_INPUTS, MODEL_INPUTS, \
+    NUMERIC_MODEL_OUTPUTS, ONE_HOT_MODEL_INPUTS, SELECTED_COLUMNS
+
 parser = argparse.ArgumentParser(description='Train a bootstrap model.')
-parser.add_argument('--input', required=True, help='File to read examples from.')
+parser.add_argument('--input', required=True,
+    help='CSV file, frame CSV file, shard directory, or directory or glob pattern of ' +
+    'CSV files with the same columns, to read examples from.')
 parser.add_argument('--output', required=True, help='File to write model to.')
 parser.add_argument('--from_checkpoint', help='Model to load as a starting point.')
 parser.add_argument('--shuffle_size', default=50000, type=int, help='Shuffle batch size');
 parser.add_argument('--train_batches', default=100, type=int, help='Number of training batches');
 parser.add_argument('--train_batch_size', default=10000, type=int, help='Training batch size');
 parser.add_argument('--epochs', default=10, type=int, help='Number of epochs to train');
-flags = parser.parse_args()
+parser.add_argument('--input_mode', default='batch', choices=['batch', 'example'],
+    help='Parse and featurize whole batches at once, or one example at a time.');
+parser.add_argument('--benchmark_input', default=0, type=int,
+    help='Measure input pipeline throughput over this many batches, then exit.');
+parser.add_argument('--input_stats',
+    help='Input statistics from input_stats.py, used to normalize model inputs.');
+parser.add_argument('--validation_fraction', default=0.1, type=float,
+    help='Fraction of examples held out for validation, chosen by a hash of ' +
+    'their values. The model with the lowest validation loss is saved.');
+parser.add_argument('--validation_size', default=20000, type=int,
+    help='Maximum number of held out examples to validate on');
+parser.add_argument('--patience', default=0, type=int,
+    help='Stop after this many training batches without a lower validation ' +
+    'loss. 0 trains on all of --train_batches.');
+parser.add_argument('--resume', default=False, action='store_true',
+    help='Continue from the model, optimizer state and input cursor saved by ' +
+    'the last --resume run with the same --output, training on one pass over ' +
+    'the rows appended to --input since then, however many batches that takes.');
+parser.add_argument('--replay_fraction', default=0.5, type=float,
+    help='With --resume, also train on this many older rows per new row, ' +
+    'sampled at random.');
+parser.add_argument('--workers', default=1, type=int,
+    help='Number of local worker processes to train with, each reading a ' +
+    'different part of the input. Gradients are averaged across workers. ' +
+    'Scaling has only been measured on a single core, where more workers are ' +
+    'slower (720, 713, 529 and 494 examples/sec with 1, 2, 4 and 8 workers); ' +
+    'see the ML TODO in the Readme.');
+parser.add_argument('--intra_op_threads', type=int,
+    help='Threads used within an op. Defaults to the cores divided by --workers.');
+parser.add_argument('--inter_op_threads', type=int, help='Threads used to run ops in parallel');
+parser.add_argument('--reservoir_size', default=0, type=int,
+    help='Train on batches balanced by action and state, drawn from reservoirs ' +
+    'of this many examples per action and state, instead of shuffling the input.');
+parser.add_argument('--action_ratio', default=[1.0] * len(ACTION_VALUES),
+    nargs=len(ACTION_VALUES), type=float,
+    help='Relative share of %s examples in balanced batches' % ', '.join(ACTION_VALUES));
+parser.add_argument('--dedup_window', default=0, type=int,
+    help='Drop examples which are near-duplicates of one of this many preceding ' +
+    'examples in the input, see dedup.py. 0 keeps all examples.');
+parser.add_argument('--dedup_precision', default=dedup.DEFAULT_PRECISION, type=float,
+    help='With --dedup_window, examples are near-duplicates if all their float ' +
+    'columns round to the same multiple of this.');
+parser.add_argument('--tick_stride', default=1, type=int,
+    help='Only read every Nth row of CSV inputs: every Nth tick of frame files, ' +
+    'and of each player in example CSVs.');
+parser.add_argument('--jit_compile', default=False, action='store_true',
+    help='Compile the whole train step with XLA.');
+parser.add_argument('--bfloat16', default=False, action='store_true',
+    help='Compute in bfloat16, keeping variables and outputs in float32.');
+parser.add_argument('--benchmark_steps', default=0, type=int,
+    help='Measure train step time over this many steps, with and without ' +
+    '--jit_compile and --bfloat16, then exit.');
+parser.add_argument('--profile',
+    help='Append the time of each input stage and training batch, examples/sec, ' +
+    'input stall percentage and peak memory to this file, as JSON lines.');
+parser.add_argument('--profile_batches', default=10, type=int,
+    help='Number of batches to time each input stage on, with --profile.');
+parser.add_argument('--profile_trace',
+    help='With --profile, also write a TensorFlow profiler trace of ' +
+    '--profile_trace_steps train steps to this directory, from the second batch on.');
+parser.add_argument('--profile_trace_steps', default=100, type=int,
+    help='Number of train steps to trace, see --profile_trace.');
 
-ACTION_VALUES = ['rest', 'move', 'throw']
 ACTION_WEIGHT = 100
+# Per-worker batch size of model.fit
+FIT_BATCH_SIZE = 32
+EVALUATE_BATCH_SIZE = 1000
 
-MODEL_INPUTS = [
-    'state',
-    'offensiveTeam',
-    'offensiveGoalDirection',
-    'stallCount',
-    'disc_x',
-    'disc_y',
-    'disc_z',
-    'team_0_player_0_x', 'team_0_player_0_y', 'team_0_player_0_vx', 'team_0_player_0_vy', 'team_0_player_0_hasDisc',
-    'team_0_player_1_x', 'team_0_player_1_y', 'team_0_player_1_vx', 'team_0_player_1_vy', 'team_0_player_1_hasDisc',
-    'team_0_player_2_x', 'team_0_player_2_y', 'team_0_player_2_vx', 'team_0_player_2_vy', 'team_0_player_2_hasDisc',
-    'team_0_player_3_x', 'team_0_player_3_y', 'team_0_player_3_vx', 'team_0_player_3_vy', 'team_0_player_3_hasDisc',
-    'team_0_player_4_x', 'team_0_player_4_y', 'team_0_player_4_vx', 'team_0_player_4_vy', 'team_0_player_4_hasDisc',
-    'team_0_player_5_x', 'team_0_player_5_y', 'team_0_player_5_vx', 'team_0_player_5_vy', 'team_0_player_5_hasDisc',
-    'team_0_player_6_x', 'team_0_player_6_y', 'team_0_player_6_vx', 'team_0_player_6_vy', 'team_0_player_6_hasDisc',
-    'team_1_player_0_x', 'team_1_player_0_y', 'team_1_player_0_vx', 'team_1_player_0_vy', 'team_1_player_0_hasDisc',
-    'team_1_player_1_x', 'team_1_player_1_y', 'team_1_player_1_vx', 'team_1_player_1_vy', 'team_1_player_1_hasDisc',
-    'team_1_player_2_x', 'team_1_player_2_y', 'team_1_player_2_vx', 'team_1_player_2_vy', 'team_1_player_2_hasDisc',
-    'team_1_player_3_x', 'team_1_player_3_y', 'team_1_player_3_vx', 'team_1_player_3_vy', 'team_1_player_3_hasDisc',
-    'team_1_player_4_x', 'team_1_player_4_y', 'team_1_player_4_vx', 'team_1_player_4_vy', 'team_1_player_4_hasDisc',
-    'team_1_player_5_x', 'team_1_player_5_y', 'team_1_player_5_vx', 'team_1_player_5_vy', 'team_1_player_5_hasDisc',
-    'team_1_player_6_x', 'team_1_player_6_y', 'team_1_player_6_vx', 'team_1_player_6_vy', 'team_1_player_6_hasDisc',
-    'last_action',
-    'last_move_x',
-    'last_move_y',
-    'last_throw_x',
-    'last_throw_y',
-    'last_throw_z',
-    'last_throw_angleOfAttack',
-    'last_throw_tiltAngle',
-]
-ONE_HOT_MODEL_INPUTS = {
-    'state': ['pickup', 'normal', 'receiving', 'kickoff'],
-    'last_action': ACTION_VALUES,
-}
-BINARY_MODEL_INPUTS = [
-    'offensiveTeam', 'offensiveGoalDirection',
-    'team_0_player_0_hasDisc',
-    'team_0_player_1_hasDisc',
-    'team_0_player_2_hasDisc',
-    'team_0_player_3_hasDisc',
-    'team_0_player_4_hasDisc',
-    'team_0_player_5_hasDisc',
-    'team_0_player_6_hasDisc',
-    'team_1_player_0_hasDisc',
-    'team_1_player_1_hasDisc',
-    'team_1_player_2_hasDisc',
-    'team_1_player_3_hasDisc',
-    'team_1_player_4_hasDisc',
-    'team_1_player_5_hasDisc',
-    'team_1_player_6_hasDisc',
+# Unlike train_double_bootstrap.py, require last_action to be present.
+COLUMN_DEFAULTS = [
+    tf.int32 if c == 'last_action' else inputs.column_default(c)
+    for c in SELECTED_COLUMNS
 ]
 
-NUMERIC_MODEL_OUTPUTS = [
-    'move_x', 'move_y', 'throw_x', 'throw_y', 'throw_z',
-    'throw_angleOfAttack', 'throw_tiltAngle',
-]
-MODEL_OUTPUTS = ['action'] + NUMERIC_MODEL_OUTPUTS
-
-SELECTED_COLUMNS = MODEL_INPUTS + MODEL_OUTPUTS
-
-DEFAULTS_MAP = {
-    'state': tf.int32,
-    'offensiveTeam': tf.int32,
-    'offensiveGoalDirection': tf.int32,
-    'stallCount': tf.float32,
-    'disc_x': tf.float32,
-    'disc_y': tf.float32,
-    'disc_z': tf.float32,
-    'team_0_player_0_x': tf.float32,
-    'team_0_player_0_y': tf.float32,
-    'team_0_player_0_vx': tf.float32,
-    'team_0_player_0_vy': tf.float32,
-    'team_0_player_0_hasDisc': tf.int32,
-    'team_0_player_1_x': tf.float32,
-    'team_0_player_1_y': tf.float32,
-    'team_0_player_1_vx': tf.float32,
-    'team_0_player_1_vy': tf.float32,
-    'team_0_player_1_hasDisc': tf.int32,
-    'team_0_player_2_x': tf.float32,
-    'team_0_player_2_y': tf.float32,
-    'team_0_player_2_vx': tf.float32,
-    'team_0_player_2_vy': tf.float32,
-    'team_0_player_2_hasDisc': tf.int32,
-    'team_0_player_3_x': tf.float32,
-    'team_0_player_3_y': tf.float32,
-    'team_0_player_3_vx': tf.float32,
-    'team_0_player_3_vy': tf.float32,
-    'team_0_player_3_hasDisc': tf.int32,
-    'team_0_player_4_x': tf.float32,
-    'team_0_player_4_y': tf.float32,
-    'team_0_player_4_vx': tf.float32,
-    'team_0_player_4_vy': tf.float32,
-    'team_0_player_4_hasDisc': tf.int32,
-    'team_0_player_5_x': tf.float32,
-    'team_0_player_5_y': tf.float32,
-    'team_0_player_5_vx': tf.float32,
-    'team_0_player_5_vy': tf.float32,
-    'team_0_player_5_hasDisc': tf.int32,
-    'team_0_player_6_x': tf.float32,
-    'team_0_player_6_y': tf.float32,
-    'team_0_player_6_vx': tf.float32,
-    'team_0_player_6_vy': tf.float32,
-    'team_0_player_6_hasDisc': tf.int32,
-    'team_1_player_0_x': tf.float32,
-    'team_1_player_0_y': tf.float32,
-    'team_1_player_0_vx': tf.float32,
-    'team_1_player_0_vy': tf.float32,
-    'team_1_player_0_hasDisc': tf.int32,
-    'team_1_player_1_x': tf.float32,
-    'team_1_player_1_y': tf.float32,
-    'team_1_player_1_vx': tf.float32,
-    'team_1_player_1_vy': tf.float32,
-    'team_1_player_1_hasDisc': tf.int32,
-    'team_1_player_2_x': tf.float32,
-    'team_1_player_2_y': tf.float32,
-    'team_1_player_2_vx': tf.float32,
-    'team_1_player_2_vy': tf.float32,
-    'team_1_player_2_hasDisc': tf.int32,
-    'team_1_player_3_x': tf.float32,
-    'team_1_player_3_y': tf.float32,
-    'team_1_player_3_vx': tf.float32,
-    'team_1_player_3_vy': tf.float32,
-    'team_1_player_3_hasDisc': tf.int32,
-    'team_1_player_4_x': tf.float32,
-    'team_1_player_4_y': tf.float32,
-    'team_1_player_4_vx': tf.float32,
-    'team_1_player_4_vy': tf.float32,
-    'team_1_player_4_hasDisc': tf.int32,
-    'team_1_player_5_x': tf.float32,
-    'team_1_player_5_y': tf.float32,
-    'team_1_player_5_vx': tf.float32,
-    'team_1_player_5_vy': tf.float32,
-    'team_1_player_5_hasDisc': tf.int32,
-    'team_1_player_6_x': tf.float32,
-    'team_1_player_6_y': tf.float32,
-    'team_1_player_6_vx': tf.float32,
-    'team_1_player_6_vy': tf.float32,
-    'team_1_player_6_hasDisc': tf.int32,
-    'action': tf.int32,
-    'move_x': 0.0,
-    'move_y': 0.0,
-    'throw_x': 0.0,
-    'throw_y': 0.0,
-    'throw_z': 0.0,
-    'throw_angleOfAttack': 0.0,
-    'throw_tiltAngle': 0.0,
-    'last_action': tf.int32,
-    'last_move_x': 0.0,
-    'last_move_y': 0.0,
-    'last_throw_x': 0.0,
-    'last_throw_y': 0.0,
-    'last_throw_z': 0.0,
-    'last_throw_angleOfAttack': 0.0,
-    'last_throw_tiltAngle': 0.0,
-}
-COLUMN_DEFAULTS = list(map(lambda c: DEFAULTS_MAP[c], SELECTED_COLUMNS))
+MOVE_OUTPUTS = [c for c in NUMERIC_MODEL_OUTPUTS if c.startswith('move_')]
+THROW_OUTPUTS = [c for c in NUMERIC_MODEL_OUTPUTS if c.startswith('throw_')]
+# Weight of the squared error of each numeric output, by action: the mean over
+# the move outputs on move examples, and over the throw outputs on throw
+# examples. Nothing else counts towards the loss.
+NUMERIC_OUTPUT_WEIGHTS = [[
+    1 / len(MOVE_OUTPUTS) if action == 'move' and c in MOVE_OUTPUTS else
+    1 / len(THROW_OUTPUTS) if action == 'throw' and c in THROW_OUTPUTS else 0
+    for c in NUMERIC_MODEL_OUTPUTS] for action in ACTION_VALUES]
 
+# Cross entropy of the action logits, plus the masked squared error of the
+# numeric outputs. The mask of each example is its one-hot action label times
+# NUMERIC_OUTPUT_WEIGHTS, so the loss is a single fused softmax cross entropy, a
+# matmul and one reduction, and XLA can fuse it into the train step with
+# --jit_compile.
 def prediction_loss(y, y_pred):
-  y_pred = tf.reshape(y_pred, tf.shape(y))
-  action, others = tf.split(y, [len(ACTION_VALUES), len(NUMERIC_MODEL_OUTPUTS)], axis=-1)
-  action_pred, others_pred = \
-      tf.split(y_pred, [len(ACTION_VALUES), len(NUMERIC_MODEL_OUTPUTS)], axis=-1)
+  splits = [len(ACTION_VALUES), len(NUMERIC_MODEL_OUTPUTS)]
+  action, others = tf.split(y, splits, axis=-1)
+  action_logits, others_pred = tf.split(y_pred, splits, axis=-1)
 
-  # Cross entropy loss for categorizing action
-  action_loss = tf.nn.softmax_cross_entropy_with_logits(action, action_pred)
-
-  # MSE loss for numeric parameters (movement, throwing)
-  others_loss = tf.compat.v1.losses.mean_squared_error(others, others_pred)
+  action_loss = tf.nn.softmax_cross_entropy_with_logits(action, action_logits)
+  others_loss = tf.reduce_sum(tf.square(others_pred - others) *
+      tf.matmul(action, NUMERIC_OUTPUT_WEIGHTS), axis=-1)
 
   return action_loss * ACTION_WEIGHT + others_loss
 
-def reload_model(model):
+def reload_model(model, jit_compile=False):
   model.compile(
       loss = prediction_loss,
       optimizer = 'adam',
-      metrics = ['accuracy'],)
+      metrics = ['accuracy'],
+      jit_compile = jit_compile)
   return model
 
+# Sets the compute precision of models built afterwards. Variables are always
+# float32.
+def set_precision(bfloat16):
+  tf.keras.mixed_precision.set_global_policy('mixed_bfloat16' if bfloat16 else 'float32')
+
 class FullyConnectedModel(tf.keras.Model):
-  def __init__(self):
+  def __init__(self, normalization=None):
     super(FullyConnectedModel, self).__init__()
+    # Normalizes raw inputs with (mean, variance) from input_stats.py, if given.
+    self.normalization = tf.keras.layers.Normalization(
+        mean=normalization[0], variance=normalization[1]) if normalization else None
     self.hidden1 = tf.keras.layers.Dense(80, activation='relu')
     self.hidden2 = tf.keras.layers.Dense(60, activation='relu')
-    self.outputAction = tf.keras.layers.Dense(len(ACTION_VALUES), activation='softmax')
+    # Action logits, see prediction_loss.
+    self.outputAction = tf.keras.layers.Dense(len(ACTION_VALUES))
     self.outputNumeric = tf.keras.layers.Dense(len(NUMERIC_MODEL_OUTPUTS))
-    self.outputLayer = tf.keras.layers.Concatenate(axis=1)
+    # Outputs are float32 even when computing in bfloat16, see --bfloat16.
+    self.outputLayer = tf.keras.layers.Concatenate(axis=1, dtype='float32')
 
   def call(self, inputs):
+    if self.normalization:
+      inputs = self.normalization(inputs)
     x = self.hidden1(inputs)
     x = self.hidden2(x)
     return self.outputLayer([
         self.outputAction(x), self.outputNumeric(x)])
 
 PLAYER_LOGITS = 5
+
+# Same as reshaping 'state' to (players * PLAYER_LOGITS, 1), applying
+# 'convolution' with a kernel size and stride of PLAYER_LOGITS and flattening
+# the result, but as a single matmul over all players with the weights of
+# 'convolution'. Avoids dispatching the reshape and flatten ops, and lets XLA
+# fuse the bias and activation into the matmul.
+def player_convolution(convolution, state):
+  kernel = tf.cast(tf.reshape(convolution.kernel, (PLAYER_LOGITS, -1)), state.dtype)
+  bias = tf.cast(convolution.bias, state.dtype)
+  players = tf.reshape(state, (-1, PLAYER_LOGITS))
+  return tf.reshape(
+      convolution.activation(tf.matmul(players, kernel) + bias),
+      (-1, state.shape[1] // PLAYER_LOGITS * convolution.filters))
+
 class ConvolutionModel(tf.keras.Model):
-  def __init__(self):
+  def __init__(self, normalization=None):
     super(ConvolutionModel, self).__init__()
+    # Normalizes raw inputs with (mean, variance) from input_stats.py, if given.
+    self.normalization = tf.keras.layers.Normalization(
+        mean=normalization[0], variance=normalization[1]) if normalization else None
     self.nonConvolutionMerge = tf.keras.layers.Concatenate(axis=1)
     self.nonConvolutionHidden = tf.keras.layers.Dense(20, activation='relu')
-    self.reshapeTeamConvolution = tf.keras.layers.Reshape((PLAYER_LOGITS * 6, 1))
-    self.reshapeEnemyConvolution = tf.keras.layers.Reshape((PLAYER_LOGITS * 7, 1))
     self.teamConvolution = tf.keras.layers.Conv1D(
         4, (PLAYER_LOGITS,), strides = (PLAYER_LOGITS,), activation='relu')
     self.enemyConvolution = tf.keras.layers.Conv1D(
         4, (PLAYER_LOGITS,), strides = (PLAYER_LOGITS,), activation='relu')
-    self.flattenTeamConvolution = tf.keras.layers.Flatten()
-    self.flattenEnemyConvolution = tf.keras.layers.Flatten()
+    # The convolutions are applied by player_convolution, which uses their
+    # weights directly.
+    self.teamConvolution.build((None, PLAYER_LOGITS * 6, 1))
+    self.enemyConvolution.build((None, PLAYER_LOGITS * 7, 1))
     self.mergeConvolution = tf.keras.layers.Concatenate(axis=1)
     self.hidden1 = tf.keras.layers.Dense(30, activation='relu')
     self.hidden2 = tf.keras.layers.Dense(20, activation='relu')
-    self.outputAction = tf.keras.layers.Dense(len(ACTION_VALUES), activation='softmax')
+    # Action logits, see prediction_loss.
+    self.outputAction = tf.keras.layers.Dense(len(ACTION_VALUES))
     self.outputNumeric = tf.keras.layers.Dense(len(NUMERIC_MODEL_OUTPUTS))
-    self.outputLayer = tf.keras.layers.Concatenate(axis=1)
+    # Outputs are float32 even when computing in bfloat16, see --bfloat16.
+    self.outputLayer = tf.keras.layers.Concatenate(axis=1, dtype='float32')
 
   def call(self, inputs, training=False):
+    if self.normalization:
+      inputs = self.normalization(inputs)
     gameState, myState, teamState, enemyState, lastAction = tf.split(
         inputs, [10, PLAYER_LOGITS, 6 * PLAYER_LOGITS, 7 * PLAYER_LOGITS, 10], axis=1)
     a = self.nonConvolutionHidden(
         self.nonConvolutionMerge([gameState, myState, lastAction]))
-    b = self.flattenTeamConvolution(
-        self.teamConvolution(self.reshapeTeamConvolution(teamState)))
-    c = self.flattenEnemyConvolution(
-        self.enemyConvolution(self.reshapeEnemyConvolution(enemyState)))
+    b = player_convolution(self.teamConvolution, teamState)
+    c = player_convolution(self.enemyConvolution, enemyState)
     d = self.hidden1(self.mergeConvolution([a, b, c]))
     e = self.hidden2(d)
     return self.outputLayer([
         self.outputAction(e), self.outputNumeric(e)])
 
-def build_model():
-  model = ConvolutionModel()
+def build_model(jit_compile=False):
+  model = ConvolutionModel(input_stats.load_normalization(flags.input_stats))
 
   model.compile(
       loss = prediction_loss,
       optimizer = 'adam',
-      metrics = ['accuracy'],)
+      metrics = ['accuracy'],
+      jit_compile = jit_compile)
   return model
 
-# Merges input features into a single tensor
-# TODO: normalize inputs
+# Merges input features into a single tensor. Numeric inputs are normalized by
+# the model itself, see --input_stats.
 RAW_INPUTS = sum(len(values) for c, values in ONE_HOT_MODEL_INPUTS.items()) + \
         len(MODEL_INPUTS) - len(ONE_HOT_MODEL_INPUTS)
 RAW_OUTPUTS = len(ACTION_VALUES) + len(NUMERIC_MODEL_OUTPUTS)
@@ -277,28 +248,200 @@ def raw_inputs(data):
         all_inputs.append(data[column])
   return tf.concat(all_inputs, axis = -1)
 
+# Same as raw_inputs, but featurizes a whole batch of examples at once. Runs of
+# consecutive numeric columns are stacked with a single op.
+def batch_raw_inputs(data):
+  all_inputs = []
+  numeric_inputs = []
+  for column in MODEL_INPUTS:
+    if column in ONE_HOT_MODEL_INPUTS:
+      if numeric_inputs:
+        all_inputs.append(tf.stack(numeric_inputs, axis = -1))
+        numeric_inputs = []
+      all_inputs.append(
+          tf.one_hot(data[column], len(ONE_HOT_MODEL_INPUTS[column]), dtype=tf.float32))
+    else:
+      numeric_inputs.append(tf.cast(data[column], tf.float32))
+  if numeric_inputs:
+    all_inputs.append(tf.stack(numeric_inputs, axis = -1))
+  return tf.concat(all_inputs, axis = -1)
+
 def encode_action(value):
   return ['rest', 'move', 'throw'].index(value)
 
+# Labels are built for a whole batch of examples with a single stack, instead of
+# one reshape per column. In example input mode, the batch has size 1.
 def labels(data):
-  #print('*******************')
-  #for col in data.keys():
-  #  print('%s => %s' % (col, data[col].dtype))
-  #print('*******************')
-  one_hot_action = tf.one_hot(data['action'], 3)
-  numeric_labels = []
-  for k in NUMERIC_MODEL_OUTPUTS:
-    numeric_labels.append(tf.reshape(data[k], (1, 1), name=k))
-  return tf.concat([one_hot_action] + numeric_labels, axis=-1)
-
-def input_fn():
-  splitter = lambda data: (raw_inputs(data), labels(data))
-  return tf.data.experimental.make_csv_dataset(
+  return tf.concat([
+      tf.one_hot(data['action'], len(ACTION_VALUES)),
+      tf.stack([data[k] for k in NUMERIC_MODEL_OUTPUTS], axis = -1)], axis = -1)
+
+def input_fn(is_validation=False):
+  splitter = lambda data: (raw_inputs(data), tf.reshape(labels(data), (-1,)))
+  dataset = tf.data.experimental.make_csv_dataset(
+        inputs.input_files(flags.input),
+        batch_size=1,
+        num_epochs=1 if is_validation else None,
+        select_columns = SELECTED_COLUMNS,
+        column_defaults = COLUMN_DEFAULTS
+      )
+  if flags.validation_fraction:
+    dataset = dataset.filter(lambda data: tf.equal(
+        validation.is_validation(data, flags.validation_fraction)[0], is_validation))
+  return dataset.map(splitter).shuffle(flags.shuffle_size)
+
+# Balanced batches are drawn at random from the reservoirs, so the input does
+# not need to be shuffled as well.
+def shuffle_size(is_validation):
+  return 1 if flags.reservoir_size and not is_validation else flags.shuffle_size
+
+# Pairs of input name and dedup.Deduplicator, with --dedup_window.
+deduplicators = []
+
+# Reads, decodes and featurizes examples a whole batch at a time. If 'offsets'
+# are given, reads one pass over the rows between them, see --resume. With
+# --dedup_window, near-duplicates are dropped in file order, before shuffling
+# and before splitting off validation examples.
+def batch_input_fn(is_validation=False, offsets=None):
+  splitter = lambda data: (batch_raw_inputs(data), labels(data))
+  num_workers, index = workers.task()
+  read_shuffle_size = 1 if flags.dedup_window else shuffle_size(is_validation)
+  if offsets:
+    dataset = inputs.appended_dataset(
         flags.input,
+        flags.train_batch_size,
+        *offsets,
+        replay_fraction = flags.replay_fraction,
+        column_defaults = COLUMN_DEFAULTS,
+        shuffle_buffer_size = read_shuffle_size,
+        row_stride = flags.tick_stride)
+  else:
+    dataset = inputs.example_dataset(
+        flags.input,
+        flags.train_batch_size,
+        column_defaults = COLUMN_DEFAULTS,
+        num_epochs = 1 if is_validation else None,
+        shuffle_buffer_size = read_shuffle_size,
+        num_shards = num_workers,
+        shard_index = index,
+        row_stride = flags.tick_stride)
+  if flags.dedup_window:
+    deduplicator = dedup.Deduplicator(flags.dedup_precision, flags.dedup_window)
+    deduplicators.append(('validation' if is_validation else 'model', deduplicator))
+    dataset = deduplicator.dataset(
+        dataset, flags.train_batch_size, shuffle_size(is_validation))
+  if flags.validation_fraction:
+    dataset = dataset.map(
+        lambda data: validation.split(data, flags.validation_fraction, is_validation),
+        num_parallel_calls = tf.data.experimental.AUTOTUNE)
+  if flags.reservoir_size and not is_validation:
+    dataset = stratified.balance(
+        dataset, flags.train_batch_size, flags.reservoir_size, flags.action_ratio)
+  return dataset.map(splitter, num_parallel_calls = tf.data.experimental.AUTOTUNE) \
+      .prefetch(tf.data.experimental.AUTOTUNE)
+
+def training_batches(offsets=None):
+  if flags.input_mode == 'batch':
+    return batch_input_fn(offsets=offsets)
+  return input_fn().batch(flags.train_batch_size)
+
+# Returns held out (features, labels) to validate on.
+def validation_set():
+  if flags.input_mode == 'batch':
+    dataset = batch_input_fn(is_validation=True)
+  else:
+    dataset = input_fn(is_validation=True).batch(flags.train_batch_size)
+  return validation.collect(dataset, flags.validation_size)
+
+def benchmark_input(dataset, num_batches):
+  examples = 0
+  start = time.time()
+  for features, labels in dataset.take(num_batches):
+    examples += features.shape[0]
+  elapsed = time.time() - start
+  print('Read %d examples in %.1fs (%.0f examples/sec, input_mode=%s)' %
+      (examples, elapsed, examples / elapsed, flags.input_mode))
+
+# Times each stage of the input pipeline on its own, see profiling.py.
+def profile_input(profiler):
+  if flags.input_mode == 'batch':
+    decoded = lambda shuffle_size: inputs.example_dataset(
+        flags.input,
+        flags.train_batch_size,
+        column_defaults = COLUMN_DEFAULTS,
+        shuffle_buffer_size = shuffle_size)
+    featurize = lambda data: (batch_raw_inputs(data), labels(data))
+    num_elements = flags.profile_batches
+  else:
+    decoded = lambda shuffle_size: tf.data.experimental.make_csv_dataset(
+        inputs.input_files(flags.input),
         batch_size=1,
+        num_epochs=1,
+        shuffle=False,
         select_columns = SELECTED_COLUMNS,
         column_defaults = COLUMN_DEFAULTS
-      ).map(splitter).shuffle(flags.shuffle_size)
+      ).shuffle(shuffle_size)
+    featurize = lambda data: (raw_inputs(data), tf.reshape(labels(data), (-1,)))
+    num_elements = flags.profile_batches * flags.train_batch_size
+  profiler.input_stages('model', decoded, featurize, flags.shuffle_size, num_elements)
+
+# Number of train steps of fit on a batch of 'examples' examples.
+def fit_steps(examples):
+  if workers.is_worker():
+    examples = flags.train_batch_size
+  return flags.epochs * math.ceil(examples / FIT_BATCH_SIZE)
+
+# Trains on one batch. With several workers, each one trains on its own batch,
+# which must not be split between workers again, and all of them run the same
+# number of steps, as gradients are averaged across workers after each one.
+def fit(model, features, labels):
+  if not workers.is_worker():
+    model.fit(x=features, y=labels, epochs=flags.epochs)
+    return
+  dataset = model.distribute_strategy.distribute_datasets_from_function(
+      lambda context: tf.data.Dataset.from_tensor_slices((features, labels))
+          .repeat()
+          .batch(FIT_BATCH_SIZE))
+  model.fit(dataset, epochs=flags.epochs,
+      steps_per_epoch=math.ceil(flags.train_batch_size / FIT_BATCH_SIZE),
+      verbose=2 if workers.is_chief() else 0)
+
+# Measures the average time of a model.fit step on one batch, for each
+# combination of XLA compilation and compute precision.
+def benchmark_steps(num_steps):
+  features, labels = next(iter(training_batches()))
+  dataset = tf.data.Dataset.from_tensor_slices((features, labels)) \
+      .take(FIT_BATCH_SIZE) \
+      .batch(FIT_BATCH_SIZE) \
+      .cache() \
+      .repeat()
+  for jit_compile in [False, True]:
+    for bfloat16 in [False, True]:
+      set_precision(bfloat16)
+      model = build_model(jit_compile)
+      # The first steps trace and compile the train step.
+      model.fit(dataset, steps_per_epoch=10, verbose=0)
+      start, cpu_start = time.time(), time.process_time()
+      model.fit(dataset, steps_per_epoch=num_steps, verbose=0)
+      elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+      print('jit_compile=%-5s bfloat16=%-5s %.3f ms/step (%.3f ms CPU)' %
+          (jit_compile, bfloat16, elapsed * 1000 / num_steps, cpu * 1000 / num_steps))
+  set_precision(flags.bfloat16)
+
+# Returns the loss on held out examples. With several workers, each one
+# evaluates its own examples, for the same number of steps, and the loss is
+# averaged across workers.
+def evaluate(model, features, labels):
+  if not workers.is_worker():
+    return model.evaluate(x=features, y=labels, batch_size=EVALUATE_BATCH_SIZE,
+        verbose=0, return_dict=True)['loss']
+  dataset = model.distribute_strategy.distribute_datasets_from_function(
+      lambda context: tf.data.Dataset.from_tensor_slices((features, labels))
+          .repeat()
+          .batch(EVALUATE_BATCH_SIZE))
+  return model.evaluate(dataset,
+      steps=math.ceil(flags.validation_size / EVALUATE_BATCH_SIZE),
+      verbose=0, return_dict=True)['loss']
 
 def labels_to_output(logits):
   action_logits, other_logits = \
@@ -320,19 +463,92 @@ def main():
   #  print(labels_to_output(labels))
   #exit(0)
 
+  if flags.benchmark_input:
+    benchmark_input(training_batches(), flags.benchmark_input)
+    return
+
+  if flags.benchmark_steps:
+    benchmark_steps(flags.benchmark_steps)
+    return
+
   # Train using Model
-  if flags.from_checkpoint:
-    model = reload_model(tf.keras.models.load_model(flags.from_checkpoint))
-  else:
-    model = build_model()
+  set_precision(flags.bfloat16)
+  with workers.strategy().scope():
+    if flags.from_checkpoint:
+      model = reload_model(
+          tf.keras.models.load_model(flags.from_checkpoint), flags.jit_compile)
+    else:
+      model = build_model(flags.jit_compile)
 
+  offsets = None
+  if flags.resume:
+    cursors = resume.load_cursors(flags.output)
+    offsets = resume.advance(cursors, flags.input)
+    if offsets[0] == offsets[1]:
+      print('No rows appended to %s since the last run, nothing to train on' %
+          flags.input)
+      return
+    # Builds the model, so that its weights are restored right away, even if
+    # no batch reaches it.
+    model(tf.zeros((1, RAW_INPUTS)))
+    if resume.restore(flags.output, {'model': model}):
+      print('Restored model and optimizer state from %s' %
+          resume.state_directory(flags.output))
+
+  if flags.validation_fraction:
+    validation_features, validation_labels = validation_set()
+    best = validation.BestWeights('model', flags.patience)
+
+  # Only the chief profiles, with several workers.
+  profiler = profiling.Profiler(
+      flags.profile if workers.is_chief() else None,
+      flags.profile_trace,
+      trace_steps = flags.profile_trace_steps)
+  if profiler.enabled:
+    profile_input(profiler)
+
+  examples = 0
+  start = time.time()
+  interrupted = False
+  # With --resume, trains on every appended row, since the cursor is saved past
+  # all of them.
+  dataset = training_batches(offsets)
+  if not flags.resume:
+    dataset = dataset.take(flags.train_batches)
+  batches = profiling.TimedIterator(dataset)
   try:
-    for features, labels in input_fn().batch(flags.train_batch_size).take(flags.train_batches):
-      model.fit(x=features, y=labels, epochs=flags.epochs)
+    for features, labels in batches:
+      profiler.start_chunk(batches.wait)
+      with profiler.fit('model', features.shape[0], fit_steps(features.shape[0])):
+        fit(model, features, labels)
+      examples += features.shape[0]
+      keep_training = True
+      if flags.validation_fraction:
+        with profiler.validate('model'):
+          keep_training = best.update(
+              model, evaluate(model, validation_features, validation_labels))
+      profiler.end_chunk()
+      if not keep_training:
+        break
   except KeyboardInterrupt:
     print('\nTraining stopped.')
+    interrupted = True
+  elapsed = time.time() - start
+  for name, deduplicator in deduplicators:
+    print('[%s] Deduplication %s' % (name, deduplicator.summary()))
+    if profiler.enabled:
+      profiler.log('dedup', model=name, rows=deduplicator.rows, kept=deduplicator.kept)
+  profiler.close()
 
-  model.summary()
+  if flags.validation_fraction:
+    best.restore(model)
+
+  if workers.is_chief():
+    # All workers train on the same number of examples.
+    num_workers = workers.task()[0]
+    print('Trained on %d examples in %.1fs (%.0f examples/sec, workers=%d)' %
+        (examples * num_workers, elapsed, examples * num_workers / elapsed, num_workers))
+    model.summary()
 
   # Predict some examples
   #for features, labels in input_fn().batch(1).take(1):
@@ -340,7 +556,32 @@ def main():
   #  print('prediction: %s %s' % labels_to_output(logits))
   #  print('actual: %s %s' % labels_to_output(labels))
 
-  model.save(flags.output, include_optimizer=False)
+  workers.save_model(model, flags.output, include_optimizer=False)
+  if flags.resume and not interrupted:
+    resume.save(flags.output, {'model': model}, cursors)
 
 if __name__ == '__main__':
+  flags = parser.parse_args()
+  if flags.workers > 1 and not workers.is_worker():
+    if flags.input_mode != 'batch':
+      parser.error('--workers requires --input_mode batch')
+    if flags.resume:
+      parser.error('--resume does not support --workers')
+    exit(workers.launch(flags.workers))
+  if flags.resume and flags.input_mode != 'batch':
+    parser.error('--resume requires --input_mode batch')
+  if flags.resume and flags.patience:
+    parser.error('--resume trains on all appended rows and does not support --patience')
+  if flags.reservoir_size and flags.input_mode != 'batch':
+    parser.error('--reservoir_size requires --input_mode batch')
+  if (flags.dedup_window or flags.tick_stride != 1) and flags.input_mode != 'batch':
+    parser.error('--dedup_window and --tick_stride require --input_mode batch')
+  # Checks the columns of every input file before starting.
+  try:
+    input_files = inputs.input_files(flags.input)
+  except ValueError as e:
+    parser.error(str(e))
+  if flags.resume and len(input_files) > 1:
+    parser.error('--resume requires a single --input file')
+  workers.configure_threads(flags.intra_op_threads, flags.inter_op_threads)
   main()
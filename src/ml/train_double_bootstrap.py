@@ -1,71 +1,106 @@
 import argparse
+import concurrent.futures
+import itertools
+import math
+import time
 import tensorflow as tf
 import os.path
 
+import dedup
+import frames
+import input_stats
+import inputs
+import profiling
+import resume
+import stratified
+import validation
+from schema import ACTION_VALUES, BINARY_MODEL_INPUTS, MODEL_INPUTS, \
+    ONE_HOT_MODEL_INPUTS, SELECTED_COLUMNS
+
 parser = argparse.ArgumentParser(description='Train a bootstrap model.')
-parser.add_argument('--cutter_input', required=True, help='File to read cutter examples from.')
-parser.add_argument('--thrower_input', required=True, help='File to read thrower examples from.')
+parser.add_argument('--cutter_input',
+    help='CSV file, frame CSV file, shard directory, or directory or glob pattern of ' +
+    'CSV files with the same columns, to read cutter examples from.')
+parser.add_argument('--thrower_input',
+    help='Input to read thrower examples from, in any of the formats of --cutter_input.')
+parser.add_argument('--input',
+    help='Input to read both cutter and thrower examples from, in any of the formats ' +
+    'of --cutter_input, instead of --cutter_input and --thrower_input.')
 parser.add_argument('--output', required=True, help='File to write model to.')
 parser.add_argument('--from_checkpoint', help='Model to load as a starting point.')
 parser.add_argument('--shuffle_size', default=50000, type=int, help='Shuffle batch size');
 parser.add_argument('--train_batches', default=100, type=int, help='Number of training batches');
 parser.add_argument('--train_batch_size', default=10000, type=int, help='Training batch size');
 parser.add_argument('--epochs', default=10, type=int, help='Number of epochs to train');
-flags = parser.parse_args()
-
-MODEL_INPUTS = [
-    'state',
-    'offensiveTeam',
-    'offensiveGoalDirection',
-    'stallCount',
-    'disc_x',
-    'disc_y',
-    'disc_z',
-    'team_0_player_0_x', 'team_0_player_0_y', 'team_0_player_0_vx', 'team_0_player_0_vy', 'team_0_player_0_hasDisc',
-    'team_0_player_1_x', 'team_0_player_1_y', 'team_0_player_1_vx', 'team_0_player_1_vy', 'team_0_player_1_hasDisc',
-    'team_0_player_2_x', 'team_0_player_2_y', 'team_0_player_2_vx', 'team_0_player_2_vy', 'team_0_player_2_hasDisc',
-    'team_0_player_3_x', 'team_0_player_3_y', 'team_0_player_3_vx', 'team_0_player_3_vy', 'team_0_player_3_hasDisc',
-    'team_0_player_4_x', 'team_0_player_4_y', 'team_0_player_4_vx', 'team_0_player_4_vy', 'team_0_player_4_hasDisc',
-    'team_0_player_5_x', 'team_0_player_5_y', 'team_0_player_5_vx', 'team_0_player_5_vy', 'team_0_player_5_hasDisc',
-    'team_0_player_6_x', 'team_0_player_6_y', 'team_0_player_6_vx', 'team_0_player_6_vy', 'team_0_player_6_hasDisc',
-    'team_1_player_0_x', 'team_1_player_0_y', 'team_1_player_0_vx', 'team_1_player_0_vy', 'team_1_player_0_hasDisc',
-    'team_1_player_1_x', 'team_1_player_1_y', 'team_1_player_1_vx', 'team_1_player_1_vy', 'team_1_player_1_hasDisc',
-    'team_1_player_2_x', 'team_1_player_2_y', 'team_1_player_2_vx', 'team_1_player_2_vy', 'team_1_player_2_hasDisc',
-    'team_1_player_3_x', 'team_1_player_3_y', 'team_1_player_3_vx', 'team_1_player_3_vy', 'team_1_player_3_hasDisc',
-    'team_1_player_4_x', 'team_1_player_4_y', 'team_1_player_4_vx', 'team_1_player_4_vy', 'team_1_player_4_hasDisc',
-    'team_1_player_5_x', 'team_1_player_5_y', 'team_1_player_5_vx', 'team_1_player_5_vy', 'team_1_player_5_hasDisc',
-    'team_1_player_6_x', 'team_1_player_6_y', 'team_1_player_6_vx', 'team_1_player_6_vy', 'team_1_player_6_hasDisc',
-    'last_action',
-    'last_move_x',
-    'last_move_y',
-    'last_throw_x',
-    'last_throw_y',
-    'last_throw_z',
-    'last_throw_angleOfAttack',
-    'last_throw_tiltAngle',
-]
-ACTION_VALUES = ['rest', 'move', 'throw']
-ONE_HOT_MODEL_INPUTS = {
-    'state': ['pickup', 'normal', 'receiving', 'kickoff'],
-    'last_action': ACTION_VALUES,
-}
-BINARY_MODEL_INPUTS = [
-    'offensiveTeam', 'offensiveGoalDirection',
-    'team_0_player_0_hasDisc',
-    'team_0_player_1_hasDisc',
-    'team_0_player_2_hasDisc',
-    'team_0_player_3_hasDisc',
-    'team_0_player_4_hasDisc',
-    'team_0_player_5_hasDisc',
-    'team_0_player_6_hasDisc',
-    'team_1_player_0_hasDisc',
-    'team_1_player_1_hasDisc',
-    'team_1_player_2_hasDisc',
-    'team_1_player_3_hasDisc',
-    'team_1_player_4_hasDisc',
-    'team_1_player_5_hasDisc',
-    'team_1_player_6_hasDisc',
-]
+parser.add_argument('--input_mode', default='batch', choices=['batch', 'example'],
+    help='Parse and featurize whole batches at once, or one example at a time.');
+parser.add_argument('--benchmark_input', default=0, type=int,
+    help='Measure input pipeline throughput over this many batches, then exit.');
+parser.add_argument('--cutter_input_stats',
+    help='Input statistics from input_stats.py, used to normalize cutter inputs.');
+parser.add_argument('--thrower_input_stats',
+    help='Input statistics from input_stats.py, used to normalize thrower inputs.');
+parser.add_argument('--concurrent', default=False, action='store_true',
+    help='Train the cutter and thrower models concurrently, in separate threads.');
+parser.add_argument('--validation_fraction', default=0.1, type=float,
+    help='Fraction of examples held out for validation, chosen by a hash of ' +
+    'their values. The models with the lowest validation loss are saved.');
+parser.add_argument('--validation_size', default=20000, type=int,
+    help='Maximum number of held out examples to validate each model on');
+parser.add_argument('--patience', default=0, type=int,
+    help='Stop training a model after this many training batches without a ' +
+    'lower validation loss. 0 trains on all of --train_batches.');
+parser.add_argument('--resume', default=False, action='store_true',
+    help='Continue from the models, optimizer state and input cursors saved by ' +
+    'the last --resume run with the same --output, training on one pass over ' +
+    'the rows appended to the inputs since then, however many batches that takes.');
+parser.add_argument('--replay_fraction', default=0.5, type=float,
+    help='With --resume, also train on this many older rows per new row, ' +
+    'sampled at random.');
+parser.add_argument('--reservoir_size', default=0, type=int,
+    help='Train on batches balanced by action and state, drawn from reservoirs ' +
+    'of this many examples per action and state, instead of shuffling the input.');
+parser.add_argument('--action_ratio', default=[1.0] * len(ACTION_VALUES),
+    nargs=len(ACTION_VALUES), type=float,
+    help='Relative share of %s examples in balanced batches' % ', '.join(ACTION_VALUES));
+parser.add_argument('--dedup_window', default=0, type=int,
+    help='Drop examples which are near-duplicates of one of this many preceding ' +
+    'examples in the input, see dedup.py. 0 keeps all examples.');
+parser.add_argument('--dedup_precision', default=dedup.DEFAULT_PRECISION, type=float,
+    help='With --dedup_window, examples are near-duplicates if all their float ' +
+    'columns round to the same multiple of this.');
+parser.add_argument('--tick_stride', default=1, type=int,
+    help='Only read every Nth row of CSV inputs: every Nth tick of frame files, ' +
+    'and of each player in example CSVs.');
+parser.add_argument('--jit_compile', default=False, action='store_true',
+    help='Compile the whole train step with XLA.');
+parser.add_argument('--bfloat16', default=False, action='store_true',
+    help='Compute in bfloat16, keeping variables and outputs in float32.');
+parser.add_argument('--benchmark_steps', default=0, type=int,
+    help='Measure train step time over this many steps, with and without ' +
+    '--jit_compile and --bfloat16, then exit.');
+parser.add_argument('--profile',
+    help='Append the time of each input stage and training batch, examples/sec, ' +
+    'input stall percentage and peak memory to this file, as JSON lines.');
+parser.add_argument('--profile_batches', default=10, type=int,
+    help='Number of batches to time each input stage on, with --profile.');
+parser.add_argument('--profile_trace',
+    help='With --profile, also write a TensorFlow profiler trace of ' +
+    '--profile_trace_steps train steps to this directory, from the second batch on.');
+parser.add_argument('--profile_trace_steps', default=100, type=int,
+    help='Number of train steps to trace, see --profile_trace.');
+parser.add_argument('--ensemble', default=0, type=int,
+    help='Train this many independently initialized cutter and thrower models ' +
+    'together, in one graph, on the same decoded input, and save each pair to ' +
+    '<output>/model-<i>, to seed evolve.js --start_population.');
+parser.add_argument('--bootstrap', default=False, action='store_true',
+    help='With --ensemble, train each model on its own sample of each batch, ' +
+    'drawn with replacement, instead of its own shuffle of it.');
+parser.add_argument('--model', default='convolution',
+    choices=['convolution', 'player_encoder'],
+    help='Kind of cutter and thrower models to train. player_encoder models ' +
+    'take whole frames and predict for all 14 players at once, see ' +
+    'PlayerEncoderModel, and are trained on frame files given as --input.');
 
 CUTTER_MODEL_OUTPUTS = ['move_x', 'move_y']
 THROWER_MODEL_NUMERIC_OUTPUTS = [
@@ -73,205 +108,358 @@ THROWER_MODEL_NUMERIC_OUTPUTS = [
 ]
 THROWER_MODEL_OUTPUTS = ['throw_action'] + THROWER_MODEL_NUMERIC_OUTPUTS
 
-NUMERIC_MODEL_OUTPUTS = [
-    'move_x', 'move_y',
-    'throw_x', 'throw_y', 'throw_z', 'throw_angleOfAttack', 'throw_tiltAngle',
-]
-MODEL_OUTPUTS = ['action'] + NUMERIC_MODEL_OUTPUTS
-
-SELECTED_COLUMNS = MODEL_INPUTS + MODEL_OUTPUTS
-
 CUTTER_MODEL_DIR = 'cutter'
 THROWER_MODEL_DIR = 'thrower'
+# Directory of each model of an --ensemble, under --output.
+ENSEMBLE_MODEL_PREFIX = 'model-'
+
+CUTTER_DEFAULTS = inputs.COLUMN_DEFAULTS
+THROWER_DEFAULTS = inputs.COLUMN_DEFAULTS
 
-DEFAULTS_MAP = {
-    'state': tf.int32,
-    'offensiveTeam': tf.int32,
-    'offensiveGoalDirection': tf.int32,
-    'stallCount': tf.float32,
-    'disc_x': tf.float32,
-    'disc_y': tf.float32,
-    'disc_z': tf.float32,
-    'team_0_player_0_x': tf.float32,
-    'team_0_player_0_y': tf.float32,
-    'team_0_player_0_vx': tf.float32,
-    'team_0_player_0_vy': tf.float32,
-    'team_0_player_0_hasDisc': tf.int32,
-    'team_0_player_1_x': tf.float32,
-    'team_0_player_1_y': tf.float32,
-    'team_0_player_1_vx': tf.float32,
-    'team_0_player_1_vy': tf.float32,
-    'team_0_player_1_hasDisc': tf.int32,
-    'team_0_player_2_x': tf.float32,
-    'team_0_player_2_y': tf.float32,
-    'team_0_player_2_vx': tf.float32,
-    'team_0_player_2_vy': tf.float32,
-    'team_0_player_2_hasDisc': tf.int32,
-    'team_0_player_3_x': tf.float32,
-    'team_0_player_3_y': tf.float32,
-    'team_0_player_3_vx': tf.float32,
-    'team_0_player_3_vy': tf.float32,
-    'team_0_player_3_hasDisc': tf.int32,
-    'team_0_player_4_x': tf.float32,
-    'team_0_player_4_y': tf.float32,
-    'team_0_player_4_vx': tf.float32,
-    'team_0_player_4_vy': tf.float32,
-    'team_0_player_4_hasDisc': tf.int32,
-    'team_0_player_5_x': tf.float32,
-    'team_0_player_5_y': tf.float32,
-    'team_0_player_5_vx': tf.float32,
-    'team_0_player_5_vy': tf.float32,
-    'team_0_player_5_hasDisc': tf.int32,
-    'team_0_player_6_x': tf.float32,
-    'team_0_player_6_y': tf.float32,
-    'team_0_player_6_vx': tf.float32,
-    'team_0_player_6_vy': tf.float32,
-    'team_0_player_6_hasDisc': tf.int32,
-    'team_1_player_0_x': tf.float32,
-    'team_1_player_0_y': tf.float32,
-    'team_1_player_0_vx': tf.float32,
-    'team_1_player_0_vy': tf.float32,
-    'team_1_player_0_hasDisc': tf.int32,
-    'team_1_player_1_x': tf.float32,
-    'team_1_player_1_y': tf.float32,
-    'team_1_player_1_vx': tf.float32,
-    'team_1_player_1_vy': tf.float32,
-    'team_1_player_1_hasDisc': tf.int32,
-    'team_1_player_2_x': tf.float32,
-    'team_1_player_2_y': tf.float32,
-    'team_1_player_2_vx': tf.float32,
-    'team_1_player_2_vy': tf.float32,
-    'team_1_player_2_hasDisc': tf.int32,
-    'team_1_player_3_x': tf.float32,
-    'team_1_player_3_y': tf.float32,
-    'team_1_player_3_vx': tf.float32,
-    'team_1_player_3_vy': tf.float32,
-    'team_1_player_3_hasDisc': tf.int32,
-    'team_1_player_4_x': tf.float32,
-    'team_1_player_4_y': tf.float32,
-    'team_1_player_4_vx': tf.float32,
-    'team_1_player_4_vy': tf.float32,
-    'team_1_player_4_hasDisc': tf.int32,
-    'team_1_player_5_x': tf.float32,
-    'team_1_player_5_y': tf.float32,
-    'team_1_player_5_vx': tf.float32,
-    'team_1_player_5_vy': tf.float32,
-    'team_1_player_5_hasDisc': tf.int32,
-    'team_1_player_6_x': tf.float32,
-    'team_1_player_6_y': tf.float32,
-    'team_1_player_6_vx': tf.float32,
-    'team_1_player_6_vy': tf.float32,
-    'team_1_player_6_hasDisc': tf.int32,
-    'action': tf.int32,
-    'move_x': 0.0,
-    'move_y': 0.0,
-    'throw_x': 0.0,
-    'throw_y': 0.0,
-    'throw_z': 0.0,
-    'throw_angleOfAttack': 0.0,
-    'throw_tiltAngle': 0.0,
-    'last_action': 0,
-    'last_move_x': 0.0,
-    'last_move_y': 0.0,
-    'last_throw_x': 0.0,
-    'last_throw_y': 0.0,
-    'last_throw_z': 0.0,
-    'last_throw_angleOfAttack': 0.0,
-    'last_throw_tiltAngle': 0.0,
-}
-CUTTER_DEFAULTS = list(map(lambda c: DEFAULTS_MAP[c], SELECTED_COLUMNS))
-THROWER_DEFAULTS = list(map(lambda c: DEFAULTS_MAP[c], SELECTED_COLUMNS))
+# Input read by example_batches, by team_0_player_0_hasDisc.
+INPUT_NAMES = {0: CUTTER_MODEL_DIR, 1: THROWER_MODEL_DIR, None: 'shared'}
+# Pairs of input name and dedup.Deduplicator, with --dedup_window.
+deduplicators = []
 
 ACTION_WEIGHT = 50
-def thrower_loss(y, y_pred):
-  y_pred = tf.reshape(y_pred, tf.shape(y))
+# Batch size of model.fit
+FIT_BATCH_SIZE = 32
+EVALUATE_BATCH_SIZE = 1000
 
-  action, params = tf.split(y, [1, 5], axis=-1)
-  action_pred, params_pred = tf.split(y_pred, [1, 5], axis=-1)
+# The cutter labels are whether the example is a move, then the move outputs.
+# Only move examples count towards the loss.
+def cutter_loss(y, y_pred):
+  is_move, move = tf.split(y, [1, len(CUTTER_MODEL_OUTPUTS)], axis=-1)
+  return tf.reduce_mean(tf.square(y_pred - move), axis=-1) * is_move[:, 0]
 
-  # Binary crossentropy loss for throw action
-  # MSE loss for numeric parameters
-  return tf.keras.losses.binary_crossentropy(action, action_pred) * ACTION_WEIGHT \
-      + tf.compat.v1.losses.mean_squared_error(params, params_pred)
+# The first thrower output is the logit of throwing. The throw parameters only
+# count towards the loss on throw examples.
+def thrower_loss(y, y_pred, action_weight=ACTION_WEIGHT):
+  action, params = tf.split(y, [1, len(THROWER_MODEL_NUMERIC_OUTPUTS)], axis=-1)
+  action_logit, params_pred = \
+      tf.split(y_pred, [1, len(THROWER_MODEL_NUMERIC_OUTPUTS)], axis=-1)
+
+  action_loss = tf.nn.sigmoid_cross_entropy_with_logits(action, action_logit)[:, 0]
+  params_loss = tf.reduce_mean(tf.square(params_pred - params), axis=-1) * action[:, 0]
+  return action_loss * action_weight + params_loss
 
 class FullyConnectedModel(tf.keras.Model):
-  def __init__(self, num_outputs):
+  def __init__(self, num_outputs, normalization=None):
     super(FullyConnectedModel, self).__init__()
+    # Normalizes raw inputs with (mean, variance) from input_stats.py, if given.
+    self.normalization = tf.keras.layers.Normalization(
+        mean=normalization[0], variance=normalization[1]) if normalization else None
     self.hidden1 = tf.keras.layers.Dense(80, activation='relu')
     self.hidden2 = tf.keras.layers.Dense(60, activation='relu')
-    self.outputAction = tf.keras.layers.Dense(len(ACTION_VALUES), activation='softmax')
-    self.outputNumeric = tf.keras.layers.Dense(num_outputs)
-    self.outputLayer = tf.keras.layers.Concatenate(axis=1)
+    # Same outputs as ConvolutionModel, see cutter_loss and thrower_loss.
+    # Outputs are float32 even when computing in bfloat16, see --bfloat16.
+    self.outputLayer = tf.keras.layers.Dense(num_outputs, dtype='float32')
 
   def call(self, inputs):
+    if self.normalization:
+      inputs = self.normalization(inputs)
     x = self.hidden1(inputs)
     x = self.hidden2(x)
-    return self.outputLayer([
-        self.outputAction(x), self.outputNumeric(x)])
+    return self.outputLayer(x)
 
 PLAYER_LOGITS = 5
 CONVOLUTION_CHANNELS = 10
+# Units of the hidden layers after the convolutions.
+HIDDEN_UNITS = [80, 60, 30]
+
+# Same as reshaping 'state' to (players * PLAYER_LOGITS, 1), applying
+# 'convolution' with a kernel size and stride of PLAYER_LOGITS and flattening
+# the result, but as a single matmul over all players with the weights of
+# 'convolution'.
+def player_convolution(convolution, state):
+  kernel = tf.cast(tf.reshape(convolution.kernel, (PLAYER_LOGITS, -1)), state.dtype)
+  bias = tf.cast(convolution.bias, state.dtype)
+  players = tf.reshape(state, (-1, PLAYER_LOGITS))
+  return tf.reshape(
+      convolution.activation(tf.matmul(players, kernel) + bias),
+      (-1, state.shape[1] // PLAYER_LOGITS * convolution.filters))
+
+# Takes the number of convolution channels and hidden units as parameters, so
+# that sweep.py can vary them.
 class ConvolutionModel(tf.keras.Model):
-  def __init__(self, num_outputs):
+  def __init__(self, num_outputs, normalization=None, channels=CONVOLUTION_CHANNELS,
+      hidden_units=HIDDEN_UNITS):
     super(ConvolutionModel, self).__init__()
+    # Normalizes raw inputs with (mean, variance) from input_stats.py, if given.
+    self.normalization = tf.keras.layers.Normalization(
+        mean=normalization[0], variance=normalization[1]) if normalization else None
     self.nonConvolutionMerge = tf.keras.layers.Concatenate(axis=1)
     self.nonConvolutionHidden = tf.keras.layers.Dense(20, activation='relu')
-    self.reshapeTeamConvolution = tf.keras.layers.Reshape((PLAYER_LOGITS * 6, 1))
-    self.reshapeEnemyConvolution = tf.keras.layers.Reshape((PLAYER_LOGITS * 7, 1))
     self.teamConvolution = tf.keras.layers.Conv1D(
-        CONVOLUTION_CHANNELS,
+        channels,
         (PLAYER_LOGITS,),
         strides=(PLAYER_LOGITS,),
         activation='relu')
     self.enemyConvolution = tf.keras.layers.Conv1D(
-        CONVOLUTION_CHANNELS,
+        channels,
         (PLAYER_LOGITS,),
         strides=(PLAYER_LOGITS,),
         activation='relu')
-    self.flattenTeamConvolution = tf.keras.layers.Flatten()
-    self.flattenEnemyConvolution = tf.keras.layers.Flatten()
+    # The convolutions are applied by player_convolution, which uses their
+    # weights directly.
+    self.teamConvolution.build((None, PLAYER_LOGITS * 6, 1))
+    self.enemyConvolution.build((None, PLAYER_LOGITS * 7, 1))
     self.mergeConvolution = tf.keras.layers.Concatenate(axis=1)
-    self.hidden1 = tf.keras.layers.Dense(80, activation='relu')
-    self.hidden2 = tf.keras.layers.Dense(60, activation='relu')
-    self.hidden3 = tf.keras.layers.Dense(30)
-    self.outputLayer = tf.keras.layers.Dense(num_outputs);
+    self.hidden1 = tf.keras.layers.Dense(hidden_units[0], activation='relu')
+    self.hidden2 = tf.keras.layers.Dense(hidden_units[1], activation='relu')
+    self.hidden3 = tf.keras.layers.Dense(hidden_units[2])
+    # Outputs are float32 even when computing in bfloat16, see --bfloat16.
+    self.outputLayer = tf.keras.layers.Dense(num_outputs, dtype='float32');
 
   def call(self, inputs, training=False):
+    if self.normalization:
+      inputs = self.normalization(inputs)
     gameState, myState, teamState, enemyState, lastAction = tf.split(
         inputs, [10, PLAYER_LOGITS, 6 * PLAYER_LOGITS, 7 * PLAYER_LOGITS, 10], axis=1)
     a = self.nonConvolutionHidden(
         self.nonConvolutionMerge([gameState, myState, lastAction]))
-    b = self.flattenTeamConvolution(
-        self.teamConvolution(self.reshapeTeamConvolution(teamState)))
-    c = self.flattenEnemyConvolution(
-        self.enemyConvolution(self.reshapeEnemyConvolution(enemyState)))
+    b = player_convolution(self.teamConvolution, teamState)
+    c = player_convolution(self.enemyConvolution, enemyState)
     d = self.hidden1(self.mergeConvolution([a, b, c]))
     e = self.hidden2(d)
     f = self.hidden3(e)
     return self.outputLayer(f)
 
-def build_cutter_model():
-  model = ConvolutionModel(2)
-  model.compile(loss = tf.keras.losses.MeanSquaredError(), optimizer = 'adam', metrics =
-      ['accuracy'])
+PLAYER_EMBEDDING_UNITS = 16
+# Offset of the state of team_0_player_0 in raw inputs.
+MY_STATE_OFFSET = 10
+
+# Predicts for all 14 players of a frame at once. Takes stacked frames, see
+# frames.stack_frames, and returns outputs of shape [frames, 14, num_outputs],
+# one for each of frames.PERSPECTIVES. The absolute state of every player is
+# encoded once per frame by the same layers, and each perspective sees the sum
+# of the encodings of its teammates and of its opponents, which does not depend
+# on the order of the players, instead of the offset state of every player as
+# in ConvolutionModel. The rest of the inputs of each perspective are the same
+# raw inputs as ConvolutionModel takes.
+class PlayerEncoderModel(tf.keras.Model):
+  def __init__(self, num_outputs, normalization=None,
+      embedding_units=PLAYER_EMBEDDING_UNITS, hidden_units=HIDDEN_UNITS):
+    # Frames are permuted and offset in float32, even when computing in
+    # bfloat16, see --bfloat16.
+    super(PlayerEncoderModel, self).__init__(autocast=False)
+    # Normalizes raw inputs with (mean, variance) from input_stats.py, if given.
+    # The state of team_0_player_0 is not offset, so its statistics are also
+    # used for the absolute state of every player.
+    self.normalization = tf.keras.layers.Normalization(
+        mean=normalization[0], variance=normalization[1]) if normalization else None
+    self.playerNormalization = tf.keras.layers.Normalization(
+        mean=normalization[0][MY_STATE_OFFSET:MY_STATE_OFFSET + PLAYER_LOGITS],
+        variance=normalization[1][MY_STATE_OFFSET:MY_STATE_OFFSET + PLAYER_LOGITS]) \
+        if normalization else None
+    self.playerHidden = tf.keras.layers.Dense(20, activation='relu')
+    self.playerEmbedding = tf.keras.layers.Dense(embedding_units, activation='relu')
+    self.nonPlayerMerge = tf.keras.layers.Concatenate(axis=-1)
+    self.nonPlayerHidden = tf.keras.layers.Dense(20, activation='relu')
+    self.mergeEmbeddings = tf.keras.layers.Concatenate(axis=-1)
+    self.hidden1 = tf.keras.layers.Dense(hidden_units[0], activation='relu')
+    self.hidden2 = tf.keras.layers.Dense(hidden_units[1], activation='relu')
+    self.hidden3 = tf.keras.layers.Dense(hidden_units[2])
+    # Outputs are float32 even when computing in bfloat16, see --bfloat16.
+    self.outputLayer = tf.keras.layers.Dense(num_outputs, dtype='float32')
+
+  def call(self, inputs, training=False):
+    perspectives = len(frames.PERSPECTIVES)
+    examples = tf.reshape(frames.permute(inputs), (-1, len(SELECTED_COLUMNS)))
+    raw = tf.reshape(
+        batch_raw_inputs(frames.to_columns(examples)), (-1, perspectives, RAW_INPUTS))
+    if self.normalization:
+      raw = self.normalization(raw)
+    gameState, myState, _, _, lastAction = tf.split(
+        raw, [10, PLAYER_LOGITS, 6 * PLAYER_LOGITS, 7 * PLAYER_LOGITS, 10], axis=-1)
+
+    # Players of shape [frames, 2, 7, PLAYER_LOGITS], by team and number.
+    players = tf.gather(inputs, frames.PLAYER_INDICES, axis=1)
+    if self.playerNormalization:
+      players = self.playerNormalization(players)
+    embeddings = self.playerEmbedding(self.playerHidden(players))
+    totals = tf.reduce_sum(embeddings, axis=2, keepdims=True)
+    # Perspectives are in the same order as the players, team by team.
+    shape = (-1, perspectives, embeddings.shape[-1])
+    team = tf.reshape(totals - embeddings, shape)
+    enemy = tf.reshape(
+        tf.broadcast_to(tf.reverse(totals, axis=[1]), tf.shape(embeddings)), shape)
+
+    a = self.nonPlayerHidden(self.nonPlayerMerge([gameState, myState, lastAction]))
+    d = self.hidden1(self.mergeEmbeddings([a, team, enemy]))
+    e = self.hidden2(d)
+    f = self.hidden3(e)
+    return self.outputLayer(f)
+
+# Dense layer of each member of an ensemble, with the kernels and biases of all
+# members stacked. Maps inputs of shape [batch, members, features] to [batch,
+# members, units], with a single batched matmul.
+class StackedDense(tf.keras.layers.Layer):
+  def __init__(self, members, units, activation=None, **kwargs):
+    super(StackedDense, self).__init__(**kwargs)
+    self.members = members
+    self.units = units
+    self.activation = tf.keras.activations.get(activation)
+
+  def build(self, input_shape):
+    # Each member is initialized the same way as a Dense layer on its own, with
+    # an initializer of its own, as an unseeded initializer returns the same
+    # values every time it is called.
+    self.kernel = self.add_weight(
+        'kernel',
+        shape=(self.members, input_shape[-1], self.units),
+        initializer=lambda shape, dtype: tf.stack([
+            tf.keras.initializers.GlorotUniform()(shape[1:], dtype)
+            for i in range(shape[0])
+        ]))
+    self.bias = self.add_weight('bias', shape=(self.members, self.units),
+        initializer='zeros')
+
+  def call(self, inputs):
+    return self.activation(tf.einsum('bki,kio->bko', inputs, self.kernel) + self.bias)
+
+# Same as player_convolution, for each member of an ensemble, with the weights
+# of a StackedDense layer.
+def stacked_player_convolution(convolution, state):
+  members, players = state.shape[1], state.shape[2] // PLAYER_LOGITS
+  outputs = tf.einsum('bkpi,kio->bkpo',
+      tf.reshape(state, (-1, members, players, PLAYER_LOGITS)), convolution.kernel)
+  return tf.reshape(
+      convolution.activation(outputs + convolution.bias[:, tf.newaxis, :]),
+      (-1, members, players * convolution.units))
+
+# 'members' independently initialized ConvolutionModels, trained together in one
+# graph. Takes inputs of shape [batch, members, RAW_INPUTS], one example for
+# each member, or [batch, RAW_INPUTS] to give all members the same examples,
+# and returns outputs of shape [batch, members, num_outputs]. Layers have the
+# same names as in ConvolutionModel, see member_model.
+class StackedConvolutionModel(tf.keras.Model):
+  def __init__(self, members, num_outputs, normalization=None):
+    super(StackedConvolutionModel, self).__init__()
+    self.members = members
+    self.num_outputs = num_outputs
+    self.normalization = tf.keras.layers.Normalization(
+        mean=normalization[0], variance=normalization[1]) if normalization else None
+    self.nonConvolutionMerge = tf.keras.layers.Concatenate(axis=-1)
+    self.nonConvolutionHidden = StackedDense(members, 20, activation='relu')
+    self.teamConvolution = StackedDense(members, CONVOLUTION_CHANNELS, activation='relu')
+    self.enemyConvolution = StackedDense(members, CONVOLUTION_CHANNELS, activation='relu')
+    self.teamConvolution.build((None, members, PLAYER_LOGITS))
+    self.enemyConvolution.build((None, members, PLAYER_LOGITS))
+    self.mergeConvolution = tf.keras.layers.Concatenate(axis=-1)
+    self.hidden1 = StackedDense(members, HIDDEN_UNITS[0], activation='relu')
+    self.hidden2 = StackedDense(members, HIDDEN_UNITS[1], activation='relu')
+    self.hidden3 = StackedDense(members, HIDDEN_UNITS[2])
+    self.outputLayer = StackedDense(members, num_outputs, dtype='float32')
+
+  def call(self, inputs, training=False):
+    if inputs.shape.rank == 2:
+      inputs = tf.tile(inputs[:, tf.newaxis, :], (1, self.members, 1))
+    if self.normalization:
+      inputs = self.normalization(inputs)
+    gameState, myState, teamState, enemyState, lastAction = tf.split(
+        inputs, [10, PLAYER_LOGITS, 6 * PLAYER_LOGITS, 7 * PLAYER_LOGITS, 10], axis=-1)
+    a = self.nonConvolutionHidden(
+        self.nonConvolutionMerge([gameState, myState, lastAction]))
+    b = stacked_player_convolution(self.teamConvolution, teamState)
+    c = stacked_player_convolution(self.enemyConvolution, enemyState)
+    d = self.hidden1(self.mergeConvolution([a, b, c]))
+    e = self.hidden2(d)
+    f = self.hidden3(e)
+    return self.outputLayer(f)
+
+STACKED_LAYERS = [
+    'nonConvolutionHidden', 'teamConvolution', 'enemyConvolution',
+    'hidden1', 'hidden2', 'hidden3', 'outputLayer',
+]
+
+# Returns member 'index' of a StackedConvolutionModel as a ConvolutionModel.
+def member_model(stacked, index, normalization=None):
+  model = ConvolutionModel(stacked.num_outputs, normalization)
+  model(tf.zeros((1, RAW_INPUTS)))
+  for name in STACKED_LAYERS:
+    layer = getattr(model, name)
+    kernel, bias = getattr(stacked, name).get_weights()
+    layer.set_weights([kernel[index].reshape(layer.kernel.shape), bias[index]])
   return model
 
-def reload_cutter_model(model):
-  model.compile(loss = tf.keras.losses.MeanSquaredError(), optimizer = 'adam', metrics =
-      ['accuracy'])
+# The weights of one member of a StackedConvolutionModel, with the same
+# get_weights and set_weights as a model, for validation.BestWeights.
+class StackedMember:
+  def __init__(self, model, index):
+    self.model = model
+    self.index = index
+
+  def get_weights(self):
+    return [v[self.index].numpy() for v in self.model.trainable_variables]
+
+  def set_weights(self, weights):
+    for variable, value in zip(self.model.trainable_variables, weights):
+      variable[self.index].assign(value)
+
+# Applies 'loss_fn' to the outputs of each member, summing over members, so
+# that each member gets the same gradients as if it was trained on its own.
+def stacked_loss(loss_fn):
+  def loss(y, y_pred):
+    members = tf.shape(y_pred)[1]
+    losses = loss_fn(
+        tf.reshape(y, (-1, y.shape[-1])), tf.reshape(y_pred, (-1, y_pred.shape[-1])))
+    return tf.reduce_sum(tf.reshape(losses, (-1, members)), axis=-1)
+  return loss
+
+# Applies 'loss_fn' to the outputs of a PlayerEncoderModel for each perspective
+# of a frame, keeping only the perspectives the model predicts for, given by the
+# first label column, see frame_labels. Sums over perspectives, so that each of
+# them counts the same as an example of its own.
+def perspective_loss(loss_fn):
+  def loss(y, y_pred):
+    mask, labels = tf.split(y, [1, y.shape[-1] - 1], axis=-1)
+    losses = loss_fn(
+        tf.reshape(labels, (-1, labels.shape[-1])), tf.reshape(y_pred, (-1, y_pred.shape[-1])))
+    return tf.reduce_sum(tf.reshape(losses, tf.shape(mask)[:2]) * mask[..., 0], axis=-1)
+  return loss
+
+# Returns the loss to train a model of the kind given by --model with.
+def model_loss(loss_fn):
+  return perspective_loss(loss_fn) if flags.model == 'player_encoder' else loss_fn
+
+# Returns a new model of the kind given by --model.
+def new_model(num_outputs, input_stats_file):
+  normalization = input_stats.load_normalization(input_stats_file)
+  if flags.model == 'player_encoder':
+    return PlayerEncoderModel(num_outputs, normalization)
+  return ConvolutionModel(num_outputs, normalization)
+
+def build_stacked_model(num_outputs, loss_fn, input_stats_file, jit_compile=False):
+  model = StackedConvolutionModel(
+      flags.ensemble, num_outputs, input_stats.load_normalization(input_stats_file))
+  model.compile(loss = stacked_loss(loss_fn), optimizer = 'adam',
+      jit_compile = jit_compile)
   return model
 
-def build_thrower_model():
-  model = ConvolutionModel(6)
-  model.compile(loss = thrower_loss, optimizer = 'adam', metrics = ['accuracy'])
+def build_cutter_model(jit_compile=False):
+  return reload_cutter_model(new_model(2, flags.cutter_input_stats), jit_compile)
+
+def reload_cutter_model(model, jit_compile=False):
+  model.compile(loss = model_loss(cutter_loss), optimizer = 'adam',
+      jit_compile = jit_compile)
   return model
 
-def reload_thrower_model(model):
-  model.compile(loss = thrower_loss, optimizer = 'adam', metrics = ['accuracy'])
+def build_thrower_model(jit_compile=False):
+  return reload_thrower_model(new_model(6, flags.thrower_input_stats), jit_compile)
+
+def reload_thrower_model(model, jit_compile=False):
+  model.compile(loss = model_loss(thrower_loss), optimizer = 'adam',
+      metrics = ['accuracy'], jit_compile = jit_compile)
   return model
 
-# Merges input features into a single tensor
-# TODO: normalize inputs
+# Sets the compute precision of models built afterwards. Variables are always
+# float32.
+def set_precision(bfloat16):
+  tf.keras.mixed_precision.set_global_policy('mixed_bfloat16' if bfloat16 else 'float32')
+
+# Merges input features into a single tensor. Numeric inputs are normalized by
+# the model itself, see --input_stats.
 RAW_INPUTS = sum(len(values) for c, values in ONE_HOT_MODEL_INPUTS.items()) + \
         len(MODEL_INPUTS) - len(ONE_HOT_MODEL_INPUTS)
 
@@ -293,62 +481,515 @@ def raw_inputs(data):
         all_inputs.append(data[column])
   return tf.concat(all_inputs, axis = -1)
 
+# Same as raw_inputs, but featurizes a whole batch of examples at once. Runs of
+# consecutive numeric columns are stacked with a single op.
+def batch_raw_inputs(data):
+  all_inputs = []
+  numeric_inputs = []
+  for column in MODEL_INPUTS:
+    if column in ONE_HOT_MODEL_INPUTS:
+      if numeric_inputs:
+        all_inputs.append(tf.stack(numeric_inputs, axis = -1))
+        numeric_inputs = []
+      all_inputs.append(
+          tf.one_hot(data[column], len(ONE_HOT_MODEL_INPUTS[column]), dtype=tf.float32))
+    else:
+      numeric_inputs.append(tf.cast(data[column], tf.float32))
+  if numeric_inputs:
+    all_inputs.append(tf.stack(numeric_inputs, axis = -1))
+  return tf.concat(all_inputs, axis = -1)
+
 def encode_action(value):
   return ['rest', 'move', 'throw'].index(value)
 
+# Labels are built for a whole batch of examples with a single stack, instead of
+# one reshape and concat per column. In example input mode, the batch has size 1.
 def cutter_labels(data):
-  numeric_labels = []
-  for k in CUTTER_MODEL_OUTPUTS:
-    numeric_labels.append(tf.reshape(data[k], (1,), name=k))
-  return tf.concat(numeric_labels, axis=-1)
+  is_move = tf.cast(tf.equal(data['action'], ACTION_VALUES.index('move')), tf.float32)
+  return tf.stack([is_move] + [data[k] for k in CUTTER_MODEL_OUTPUTS], axis = -1)
 
 def thrower_labels(data):
-  throw_action = tf.map_fn(
-      lambda action: 1.0 if action == ACTION_VALUES.index('throw') else 0.0,
-      data['action'],
-      dtype = tf.float32)
-  numeric_labels = []
-  for k in THROWER_MODEL_NUMERIC_OUTPUTS:
-    numeric_labels.append(tf.reshape(data[k], (1,), name=k))
-  return tf.concat([throw_action] + numeric_labels, axis=-1)
-  return tf.concat(numeric_labels, axis=-1)
-
-def cutter_input_fn():
-  splitter = lambda data: (raw_inputs(data), cutter_labels(data))
-  return tf.data.experimental.make_csv_dataset(
-        flags.cutter_input,
+  throw_action = tf.cast(
+      tf.equal(data['action'], ACTION_VALUES.index('throw')), tf.float32)
+  return tf.stack(
+      [throw_action] + [data[k] for k in THROWER_MODEL_NUMERIC_OUTPUTS], axis = -1)
+
+# Keeps only examples in the validation split, or only the ones not in it.
+def split_example(dataset, is_validation):
+  if not flags.validation_fraction:
+    return dataset
+  return dataset.filter(lambda data: tf.equal(
+      validation.is_validation(data, flags.validation_fraction)[0], is_validation))
+
+def cutter_input_fn(is_validation=False):
+  splitter = lambda data: (raw_inputs(data), tf.reshape(cutter_labels(data), (-1,)))
+  return split_example(tf.data.experimental.make_csv_dataset(
+        inputs.input_files(flags.cutter_input),
         batch_size=1,
+        num_epochs=1,
         select_columns = SELECTED_COLUMNS,
         column_defaults = CUTTER_DEFAULTS
-      ).map(splitter).shuffle(flags.shuffle_size)
+      ), is_validation).map(splitter).shuffle(flags.shuffle_size)
 
-def thrower_input_fn():
-  splitter = lambda data: (raw_inputs(data), thrower_labels(data))
-  return tf.data.experimental.make_csv_dataset(
-        flags.thrower_input,
+def thrower_input_fn(is_validation=False):
+  splitter = lambda data: (raw_inputs(data), tf.reshape(thrower_labels(data), (-1,)))
+  return split_example(tf.data.experimental.make_csv_dataset(
+        inputs.input_files(flags.thrower_input),
         batch_size=1,
+        num_epochs=1,
         select_columns = SELECTED_COLUMNS,
         column_defaults = THROWER_DEFAULTS
-      ).map(splitter).shuffle(flags.shuffle_size)
+      ), is_validation).map(splitter).shuffle(flags.shuffle_size)
+
+# Reads examples a whole batch at a time, keeping only the ones in the
+# validation split, or only the ones not in it. If 'offsets' are given, reads
+# the rows between them, see --resume. Training examples are balanced by
+# action and state with --reservoir_size, in which case the reservoirs replace
+# the shuffle buffer. With --dedup_window, near-duplicates are dropped in file
+# order, before shuffling and before splitting off validation examples.
+def example_batches(filename, column_defaults, has_disc, is_validation, offsets=None):
+  balance = flags.reservoir_size and not is_validation
+  shuffle_size = 1 if balance else flags.shuffle_size
+  read_shuffle_size = 1 if flags.dedup_window else shuffle_size
+  if offsets:
+    dataset = inputs.appended_dataset(
+        filename,
+        flags.train_batch_size,
+        *offsets,
+        replay_fraction = flags.replay_fraction,
+        column_defaults = column_defaults,
+        shuffle_buffer_size = read_shuffle_size,
+        has_disc = has_disc,
+        row_stride = flags.tick_stride)
+  else:
+    dataset = inputs.example_dataset(
+        filename,
+        flags.train_batch_size,
+        column_defaults = column_defaults,
+        shuffle_buffer_size = read_shuffle_size,
+        has_disc = has_disc,
+        row_stride = flags.tick_stride)
+  if flags.dedup_window:
+    dataset = deduplicate(dataset, INPUT_NAMES[has_disc], is_validation,
+        flags.train_batch_size, shuffle_size)
+  if flags.validation_fraction:
+    dataset = dataset.map(
+        lambda data: validation.split(data, flags.validation_fraction, is_validation),
+        num_parallel_calls = tf.data.experimental.AUTOTUNE)
+  if balance:
+    dataset = stratified.balance(
+        dataset, flags.train_batch_size, flags.reservoir_size, flags.action_ratio)
+  return dataset
+
+# Drops near-duplicates from a dataset of batches read in file order, see
+# --dedup_window, then shuffles the rest through a buffer of 'shuffle_size'.
+def deduplicate(dataset, name, is_validation, batch_size, shuffle_size):
+  deduplicator = dedup.Deduplicator(flags.dedup_precision, flags.dedup_window)
+  deduplicators.append((name + (' validation' if is_validation else ''), deduplicator))
+  return deduplicator.dataset(dataset, batch_size, shuffle_size)
+
+# Reads, decodes and featurizes examples a whole batch at a time.
+# Frame files are permuted on the fly, keeping only examples where
+# team_0_player_0_hasDisc is 'has_disc'.
+def batch_input_fn(filename, column_defaults, labels_fn, has_disc, is_validation=False,
+    offsets=None):
+  splitter = lambda data: (batch_raw_inputs(data), labels_fn(data))
+  dataset = example_batches(filename, column_defaults, has_disc, is_validation, offsets)
+  return dataset.map(splitter, num_parallel_calls = tf.data.experimental.AUTOTUNE) \
+      .prefetch(tf.data.experimental.AUTOTUNE)
+
+def cutter_batches(is_validation=False, offsets=None):
+  if flags.input_mode == 'batch':
+    return batch_input_fn(flags.cutter_input, CUTTER_DEFAULTS, cutter_labels,
+        has_disc = 0, is_validation = is_validation, offsets = offsets)
+  return cutter_input_fn(is_validation).batch(flags.train_batch_size)
+
+def thrower_batches(is_validation=False, offsets=None):
+  if flags.input_mode == 'batch':
+    return batch_input_fn(flags.thrower_input, THROWER_DEFAULTS, thrower_labels,
+        has_disc = 1, is_validation = is_validation, offsets = offsets)
+  return thrower_input_fn(is_validation).batch(flags.train_batch_size)
+
+# Featurizes a batch of examples for both models, then routes each example by
+# team_0_player_0_hasDisc, the same way as getPermutedCsvData.
+def route_batch(data):
+  features = batch_raw_inputs(data)
+  is_thrower = tf.equal(data['team_0_player_0_hasDisc'], 1)
+  is_cutter = tf.logical_not(is_thrower)
+  return (
+      (tf.boolean_mask(features, is_cutter),
+          tf.boolean_mask(cutter_labels(data), is_cutter)),
+      (tf.boolean_mask(features, is_thrower),
+          tf.boolean_mask(thrower_labels(data), is_thrower)))
+
+# Reads both cutter and thrower examples from --input, decoding and featurizing
+# each batch once, see route_batch.
+def shared_batches(is_validation=False, offsets=None):
+  if flags.model == 'player_encoder':
+    return frame_batches(is_validation)
+  dataset = example_batches(
+      flags.input, inputs.COLUMN_DEFAULTS, has_disc = None,
+      is_validation = is_validation, offsets = offsets)
+  return dataset.map(route_batch, num_parallel_calls = tf.data.experimental.AUTOTUNE) \
+      .prefetch(tf.data.experimental.AUTOTUNE)
+
+# Featurizes a batch of frames for --model=player_encoder. Both models take the
+# stacked frames, with labels of shape [frames, 14, 1 + labels] for each of
+# their perspectives. The first label column is 1 for the perspectives the
+# model predicts for, routed by team_0_player_0_hasDisc the same way as
+# route_batch.
+def frame_labels(data):
+  stacked = frames.stack_frames(data)
+  examples = frames.to_columns(
+      tf.reshape(frames.permute(stacked), (-1, len(SELECTED_COLUMNS))))
+  is_thrower = tf.cast(
+      tf.equal(examples['team_0_player_0_hasDisc'], 1), tf.float32)[:, tf.newaxis]
+  cutter = tf.concat([1 - is_thrower, cutter_labels(examples)], axis = -1)
+  thrower = tf.concat([is_thrower, thrower_labels(examples)], axis = -1)
+  perspectives = len(frames.PERSPECTIVES)
+  return (
+      (stacked, tf.reshape(cutter, (-1, perspectives, cutter.shape[-1]))),
+      (stacked, tf.reshape(thrower, (-1, perspectives, thrower.shape[-1]))))
+
+# Number of frames in a batch of --train_batch_size examples.
+def frame_batch_size():
+  return max(1, flags.train_batch_size // len(frames.PERSPECTIVES))
+
+# Reads whole frames from --input for --model=player_encoder, in batches of
+# pairs of cutter and thrower (frames, labels), see frame_labels. Frames are
+# split off for validation, and deduplicated, as a whole.
+def frame_batches(is_validation=False):
+  dataset = inputs.frame_dataset(
+      flags.input,
+      frame_batch_size(),
+      shuffle_buffer_size = 1 if flags.dedup_window else flags.shuffle_size,
+      row_stride = flags.tick_stride)
+  if flags.dedup_window:
+    dataset = deduplicate(dataset, INPUT_NAMES[None], is_validation,
+        frame_batch_size(), flags.shuffle_size)
+  if flags.validation_fraction:
+    dataset = dataset.map(
+        lambda data: validation.split(
+            data, flags.validation_fraction, is_validation, frames.FRAME_COLUMNS),
+        num_parallel_calls = tf.data.experimental.AUTOTUNE)
+  return dataset.map(frame_labels, num_parallel_calls = tf.data.experimental.AUTOTUNE) \
+      .prefetch(tf.data.experimental.AUTOTUNE)
+
+# Returns held out (features, labels) to validate the cutter and thrower models
+# on.
+def validation_sets():
+  if flags.input:
+    dataset = shared_batches(is_validation=True)
+    # Whole frames, with --model=player_encoder.
+    size = flags.validation_size // len(frames.PERSPECTIVES) \
+        if flags.model == 'player_encoder' else flags.validation_size
+    return (
+        validation.collect(dataset.map(lambda cutter, thrower: cutter), size),
+        validation.collect(dataset.map(lambda cutter, thrower: thrower), size))
+  return (
+      validation.collect(cutter_batches(is_validation=True), flags.validation_size),
+      validation.collect(thrower_batches(is_validation=True), flags.validation_size))
+
+# Yields batches from a single long-lived dataset, starting another pass over
+# the input whenever the previous one is exhausted.
+def stream_batches(name, dataset):
+  passes = 0
+  while True:
+    batches = 0
+    for batch in dataset:
+      batches += 1
+      yield batch
+    if not batches:
+      raise ValueError('No %s examples found' % name)
+    passes += 1
+    print('[%s] Finished pass %d over input (%d batches)' % (name, passes, batches))
+
+# Yields pairs of cutter and thrower (features, labels) to train on. With
+# 'offsets', a dict of byte offsets by input file, only yields one pass over the
+# rows between them, with (None, None) once one of the models runs out.
+def training_batches(offsets=None):
+  if offsets and flags.input:
+    return iter(shared_batches(offsets=offsets[flags.input]))
+  elif offsets:
+    return itertools.zip_longest(
+        cutter_batches(offsets=offsets[flags.cutter_input]),
+        thrower_batches(offsets=offsets[flags.thrower_input]),
+        fillvalue=(None, None))
+  elif flags.input:
+    return stream_batches('shared', shared_batches())
+  return zip(
+      stream_batches('cutter', cutter_batches()),
+      stream_batches('thrower', thrower_batches()))
+
+# Number of train steps of fit on a batch of 'examples' examples.
+def fit_steps(examples):
+  return flags.epochs * math.ceil(examples / FIT_BATCH_SIZE)
+
+def fit(model, features, labels):
+  # Routing a shared batch can leave one of the models without examples.
+  if features.shape[0]:
+    model.fit(x=features, y=labels, epochs=flags.epochs,
+        verbose=2 if flags.concurrent else 1)
+
+# Trains model 'name' on one batch, then validates it if 'best' is given, unless
+# it has already stopped early.
+def train(name, model, profiler, features, labels, best=None, validation_set=None):
+  if features is None or (best and best.stopped):
+    return
+  with profiler.fit(name, features.shape[0], fit_steps(features.shape[0])):
+    fit(model, features, labels)
+  if best and features.shape[0]:
+    validation_features, validation_labels = validation_set
+    with profiler.validate(name):
+      best.update(model, model.evaluate(
+          x=validation_features, y=validation_labels, batch_size=EVALUATE_BATCH_SIZE,
+          verbose=0, return_dict=True)['loss'])
+
+LOSSES = {CUTTER_MODEL_DIR: cutter_loss, THROWER_MODEL_DIR: thrower_loss}
+
+# Returns a copy of a batch for each model of an --ensemble, with shape
+# [examples, members, ...]. Each model gets its own shuffle of the batch or,
+# with --bootstrap, its own sample of it, drawn with replacement.
+def member_batches(features, labels):
+  examples = tf.shape(features)[0]
+  if flags.bootstrap:
+    indices = tf.random.uniform((flags.ensemble, examples), maxval=examples, dtype=tf.int32)
+  else:
+    indices = tf.argsort(tf.random.uniform((flags.ensemble, examples)), axis=-1)
+  indices = tf.transpose(indices)
+  return tf.gather(features, indices), tf.gather(labels, indices)
+
+# Returns the mean loss of each member of a StackedConvolutionModel on the same
+# examples.
+def member_losses(name, model, features, labels):
+  outputs = model.predict(features, batch_size=EVALUATE_BATCH_SIZE, verbose=0)
+  labels = tf.tile(labels[:, tf.newaxis, :], (1, model.members, 1))
+  losses = LOSSES[name](
+      tf.reshape(labels, (-1, labels.shape[-1])), tf.reshape(outputs, (-1, outputs.shape[-1])))
+  return tf.reduce_mean(tf.reshape(losses, (-1, model.members)), axis=0).numpy()
+
+# A model has stopped early once all of its members have, with --ensemble.
+def stopped(best):
+  return all(b.stopped for b in best) if isinstance(best, list) else best.stopped
+
+# Same as train, for the StackedConvolutionModel of an --ensemble, with a
+# BestWeights for each of its members.
+def train_ensemble(name, model, profiler, features, labels, best=None, validation_set=None):
+  if features is None or (best and stopped(best)):
+    return
+  with profiler.fit(name, features.shape[0], fit_steps(features.shape[0])):
+    if features.shape[0]:
+      member_features, member_labels = member_batches(features, labels)
+      model.fit(x=member_features, y=member_labels, epochs=flags.epochs,
+          verbose=2 if flags.concurrent else 1)
+  if best and features.shape[0]:
+    with profiler.validate(name):
+      for i, loss in enumerate(member_losses(name, model, *validation_set)):
+        best[i].update(StackedMember(model, i), loss)
+
+def save_ensemble(cutter_model, thrower_model):
+  for model, model_dir, stats in [
+      (cutter_model, CUTTER_MODEL_DIR, flags.cutter_input_stats),
+      (thrower_model, THROWER_MODEL_DIR, flags.thrower_input_stats),
+  ]:
+    normalization = input_stats.load_normalization(stats)
+    for i in range(flags.ensemble):
+      member_model(model, i, normalization).save(
+          os.path.join(flags.output, ENSEMBLE_MODEL_PREFIX + str(i), model_dir),
+          include_optimizer=False)
+  print('Saved %d models to %s' % (flags.ensemble, flags.output))
+
+def benchmark_input(name, dataset, num_batches):
+  examples = 0
+  start = time.time()
+  for batch in dataset.take(num_batches):
+    # Shared batches are pairs of cutter and thrower (features, labels).
+    pairs = batch if flags.input else [batch]
+    examples += sum(features.shape[0] for features, labels in pairs)
+  elapsed = time.time() - start
+  print('[%s] Read %d examples in %.1fs (%.0f examples/sec, input_mode=%s)' %
+      (name, examples, elapsed, examples / elapsed, flags.input_mode))
+
+# Times each stage of the input pipeline of 'name' on its own, see profiling.py.
+# Without 'labels_fn', batches are featurized for both models by route_batch,
+# or by frame_labels with --model=player_encoder.
+def profile_input(profiler, name, filename, column_defaults, has_disc, labels_fn=None):
+  if flags.model == 'player_encoder':
+    decoded = lambda shuffle_size: inputs.frame_dataset(
+        filename,
+        frame_batch_size(),
+        shuffle_buffer_size = shuffle_size)
+    featurize = frame_labels
+    num_elements = flags.profile_batches
+  elif flags.input_mode == 'batch':
+    decoded = lambda shuffle_size: inputs.example_dataset(
+        filename,
+        flags.train_batch_size,
+        column_defaults = column_defaults,
+        shuffle_buffer_size = shuffle_size,
+        has_disc = has_disc)
+    featurize = (lambda data: (batch_raw_inputs(data), labels_fn(data))) \
+        if labels_fn else route_batch
+    num_elements = flags.profile_batches
+  else:
+    decoded = lambda shuffle_size: tf.data.experimental.make_csv_dataset(
+        inputs.input_files(filename),
+        batch_size=1,
+        num_epochs=1,
+        shuffle=False,
+        select_columns = SELECTED_COLUMNS,
+        column_defaults = column_defaults
+      ).shuffle(shuffle_size)
+    featurize = lambda data: (raw_inputs(data), tf.reshape(labels_fn(data), (-1,)))
+    num_elements = flags.profile_batches * flags.train_batch_size
+  profiler.input_stages(name, decoded, featurize, flags.shuffle_size, num_elements)
+
+# Measures the average time of a model.fit step on one batch, for each
+# combination of XLA compilation and compute precision.
+def benchmark_steps(num_steps):
+  cutter_batch, thrower_batch = next(iter(training_batches()))
+  for name, build_fn, (features, labels) in [
+      ('cutter', build_cutter_model, cutter_batch),
+      ('thrower', build_thrower_model, thrower_batch),
+  ]:
+    dataset = tf.data.Dataset.from_tensor_slices((features, labels)) \
+        .take(FIT_BATCH_SIZE) \
+        .batch(FIT_BATCH_SIZE) \
+        .cache() \
+        .repeat()
+    for jit_compile in [False, True]:
+      for bfloat16 in [False, True]:
+        set_precision(bfloat16)
+        model = build_fn(jit_compile)
+        # The first steps trace and compile the train step.
+        model.fit(dataset, steps_per_epoch=10, verbose=0)
+        start, cpu_start = time.time(), time.process_time()
+        model.fit(dataset, steps_per_epoch=num_steps, verbose=0)
+        elapsed, cpu = time.time() - start, time.process_time() - cpu_start
+        print('[%s] jit_compile=%-5s bfloat16=%-5s %.3f ms/step (%.3f ms CPU)' %
+            (name, jit_compile, bfloat16, elapsed * 1000 / num_steps,
+            cpu * 1000 / num_steps))
+  set_precision(flags.bfloat16)
 
 def main():
-  if flags.from_checkpoint:
+  if flags.benchmark_input:
+    if flags.input:
+      benchmark_input('shared', shared_batches(), flags.benchmark_input)
+    else:
+      benchmark_input('cutter', cutter_batches(), flags.benchmark_input)
+      benchmark_input('thrower', thrower_batches(), flags.benchmark_input)
+    return
+
+  if flags.benchmark_steps:
+    benchmark_steps(flags.benchmark_steps)
+    return
+
+  set_precision(flags.bfloat16)
+  if flags.ensemble:
+    cutter_model = build_stacked_model(len(CUTTER_MODEL_OUTPUTS), cutter_loss,
+        flags.cutter_input_stats, flags.jit_compile)
+    thrower_model = build_stacked_model(len(THROWER_MODEL_OUTPUTS), thrower_loss,
+        flags.thrower_input_stats, flags.jit_compile)
+  elif flags.from_checkpoint:
     cutter_model = reload_cutter_model(tf.keras.models.load_model(
-      os.path.join(flags.from_checkpoint, CUTTER_MODEL_DIR)))
+      os.path.join(flags.from_checkpoint, CUTTER_MODEL_DIR)), flags.jit_compile)
     thrower_model = reload_thrower_model(tf.keras.models.load_model(
-      os.path.join(flags.from_checkpoint, THROWER_MODEL_DIR)))
+      os.path.join(flags.from_checkpoint, THROWER_MODEL_DIR)), flags.jit_compile)
   else:
-    cutter_model = build_cutter_model()
-    thrower_model = build_thrower_model()
+    cutter_model = build_cutter_model(flags.jit_compile)
+    thrower_model = build_thrower_model(flags.jit_compile)
+  models = {CUTTER_MODEL_DIR: cutter_model, THROWER_MODEL_DIR: thrower_model}
+
+  offsets = None
+  if flags.resume:
+    cursors = resume.load_cursors(flags.output)
+    filenames = [flags.input] if flags.input else [flags.cutter_input, flags.thrower_input]
+    offsets = {
+        filename: resume.advance(cursors, filename) for filename in set(filenames)
+    }
+    if all(start == end for start, end in offsets.values()):
+      print('No rows appended to %s since the last run, nothing to train on' %
+          ', '.join(sorted(offsets)))
+      return
+    # Builds the models, so that their weights are restored right away, even
+    # if no batch reaches one of them.
+    for model in models.values():
+      model(tf.zeros((1, RAW_INPUTS)))
+    if resume.restore(flags.output, models):
+      print('Restored model and optimizer state from %s' %
+          resume.state_directory(flags.output))
 
+  cutter_best = thrower_best = cutter_validation = thrower_validation = None
+  if flags.validation_fraction:
+    cutter_validation, thrower_validation = validation_sets()
+    if flags.ensemble:
+      cutter_best = [
+          validation.BestWeights('cutter %d' % i, flags.patience)
+          for i in range(flags.ensemble)
+      ]
+      thrower_best = [
+          validation.BestWeights('thrower %d' % i, flags.patience)
+          for i in range(flags.ensemble)
+      ]
+    else:
+      cutter_best = validation.BestWeights('cutter', flags.patience)
+      thrower_best = validation.BestWeights('thrower', flags.patience)
+
+  profiler = profiling.Profiler(
+      flags.profile, flags.profile_trace, trace_steps = flags.profile_trace_steps)
+  if profiler.enabled and flags.input:
+    profile_input(profiler, 'shared', flags.input, inputs.COLUMN_DEFAULTS, None)
+  elif profiler.enabled:
+    profile_input(profiler, CUTTER_MODEL_DIR, flags.cutter_input, CUTTER_DEFAULTS, 0,
+        cutter_labels)
+    profile_input(profiler, THROWER_MODEL_DIR, flags.thrower_input, THROWER_DEFAULTS, 1,
+        thrower_labels)
+
+  executor = concurrent.futures.ThreadPoolExecutor(2) if flags.concurrent else None
+  train_fn = train_ensemble if flags.ensemble else train
+  interrupted = False
+  # With --resume, trains on every appended row, since the cursors are saved
+  # past all of them.
+  batches = training_batches(offsets)
+  if not flags.resume:
+    batches = itertools.islice(batches, flags.train_batches)
+  batches = profiling.TimedIterator(batches)
   try:
-    for batch in range(flags.train_batches):
-      for features, labels in cutter_input_fn().batch(flags.train_batch_size).take(1):
-        cutter_model.fit(x=features, y=labels, epochs=flags.epochs)
-      for features, labels in thrower_input_fn().batch(flags.train_batch_size).take(1):
-        thrower_model.fit(x=features, y=labels, epochs=flags.epochs)
+    for cutter_batch, thrower_batch in batches:
+      profiler.start_chunk(batches.wait)
+      if executor:
+        futures = [
+            executor.submit(train_fn, CUTTER_MODEL_DIR, cutter_model, profiler,
+                *cutter_batch, cutter_best, cutter_validation),
+            executor.submit(train_fn, THROWER_MODEL_DIR, thrower_model, profiler,
+                *thrower_batch, thrower_best, thrower_validation),
+        ]
+        for future in futures:
+          future.result()
+      else:
+        train_fn(CUTTER_MODEL_DIR, cutter_model, profiler,
+            *cutter_batch, cutter_best, cutter_validation)
+        train_fn(THROWER_MODEL_DIR, thrower_model, profiler,
+            *thrower_batch, thrower_best, thrower_validation)
+      profiler.end_chunk()
+      if cutter_best and stopped(cutter_best) and stopped(thrower_best):
+        break
   except KeyboardInterrupt:
     print('\nTraining stopped.')
+    interrupted = True
+  for name, deduplicator in deduplicators:
+    print('[%s] Deduplication %s' % (name, deduplicator.summary()))
+    if profiler.enabled:
+      profiler.log('dedup', model=name, rows=deduplicator.rows, kept=deduplicator.kept)
+  profiler.close()
+
+  if flags.validation_fraction and flags.ensemble:
+    for i in range(flags.ensemble):
+      cutter_best[i].restore(StackedMember(cutter_model, i))
+      thrower_best[i].restore(StackedMember(thrower_model, i))
+  elif flags.validation_fraction:
+    cutter_best.restore(cutter_model)
+    thrower_best.restore(thrower_model)
 
   cutter_model.summary()
   thrower_model.summary()
@@ -359,8 +1000,46 @@ def main():
   #  print('prediction: %s %s' % logits)
   #  print('actual: %s %s' % labels)
 
-  cutter_model.save(os.path.join(flags.output, CUTTER_MODEL_DIR), include_optimizer=False)
-  thrower_model.save(os.path.join(flags.output, THROWER_MODEL_DIR), include_optimizer=False)
+  if flags.ensemble:
+    save_ensemble(cutter_model, thrower_model)
+  else:
+    cutter_model.save(os.path.join(flags.output, CUTTER_MODEL_DIR), include_optimizer=False)
+    thrower_model.save(os.path.join(flags.output, THROWER_MODEL_DIR), include_optimizer=False)
+  if flags.resume and not interrupted:
+    resume.save(flags.output, models, cursors)
 
 if __name__ == '__main__':
+  flags = parser.parse_args()
+  if not flags.input and not (flags.cutter_input and flags.thrower_input):
+    parser.error('Either --input or both --cutter_input and --thrower_input are required')
+  if flags.input and flags.input_mode == 'example':
+    parser.error('--input requires --input_mode=batch')
+  if flags.resume and flags.input_mode == 'example':
+    parser.error('--resume requires --input_mode=batch')
+  if flags.resume and flags.patience:
+    parser.error('--resume trains on all appended rows and does not support --patience')
+  if flags.reservoir_size and flags.input_mode == 'example':
+    parser.error('--reservoir_size requires --input_mode=batch')
+  if (flags.dedup_window or flags.tick_stride != 1) and flags.input_mode == 'example':
+    parser.error('--dedup_window and --tick_stride require --input_mode=batch')
+  if flags.ensemble and (flags.resume or flags.from_checkpoint):
+    parser.error('--ensemble trains new models, and cannot be used with --resume ' +
+        'or --from_checkpoint')
+  if flags.model == 'player_encoder' and not flags.input:
+    parser.error('--model=player_encoder requires frame files as --input')
+  if flags.model == 'player_encoder' and \
+      (flags.ensemble or flags.resume or flags.reservoir_size):
+    parser.error('--model=player_encoder cannot be used with --ensemble, --resume ' +
+        'or --reservoir_size')
+  # Checks the columns of every input file before starting.
+  for path in [flags.input] if flags.input else [flags.cutter_input, flags.thrower_input]:
+    try:
+      input_files = inputs.input_files(path)
+    except ValueError as e:
+      parser.error(str(e))
+    if flags.resume and len(input_files) > 1:
+      parser.error('--resume requires a single file for each input')
+    if flags.model == 'player_encoder' and (os.path.isdir(input_files[0]) or
+        not frames.is_frame_file(input_files[0])):
+      parser.error('--model=player_encoder requires frame files as --input')
   main()
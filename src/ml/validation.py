@@ -0,0 +1,73 @@
+import math
+import tensorflow as tf
+
+from schema import SELECTED_COLUMNS
+
+# Holds out a deterministic fraction of the input for validation. Examples are
+# assigned to the validation split by a fingerprint of their values, so the
+# split is the same across runs, shuffling, and appends to the input.
+
+VALIDATION_BUCKETS = 1 << 16
+
+# Returns a boolean tensor of shape [batch], which is true for examples in the
+# validation split. Whole frames are split by passing 'columns' =
+# frames.FRAME_COLUMNS.
+def is_validation(data, validation_fraction, columns=SELECTED_COLUMNS):
+  values = tf.stack(
+      [tf.cast(data[c], tf.float32) for c in columns], axis = -1)
+  fingerprint = tf.cast(
+      tf.fingerprint(tf.bitcast(values, tf.uint8))[:, :2], tf.int32)
+  bucket = fingerprint[:, 0] * 256 + fingerprint[:, 1]
+  return bucket < int(validation_fraction * VALIDATION_BUCKETS)
+
+# Keeps only the examples of a batch in the validation split, or only the ones
+# not in it.
+def split(data, validation_fraction, validation, columns=SELECTED_COLUMNS):
+  mask = tf.equal(is_validation(data, validation_fraction, columns), validation)
+  return {c: tf.boolean_mask(v, mask) for c, v in data.items()}
+
+# Collects up to 'size' examples from a dataset of (features, labels) batches
+# into a single (features, labels) pair.
+def collect(dataset, size):
+  features, labels = [], []
+  examples = 0
+  for batch_features, batch_labels in dataset:
+    features.append(batch_features)
+    labels.append(batch_labels)
+    examples += batch_features.shape[0]
+    if examples >= size:
+      break
+  if not examples:
+    raise ValueError('No validation examples found')
+  return tf.concat(features, axis = 0)[:size], tf.concat(labels, axis = 0)[:size]
+
+# Tracks the validation loss of a model after each training chunk, keeping the
+# weights with the lowest loss seen so far.
+class BestWeights:
+  def __init__(self, name, patience=0):
+    self.name = name
+    self.patience = patience
+    self.best_loss = math.inf
+    self.weights = None
+    self.chunks_since_best = 0
+    self.stopped = False
+
+  # Returns False once the loss has not improved for 'patience' chunks, if
+  # 'patience' is set.
+  def update(self, model, loss):
+    if loss < self.best_loss:
+      self.best_loss = loss
+      self.weights = model.get_weights()
+      self.chunks_since_best = 0
+    else:
+      self.chunks_since_best += 1
+    print('[%s] Validation loss %.5f (best %.5f, %d chunks ago)' %
+        (self.name, loss, self.best_loss, self.chunks_since_best))
+    if self.patience and self.chunks_since_best >= self.patience:
+      print('[%s] Stopping early' % self.name)
+      self.stopped = True
+    return not self.stopped
+
+  def restore(self, model):
+    if self.weights is not None:
+      model.set_weights(self.weights)
@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import tensorflow as tf
+
+# Data-parallel training across local worker processes. The launcher starts
+# one process per worker, running the same script with the same flags and a
+# TF_CONFIG describing a cluster of workers on localhost. Workers train with
+# MultiWorkerMirroredStrategy, which averages gradients across all workers after
+# every step, and each one reads a different shard of the input.
+
+def free_port():
+  with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as s:
+    s.bind(('localhost', 0))
+    return s.getsockname()[1]
+
+def is_worker():
+  return 'TF_CONFIG' in os.environ
+
+# Returns (num_workers, index) of this process, or (1, 0) outside of a cluster.
+def task():
+  if not is_worker():
+    return 1, 0
+  config = json.loads(os.environ['TF_CONFIG'])
+  return len(config['cluster']['worker']), config['task']['index']
+
+def is_chief():
+  return task()[1] == 0
+
+# Runs this script in 'num_workers' processes, and waits for all of them.
+# Returns the exit code of the first one to fail, or 0.
+def launch(num_workers):
+  cluster = ['localhost:%d' % free_port() for i in range(num_workers)]
+  processes = []
+  for index in range(num_workers):
+    env = dict(os.environ, TF_CONFIG=json.dumps({
+        'cluster': {'worker': cluster},
+        'task': {'type': 'worker', 'index': index},
+    }))
+    processes.append(subprocess.Popen([sys.executable] + sys.argv, env=env))
+  exit_code = 0
+  try:
+    for process in processes:
+      code = process.wait()
+      if code and not exit_code:
+        # The other workers would block forever on the next gradient update.
+        exit_code = code
+        for other in processes:
+          other.terminate()
+  except KeyboardInterrupt:
+    for process in processes:
+      process.wait()
+  return exit_code
+
+# Sets the number of threads TensorFlow uses within and across ops. Must be
+# called before TensorFlow runs any op. By default, the cores are split evenly
+# between workers, so that they do not compete for them.
+def configure_threads(intra_op_threads=None, inter_op_threads=None):
+  num_workers = task()[0]
+  if intra_op_threads is None and num_workers > 1:
+    intra_op_threads = max(1, (os.cpu_count() or 1) // num_workers)
+  if intra_op_threads:
+    tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+  if inter_op_threads:
+    tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+
+def strategy():
+  if is_worker():
+    return tf.distribute.MultiWorkerMirroredStrategy()
+  return tf.distribute.get_strategy()
+
+# Every worker has to save the model, as saving variables involves all of them,
+# but only the chief writes to 'path'. The others write to a temporary
+# directory, which is removed afterwards.
+def save_model(model, path, **kwargs):
+  if is_chief():
+    model.save(path, **kwargs)
+    return
+  directory = tempfile.mkdtemp()
+  try:
+    model.save(os.path.join(directory, os.path.basename(path)), **kwargs)
+  finally:
+    shutil.rmtree(directory, ignore_errors=True)
@@ -72,7 +72,10 @@ function playGame() {
     actionMap.clear();
   }
 
-  return frameTensor.getPermutedCsvData();
+  const [headers, cutterData, throwerData] = frameTensor.getPermutedCsvData();
+  const [frameHeaders, frameData] = flags.get('frame_output') !== '' ?
+    frameTensor.getCsvData() : [null, []];
+  return [headers, cutterData, throwerData, frameHeaders, frameData];
 }
 
 function writeCutterOutput(headers, data) {
@@ -91,6 +94,12 @@ function writeThrowerOutput(headers, data) {
   }
 }
 
+function writeFrameOutput(headers, data) {
+  if (flags.get('frame_output') !== '') {
+    writeOutput(flags.get('frame_output'), headers, data);
+  }
+}
+
 function writeOutput(file, headers, data) {
   if (data.length === 0) {
     return;
@@ -121,6 +130,10 @@ async function main() {
     'thrower_output',
     'data/thrower_examples.csv',
     'File to store permuted thrower training data in CSV format');
+  flags.defineString(
+    'frame_output',
+    '',
+    'File to store un-permuted frames in CSV format, one row per frame');
   flags.parse();
 
   const numGames = flags.get('games');
@@ -138,12 +151,17 @@ async function main() {
 
 function trainSerial(numGames) {
   let headers;
+  let frameHeaders;
   let cutterData = [];
   let throwerData = [];
+  let frameData = [];
 
   for (let i = 0; i < numGames; ++i) {
-    const [newHeaders, newCutterData, newThrowerData] = playGame();
+    const [newHeaders, newCutterData, newThrowerData, newFrameHeaders,
+      newFrameData
+    ] = playGame();
     headers = headers || newHeaders;
+    frameHeaders = frameHeaders || newFrameHeaders;
     if (flags.get('cutter_output') !== '') {
       cutterData = cutterData.concat(newCutterData)
       console.log(
@@ -154,33 +172,46 @@ function trainSerial(numGames) {
       console.log(
         `Thrower: ${throwerData.length} \t (${newThrowerData.length} new)`);
     }
-    if (cutterData.length + throwerData.length > MAX_IN_MEMORY_SAMPLES) {
+    if (flags.get('frame_output') !== '') {
+      frameData = frameData.concat(newFrameData);
+      console.log(
+        `Frames: ${frameData.length} \t (${newFrameData.length} new)`);
+    }
+    if (cutterData.length + throwerData.length + frameData.length
+      > MAX_IN_MEMORY_SAMPLES) {
       writeCutterOutput(headers, cutterData);
       writeThrowerOutput(headers, throwerData);
+      writeFrameOutput(frameHeaders, frameData);
       cutterData = [];
       throwerData = [];
+      frameData = [];
     }
   }
 
   writeCutterOutput(headers, cutterData);
   writeThrowerOutput(headers, throwerData);
+  writeFrameOutput(frameHeaders, frameData);
 }
 
 function trainParallel(numGames) {
   const numWorkers = flags.get('num_workers');
 
   let headers;
+  let frameHeaders;
   let cutterData = [];
   let throwerData = [];
+  let frameData = [];
   let gamesPlayed = 0;
 
   const maybeWrite = () => {
-    if (cutterData.length + throwerData.length > MAX_IN_MEMORY_SAMPLES
-      || gamesPlayed === numGames) {
+    if (cutterData.length + throwerData.length + frameData.length
+      > MAX_IN_MEMORY_SAMPLES || gamesPlayed === numGames) {
       writeCutterOutput(headers, cutterData);
       writeThrowerOutput(headers, throwerData);
+      writeFrameOutput(frameHeaders, frameData);
       cutterData = [];
       throwerData = [];
+      frameData = [];
     }
   }
 
@@ -197,8 +228,11 @@ function trainParallel(numGames) {
     });
     worker.on('message', (newMessage) => {
       ++gamesPlayed;
-      const [newHeaders, newCutterData, newThrowerData] = newMessage;
+      const [newHeaders, newCutterData, newThrowerData, newFrameHeaders,
+        newFrameData
+      ] = newMessage;
       headers = headers || newHeaders;
+      frameHeaders = frameHeaders || newFrameHeaders;
       if (flags.get('cutter_output') !== '') {
         cutterData = cutterData.concat(newCutterData)
         console.log(
@@ -210,6 +244,11 @@ function trainParallel(numGames) {
           `Thrower: ${throwerData.length} \t (${newThrowerData.length} new)`
         );
       }
+      if (flags.get('frame_output') !== '') {
+        frameData = frameData.concat(newFrameData);
+        console.log(
+          `Frames: ${frameData.length} \t (${newFrameData.length} new)`);
+      }
       maybeWrite();
     });
     worker.on('error', (e) => console.error(e));